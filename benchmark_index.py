@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Compares the compressed and approximate LSI indexes to the original 32-bit
+index.
+
+For a random sample of Wikipedia articles, this runs a top-10 search against
+each index, and reports:
+  * The recall@10 -- the fraction of the exact top 10 results which were
+    also found using the other index.
+  * The average search time per query.
+  * The size of the index in memory.
+
+For the approximate (IVF) index, this is repeated for several values of
+`nprobe` to show the trade-off between recall and search time.
+
+Run `make_wikicorpus.py` first (including steps 7 and 8) to create the 
+indexes.
+"""
+from gensim import similarities
+from quantindex import QuantizedIndex
+from ivfindex import IVFIndex
+from ranking import blockedTopN, recallAtN
+import numpy as np
+import time
+
+# The number of results per search, and the number of searches to run.
+topn = 10
+num_queries = 100
+
+def timeSearches(index, query_vecs, query_ids):
+    """
+    Run each of the queries, one at a time, against `index`.
+    Returns (results, average milliseconds per query)
+    """
+    results = []
+
+    t0 = time.time()
+
+    for i in range(0, len(query_ids)):
+        results.extend(index.findTopN(query_vecs[i:i + 1], topn,
+                                      query_ids=query_ids[i:i + 1]))
+
+    return results, (time.time() - t0) * 1000.0 / len(query_ids)
+
+
+class ExactIndex(object):
+    """
+    Wraps the 32-bit MatrixSimilarity so that it has the same search
+    interface as the other index types.
+    """
+    def __init__(self, index):
+        self.index = index
+
+    def scoreBlock(self, query_vecs, start, end):
+        return np.dot(query_vecs, self.index.index[start:end].T)
+
+    def findTopN(self, query_vecs, topn=10, query_ids=None):
+        return blockedTopN(self.scoreBlock, len(self.index), query_vecs, topn,
+                           query_ids)
+
+# ======== main ========
+
+# Read the full 32-bit index into memory.
+print 'Loading the 32-bit LSI index...'
+index = similarities.MatrixSimilarity.load('./data/lsi_index.mm')
+
+num_docs = index.index.shape[0]
+
+# Pick the articles to use as queries. Their LSI vectors are already in the
+# index.
+query_ids = np.sort(np.random.RandomState(0).choice(num_docs, num_queries, replace=False))
+query_vecs = np.asarray(index.index[query_ids])
+
+print '\nRunning %d searches against each index...\n' % num_queries
+
+exact_results, exact_ms = timeSearches(ExactIndex(index), query_vecs, query_ids)
+
+print '  %-24s  %9s  %10s  %8s' % ('Index', 'Recall@%d' % topn, 'ms / query', 'Size (GB)')
+print '  %-24s  %9.3f  %10.1f  %8.2f' % ('float32', 1.0, exact_ms, index.index.nbytes / 2.0**30)
+
+for dtype in ['float16', 'int8']:
+
+    qindex = QuantizedIndex.load('./data/lsi_index_%s.qi' % dtype)
+
+    # Search using just the compressed vectors.
+    results, ms = timeSearches(qindex, query_vecs, query_ids)
+
+    print '  %-24s  %9.3f  %10.1f  %8.2f' % (dtype, recallAtN(exact_results, results), ms, qindex.memorySize() / 2.0**30)
+
+    # Search again, re-scoring a shortlist of candidates with the exact
+    # vectors.
+    qindex.setExactVectors(index.index, rescore_factor=4)
+
+    results, ms = timeSearches(qindex, query_vecs, query_ids)
+
+    print '  %-24s  %9.3f  %10.1f  %8.2f' % (dtype + ' + rescoring', recallAtN(exact_results, results), ms, qindex.memorySize() / 2.0**30)
+
+    del qindex
+
+# Search the approximate index, probing more and more of the clusters.
+ivf_index = IVFIndex.load('./data/lsi_index.ivf')
+
+for nprobe in [1, 4, 16, 32, 64, 128]:
+    ivf_index.nprobe = nprobe
+
+    results, ms = timeSearches(ivf_index, query_vecs, query_ids)
+
+    print '  %-24s  %9.3f  %10.1f  %8.2f' % ('ivf, nprobe=%d' % nprobe, recallAtN(exact_results, results), ms, ivf_index.vectors.nbytes / 2.0**30)
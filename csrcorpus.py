@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+A compact, binary, memory-mapped corpus format with fast random access.
+
+gensim's MmCorpus stores the vectors as Matrix Market text, so every
+document lookup has to seek into the file and parse text. For the Wikipedia
+tf-idf corpus that's a 17.9 GB file.
+
+CsrCorpus instead stores the corpus as a sparse matrix in "compressed sparse
+row" (CSR) form, using three flat binary arrays:
+    indptr  - (int64)   The vector for document `i` is held in positions
+                        indptr[i] to indptr[i + 1] of the other two arrays.
+    indices - (uint32)  The word ids.
+    data    - (float32) The values (e.g., tf-idf weights).
+
+The arrays are memory-mapped, so opening the corpus is instant, looking up a
+document is just a slice of each array, and a batch of documents can be
+gathered into a scipy sparse matrix without any Python loops. The file is
+also much smaller--8 bytes per non-zero value.
+"""
+
+from gensim import interfaces, utils
+from scipy import sparse
+import numpy as np
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class CsrCorpus(interfaces.CorpusABC):
+    """
+    A corpus stored as memory-mapped CSR arrays. Use `CsrCorpus.serialize`
+    to write one out, then `CsrCorpus(fname)` to open it.
+
+    The files are:
+        [fname]          - Pickled header (sizes and data types).
+        [fname].indptr   - Raw int64 array.
+        [fname].indices  - Raw word id array.
+        [fname].data     - Raw value array.
+    """
+
+    def __init__(self, fname, mmap='r'):
+        """
+        Open the corpus saved at `fname`. By default, the arrays are
+        memory-mapped read-only; pass mmap=None to read them into memory.
+        """
+        self.fname = fname
+
+        header = utils.unpickle(fname)
+
+        self.num_docs = header['num_docs']
+        self.num_terms = header['num_terms']
+        self.num_nnz = header['num_nnz']
+
+        self.indptr = self._openArray(fname + '.indptr', np.int64, self.num_docs + 1, mmap)
+        self.indices = self._openArray(fname + '.indices', header['index_dtype'], self.num_nnz, mmap)
+        self.data = self._openArray(fname + '.data', header['data_dtype'], self.num_nnz, mmap)
+
+    @staticmethod
+    def _openArray(fname, dtype, length, mmap):
+        """
+        Internal function which opens (or memory-maps) one of the raw arrays.
+        """
+        # An empty file can't be memory-mapped.
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+
+        if mmap is None:
+            return np.fromfile(fname, dtype=dtype, count=length)
+
+        return np.memmap(fname, dtype=dtype, mode=mmap, shape=(length,))
+
+    def __len__(self):
+        return self.num_docs
+
+    def __getitem__(self, doc_id):
+        """
+        Return the sparse vector for document `doc_id`, as a list of
+        (word_id, value) tuples.
+        """
+        start, end = self.indptr[doc_id], self.indptr[doc_id + 1]
+
+        return list(zip(self.indices[start:end].astype(np.int64).tolist(), self.data[start:end].tolist()))
+
+    def __iter__(self):
+        """
+        Iterate over all of the documents, yielding each as a list of
+        (word_id, value) tuples.
+        """
+        return self.iterDocs()
+
+    def iterDocs(self, start=0):
+        """
+        Iterate over the documents from `start` onward, yielding each as a
+        list of (word_id, value) tuples.
+        """
+        for chunk in self.iterChunks(start=start):
+            for i in range(0, chunk.shape[0]):
+                begin, end = chunk.indptr[i], chunk.indptr[i + 1]
+                yield list(zip(chunk.indices[begin:end].astype(np.int64).tolist(), chunk.data[begin:end].tolist()))
+
+    def getChunk(self, start, end):
+        """
+        Return the documents `start` through `end - 1` as a scipy sparse
+        [num_docs x num_terms] CSR matrix.
+
+        The word ids and values are views onto the (memory-mapped) arrays, so
+        no data is copied.
+        """
+        end = min(end, self.num_docs)
+        indptr = np.asarray(self.indptr[start:end + 1])
+
+        indices = self.indices[indptr[0]:indptr[-1]]
+        data = self.data[indptr[0]:indptr[-1]]
+
+        return sparse.csr_matrix((data, indices, indptr - indptr[0]),
+                                 shape=(end - start, self.num_terms), copy=False)
+
+    def iterChunks(self, chunksize=10000, start=0):
+        """
+        Iterate over the corpus `chunksize` documents at a time, starting from
+        document `start`, yielding each chunk as a scipy sparse CSR matrix
+        (see `getChunk`).
+        """
+        for begin in range(start, self.num_docs, chunksize):
+            yield self.getChunk(begin, begin + chunksize)
+
+    def getRows(self, doc_ids):
+        """
+        Gather the vectors for the documents `doc_ids` into a scipy sparse
+        [len(doc_ids) x num_terms] CSR matrix, without a Python loop.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+
+        starts = np.asarray(self.indptr[doc_ids])
+        lengths = np.asarray(self.indptr[doc_ids + 1]) - starts
+
+        indptr = np.concatenate(([0], np.cumsum(lengths)))
+
+        # The position in `indices` / `data` of every value to gather. Each
+        # document's run of positions is its start plus 0, 1, 2, ...
+        positions = np.repeat(starts - indptr[0:-1], lengths) + np.arange(indptr[-1])
+
+        return sparse.csr_matrix((self.data[positions], self.indices[positions], indptr),
+                                 shape=(len(doc_ids), self.num_terms))
+
+    @staticmethod
+    def checkpointedDocs(fname):
+        """
+        Return the number of documents which have already been written to the
+        partially written corpus at `fname`, according to its checkpoint, or
+        0 if there is no checkpoint.
+
+        To resume writing the corpus, pass the remaining documents (starting
+        from this one) to `serialize` or `serializeChunks` with resume=True.
+        """
+        if not os.path.exists(fname + '.checkpoint'):
+            return 0
+
+        return utils.unpickle(fname + '.checkpoint')['num_docs']
+
+    @staticmethod
+    def serialize(fname, corpus, num_terms=None, index_dtype=np.uint32,
+                  data_dtype=np.float32, progress_cnt=10000, chunksize=10000,
+                  resume=False):
+        """
+        Write the documents in `corpus` (any iterable of sparse vectors) out
+        to `fname` in the CsrCorpus format, one chunk of documents at a time.
+
+        `num_terms` is the size of the vocabulary. If not given, it's taken
+        from the largest word id in the corpus.
+
+        See `serializeChunks` for `resume`.
+
+        Returns the opened CsrCorpus.
+        """
+        def toChunks():
+            for chunk in utils.grouper(corpus, chunksize):
+                lengths = [len(doc) for doc in chunk]
+
+                ids = np.asarray([word_id for doc in chunk for (word_id, value) in doc], dtype=np.int64)
+                values = np.asarray([value for doc in chunk for (word_id, value) in doc], dtype=data_dtype)
+
+                indptr = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+                width = int(ids.max()) + 1 if len(ids) > 0 else 0
+
+                yield sparse.csr_matrix((values, ids, indptr), shape=(len(chunk), width))
+
+        return CsrCorpus.serializeChunks(fname, toChunks(), num_terms, 
+                                         index_dtype, data_dtype, progress_cnt,
+                                         resume)
+
+    @staticmethod
+    def serializeChunks(fname, chunks, num_terms=None, index_dtype=np.uint32,
+                        data_dtype=np.float32, progress_cnt=10000, resume=False):
+        """
+        Write a corpus out to `fname` in the CsrCorpus format, where the
+        corpus is given as a stream of scipy sparse CSR matrices (one row per 
+        document). This avoids converting each document to a list of tuples.
+
+        `num_terms` is the size of the vocabulary. If not given, it's taken
+        from the largest word id in the corpus.
+
+        After each chunk, the progress so far is recorded in a checkpoint 
+        file, [fname].checkpoint, which is removed once the corpus is 
+        complete. If writing is interrupted, it can be picked up again by 
+        passing resume=True, with `chunks` starting from document number
+        `CsrCorpus.checkpointedDocs(fname)`. Otherwise, any partially written
+        corpus is discarded.
+
+        Returns the opened CsrCorpus.
+        """
+        logger.info('storing corpus in CSR format to %s', fname)
+
+        checkpoint_fname = fname + '.checkpoint'
+
+        # The header is written last, so it's only present for a complete 
+        # corpus.
+        if os.path.exists(fname):
+            os.remove(fname)
+
+        if resume and os.path.exists(checkpoint_fname):
+            state = utils.unpickle(checkpoint_fname)
+            
+            logger.info('resuming from document #%d', state['num_docs'])
+        else:
+            state = {'num_docs': 0, 'num_nnz': 0, 'max_id': -1}
+
+        num_docs = state['num_docs']
+        num_nnz = state['num_nnz']
+        max_id = state['max_id']
+
+        # Drop anything written after the last checkpoint.
+        for (ext, length, dtype) in [('.indptr', num_docs + 1, np.int64), 
+                                     ('.indices', num_nnz, index_dtype), 
+                                     ('.data', num_nnz, data_dtype)]:
+            with open(fname + ext, 'ab') as f:
+                f.truncate(length * np.dtype(dtype).itemsize if num_docs > 0 else 0)
+
+        with open(fname + '.indptr', 'ab') as f_indptr, \
+             open(fname + '.indices', 'ab') as f_indices, \
+             open(fname + '.data', 'ab') as f_data:
+
+            if num_docs == 0:
+                np.zeros(1, dtype=np.int64).tofile(f_indptr)
+
+            for chunk in chunks:
+                chunk = sparse.csr_matrix(chunk)
+                
+                indptr = np.asarray(chunk.indptr, dtype=np.int64)
+                ids = chunk.indices[indptr[0]:indptr[-1]]
+
+                # Write out the document boundaries, word ids, and values.
+                (num_nnz + indptr[1:] - indptr[0]).tofile(f_indptr)
+                ids.astype(index_dtype).tofile(f_indices)
+                chunk.data[indptr[0]:indptr[-1]].astype(data_dtype).tofile(f_data)
+
+                if len(ids) > 0:
+                    max_id = max(max_id, int(ids.max()))
+
+                # Report progress every `progress_cnt` documents.
+                if (num_docs + chunk.shape[0]) // progress_cnt > num_docs // progress_cnt:
+                    logger.info('PROGRESS: saving document #%d', num_docs + chunk.shape[0])
+
+                num_docs += chunk.shape[0]
+                num_nnz += len(ids)
+
+                # Record a checkpoint once the chunk is safely written.
+                for f in [f_indptr, f_indices, f_data]:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                utils.pickle({'num_docs': num_docs, 'num_nnz': num_nnz, 'max_id': max_id},
+                             checkpoint_fname + '.tmp')
+                os.rename(checkpoint_fname + '.tmp', checkpoint_fname)
+
+        if num_terms is None:
+            num_terms = max_id + 1
+
+        header = {'num_docs': num_docs, 'num_terms': num_terms,
+                  'num_nnz': num_nnz, 'index_dtype': np.dtype(index_dtype),
+                  'data_dtype': np.dtype(data_dtype)}
+
+        utils.pickle(header, fname)
+
+        if os.path.exists(checkpoint_fname):
+            os.remove(checkpoint_fname)
+
+        logger.info('saved %d documents x %d terms, %d non-zero values to %s',
+                    num_docs, num_terms, num_nnz, fname)
+
+        return CsrCorpus(fname)
+
+    def save(self, *args, **kwargs):
+        """
+        A CsrCorpus is already on disk; use `serialize` to write a copy.
+        """
+        raise NotImplementedError('Use CsrCorpus.serialize to save a corpus.')
+
@@ -0,0 +1,473 @@
+# -*- coding: utf-8 -*-
+"""
+Adds, updates, and deletes documents on a built corpus and LSI index without
+rebuilding them.
+
+The Wikipedia corpus and its index are built once, by `make_wikicorpus.py`,
+and are stored as large (usually memory-mapped) arrays which can't be grown
+in place. To apply a day's worth of edits, the new documents are instead kept
+in a small "delta" segment alongside the original "base" segment:
+
+  - DeltaCorpus wraps the tf-idf corpus, and holds the tf-idf vectors of the
+    added documents in a list, along with their bag-of-words vectors (when
+    given) for BM25 ranking.
+  - DeltaIndex wraps the LSI index, and holds the LSI vectors of the added
+    documents in an array. The new documents are folded into the existing
+    LSI space with the existing projection--the LSI model isn't retrained.
+
+Each wrapper keeps the doc ids contiguous: the added documents simply get
+the next doc ids after the end of the corpus.
+
+Deleted documents (and the old versions of updated ones) are tombstoned by
+KeySearch, and filtered out of the results. `compact` then removes them and
+re-numbers the remaining documents. The wrappers do this by keeping a map
+from each doc id to its row in the base or delta segment, so no rows need to
+be moved--except for a MatrixSimilarity index, which is small enough to
+rebuild in memory.
+
+Saving writes the delta segment to its own files, and leaves the files of the
+base segment (and the inverted index over it) as they were. So applying a
+day's edits to a live, memory-mapped index only writes out the edits.
+"""
+
+from gensim import interfaces, matutils, utils
+from ranking import topN, blockedTopN
+from scipy import sparse
+import numpy as np
+import copy
+
+
+def _invertRows(rows, num_rows):
+    """
+    Internal function which inverts a map of doc id to row into a map of row
+    to doc id. Rows which belong to deleted documents map to -1.
+    """
+    doc_ids = np.full(num_rows, -1, dtype=np.int64)
+    doc_ids[rows] = np.arange(len(rows))
+
+    return doc_ids
+
+
+class DeltaCorpus(interfaces.CorpusABC):
+    """
+    A tf-idf corpus made up of a base corpus plus the tf-idf vectors of the
+    documents added since it was built.
+    """
+
+    def __init__(self, base, num_terms):
+        """
+        Parameters:
+            base       The original tf-idf corpus (e.g., a CsrCorpus or
+                       TfidfCorpus).
+            num_terms  The number of words in the dictionary.
+        """
+        self.base = base
+        self.num_base = len(base)
+        self.num_terms = num_terms
+
+        # The tf-idf vectors of the added documents, and their bag-of-words
+        # vectors (or None, for documents added without one).
+        self.delta = []
+        self.delta_bow = []
+
+        # Map of doc id to row, where rows 0 to num_base - 1 are in the base
+        # corpus and the rest are in `delta`. None until the first
+        # compaction, since until then the doc id is the row.
+        self.rows = None
+        self.doc_ids = None
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
+
+        return self.num_base + len(self.delta)
+
+    def toRows(self, doc_ids):
+        """
+        Translate doc ids to their rows in the base and delta segments.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+
+        if self.rows is None:
+            return doc_ids
+
+        return self.rows[doc_ids]
+
+    def toDocIds(self, rows):
+        """
+        Translate rows in the base and delta segments back to doc ids. Rows
+        which belong to deleted documents are given as -1.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+
+        if self.rows is None:
+            return rows
+
+        return self.doc_ids[rows]
+
+    def __getitem__(self, doc_id):
+        """
+        Return the tf-idf vector for document `doc_id`, as a list of
+        (word_id, value) tuples.
+        """
+        row = int(self.toRows(doc_id))
+
+        if row < self.num_base:
+            return self.base[row]
+
+        return self.delta[row - self.num_base]
+
+    def __iter__(self):
+        """
+        Iterate over all of the documents, in doc id order.
+        """
+        # Before any compaction, this is just the base corpus followed by
+        # the added documents.
+        if self.rows is None:
+            for vec in self.base:
+                yield vec
+            for vec in self.delta:
+                yield vec
+        else:
+            for doc_id in range(0, len(self)):
+                yield self[doc_id]
+
+    def getRows(self, doc_ids):
+        """
+        Gather the tf-idf vectors for the documents `doc_ids` into a scipy
+        sparse [len(doc_ids) x num_terms] CSR matrix.
+        """
+        rows = self.toRows(doc_ids)
+        in_base = rows < self.num_base
+
+        base_rows = rows[in_base]
+        if hasattr(self.base, 'getRows'):
+            base_vecs = self.base.getRows(base_rows)
+        else:
+            base_vecs = matutils.corpus2csc([self.base[row] for row in base_rows],
+                                            num_terms=self.num_terms).T
+
+        delta_vecs = matutils.corpus2csc([self.delta[row - self.num_base] for row in rows[~in_base]],
+                                         num_terms=self.num_terms).T
+
+        vecs = sparse.vstack([sparse.csr_matrix(base_vecs, shape=(len(base_rows), self.num_terms)),
+                              sparse.csr_matrix(delta_vecs, shape=(len(rows) - len(base_rows), self.num_terms))],
+                             format='csr')
+
+        # Put the rows back in the order they were asked for.
+        order = np.concatenate((np.flatnonzero(in_base), np.flatnonzero(~in_base)))
+
+        return vecs[np.argsort(order, kind='mergesort')]
+
+    def iterChunks(self, chunksize=10000, start=0):
+        """
+        Iterate over the corpus `chunksize` documents at a time, starting from
+        document `start`, yielding each chunk as a scipy sparse CSR matrix.
+        """
+        for chunk_start in range(start, len(self), chunksize):
+            yield self.getRows(np.arange(chunk_start, min(chunk_start + chunksize, len(self))))
+
+    def getBow(self, doc_id):
+        """
+        Return the bag-of-words vector for the added document `doc_id`, or
+        None if it was added without one (or is in the base corpus).
+        """
+        row = int(self.toRows(doc_id))
+
+        if row < self.num_base:
+            return None
+
+        return self.delta_bow[row - self.num_base]
+
+    def append(self, vecs, vecs_bow=None):
+        """
+        Add the tf-idf vectors `vecs` to the end of the corpus, along with
+        their bag-of-words vectors `vecs_bow`, if given.
+
+        Returns the doc ids of the new documents.
+        """
+        first_id = len(self)
+        first_row = self.num_base + len(self.delta)
+
+        if vecs_bow is None:
+            vecs_bow = [None] * len(vecs)
+
+        self.delta.extend(vecs)
+        self.delta_bow.extend(vecs_bow)
+
+        if self.rows is not None:
+            self.rows = np.concatenate((self.rows, np.arange(first_row, first_row + len(vecs))))
+            self.doc_ids = _invertRows(self.rows, self.num_base + len(self.delta))
+
+        return list(range(first_id, first_id + len(vecs)))
+
+    def compact(self, keep):
+        """
+        Drop the documents which aren't marked True in the boolean array
+        `keep`. The remaining documents are re-numbered, in order.
+        """
+        self.rows = self.toRows(np.flatnonzero(keep))
+        self.doc_ids = _invertRows(self.rows, self.num_base + len(self.delta))
+
+    def save(self, fname):
+        """
+        Save the delta segment to `fname`: the vectors of the added documents,
+        and the doc id maps. The base corpus isn't included; it's saved on its
+        own (see `KeySearch.save`), and passed back in to `load`.
+        """
+        utils.SaveLoad.save(self, fname, ignore=['base'], sep_limit=0)
+
+    @classmethod
+    def load(cls, fname, base):
+        """
+        Load a delta segment saved with `save`, on top of the base corpus
+        `base`.
+        """
+        corpus = super(DeltaCorpus, cls).load(fname)
+
+        if len(base) != corpus.num_base:
+            raise ValueError('The delta segment in %s was saved over a base corpus of %d '
+                             'documents, not %d.' % (fname, corpus.num_base, len(base)))
+
+        corpus.base = base
+
+        return corpus
+
+
+class DeltaIndex(utils.SaveLoad):
+    """
+    An LSI index made up of a base index plus the LSI vectors of the
+    documents added since it was built.
+
+    The base index can be a MatrixSimilarity, or any of the other index types
+    (e.g., a QuantizedIndex or IvfIndex). The added documents are always
+    scored exactly.
+    """
+
+    def __init__(self, base, num_features):
+        """
+        Parameters:
+            base          The original LSI index.
+            num_features  The number of LSI topics.
+        """
+        self.base = base
+        self.num_base = len(base)
+
+        # The normalized LSI vectors of the added documents.
+        self.delta = np.zeros((0, num_features), dtype=np.float32)
+
+        # Map of doc id to row (see DeltaCorpus).
+        self.rows = None
+        self.doc_ids = None
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
+
+        return self.num_base + self.delta.shape[0]
+
+    def toRows(self, doc_ids):
+        """
+        Translate doc ids to their rows in the base and delta segments.
+        """
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+
+        if self.rows is None:
+            return doc_ids
+
+        return self.rows[doc_ids]
+
+    def toDocIds(self, rows):
+        """
+        Translate rows in the base and delta segments back to doc ids. Rows
+        which belong to deleted documents are given as -1.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+
+        if self.rows is None:
+            return rows
+
+        return self.doc_ids[rows]
+
+    def _baseVectors(self, rows):
+        """
+        Internal function which looks up the LSI vectors for rows of the base
+        index.
+        """
+        if hasattr(self.base, 'getVectors'):
+            return self.base.getVectors(rows)
+
+        return np.asarray(self.base.index[rows])
+
+    def getVectors(self, doc_ids):
+        """
+        Return the normalized LSI vectors for the documents `doc_ids`, as a
+        [len(doc_ids) x num_topics] array.
+        """
+        rows = self.toRows(doc_ids)
+        in_base = rows < self.num_base
+
+        vecs = np.zeros((len(rows), self.delta.shape[1]), dtype=np.float32)
+
+        if np.any(in_base):
+            vecs[in_base] = self._baseVectors(rows[in_base])
+
+        vecs[~in_base] = self.delta[rows[~in_base] - self.num_base]
+
+        return vecs
+
+    def append(self, lsi_vecs):
+        """
+        Add the normalized LSI vectors `lsi_vecs` (one row per document) to
+        the end of the index.
+
+        Returns the doc ids of the new documents.
+        """
+        first_id = len(self)
+        first_row = self.num_base + self.delta.shape[0]
+
+        self.delta = np.vstack((self.delta, np.asarray(lsi_vecs, dtype=np.float32)))
+
+        if self.rows is not None:
+            self.rows = np.concatenate((self.rows, np.arange(first_row, self.num_base + self.delta.shape[0])))
+            self.doc_ids = _invertRows(self.rows, self.num_base + self.delta.shape[0])
+
+        return list(range(first_id, first_id + len(lsi_vecs)))
+
+    def findTopN(self, query_vecs, topn=10, query_ids=None, exclude_ids=None,
+                 mask=None, chunksize=1024, block_size=32768):
+        """
+        Find the `topn` most similar documents for each of the normalized LSI
+        vectors in `query_vecs` (one per row).
+
+        The base and delta segments are searched separately, and their
+        results merged. See `SimSearch.findSimilarToVectorsBatch` for the
+        parameters.
+
+        Returns a list with one entry per query; each entry is a list of
+        tuples in the form:
+            (doc_id, similarity_value)
+        """
+        query_vecs = np.asarray(query_vecs, dtype=np.float32)
+        num_rows = self.num_base + self.delta.shape[0]
+
+        # Translate the filters from doc ids to rows. After a compaction, the
+        # rows of the deleted documents must also be masked out.
+        if self.rows is not None:
+            row_mask = np.zeros(num_rows, dtype=np.bool_)
+            if mask is None:
+                row_mask[self.rows] = True
+            else:
+                row_mask[self.rows[np.asarray(mask, dtype=np.bool_)]] = True
+            mask = row_mask
+
+        if query_ids is not None:
+            query_ids = self.toRows(query_ids)
+
+        if exclude_ids is not None and len(exclude_ids) > 0:
+            exclude_ids = self.toRows(list(exclude_ids))
+        else:
+            exclude_ids = np.zeros(0, dtype=np.int64)
+
+        # Search the base index. Anything in the delta segment is given as a
+        # row of -1, which matches nothing.
+        if query_ids is not None:
+            base_query_ids = np.where(query_ids < self.num_base, query_ids, -1)
+        else:
+            base_query_ids = None
+
+        base_excludes = exclude_ids[exclude_ids < self.num_base]
+        base_mask = mask[0:self.num_base] if mask is not None else None
+
+        if hasattr(self.base, 'findTopN'):
+            base_results = self.base.findTopN(query_vecs, topn, query_ids=base_query_ids,
+                                              exclude_ids=base_excludes, mask=base_mask)
+        else:
+            def scoreBase(vecs, start, end):
+                return np.dot(vecs, self.base.index[start:end].T)
+
+            base_results = blockedTopN(scoreBase, self.num_base, query_vecs, topn,
+                                       base_query_ids, base_excludes, chunksize,
+                                       block_size, base_mask)
+
+        # Search the delta segment, whose rows are numbered from zero.
+        def scoreDelta(vecs, start, end):
+            return np.dot(vecs, self.delta[start:end].T)
+
+        if query_ids is not None:
+            delta_query_ids = query_ids - self.num_base
+        else:
+            delta_query_ids = None
+
+        delta_excludes = exclude_ids[exclude_ids >= self.num_base] - self.num_base
+        delta_mask = mask[self.num_base:] if mask is not None else None
+
+        delta_results = blockedTopN(scoreDelta, self.delta.shape[0], query_vecs, topn,
+                                    delta_query_ids, delta_excludes, chunksize,
+                                    block_size, delta_mask)
+
+        # Merge the two lists for each query, and translate the rows back to
+        # doc ids.
+        results = []
+        for (base_result, delta_result) in zip(base_results, delta_results):
+            rows = [row for (row, sim) in base_result] + \
+                   [row + self.num_base for (row, sim) in delta_result]
+            sims = [sim for (row, sim) in base_result] + \
+                   [sim for (row, sim) in delta_result]
+
+            results.append(topN(np.asarray(sims, dtype=np.float32), topn,
+                                doc_ids=self.toDocIds(rows)))
+
+        return results
+
+    def compact(self, keep):
+        """
+        Drop the documents which aren't marked True in the boolean array
+        `keep`. The remaining documents are re-numbered, in order.
+
+        For a MatrixSimilarity base, the remaining vectors are copied into a
+        new MatrixSimilarity, which is returned. The other index types can't
+        be rebuilt without re-training them, so their deleted rows are just
+        masked out of the search until the next full build; in that case the
+        DeltaIndex itself is returned.
+        """
+        doc_ids = np.flatnonzero(keep)
+
+        if not hasattr(self.base, 'findTopN'):
+            index = copy.copy(self.base)
+            index.index = self.getVectors(doc_ids)
+
+            # The new index isn't the one stored in the base's file (see
+            # `SimSearch.save`).
+            index.fname = None
+
+            return index
+
+        self.rows = self.toRows(doc_ids)
+        self.doc_ids = _invertRows(self.rows, self.num_base + self.delta.shape[0])
+
+        return self
+
+    def save(self, fname):
+        """
+        Save the delta segment to `fname`: the LSI vectors of the added
+        documents, and the doc id maps. The base index isn't included; it's
+        saved on its own (see `SimSearch.save`), and passed back in to `load`.
+        """
+        utils.SaveLoad.save(self, fname, ignore=['base'], sep_limit=0)
+
+    @classmethod
+    def load(cls, fname, base):
+        """
+        Load a delta segment saved with `save`, on top of the base index
+        `base`.
+        """
+        index = super(DeltaIndex, cls).load(fname)
+
+        if len(base) != index.num_base:
+            raise ValueError('The delta segment in %s was saved over a base index of %d '
+                             'documents, not %d.' % (fname, index.num_base, len(base)))
+
+        index.base = base
+
+        return index
@@ -0,0 +1,534 @@
+# -*- coding: utf-8 -*-
+"""
+An inverted index over the tf-idf corpus, for fast boolean keyword search.
+
+Without an index, a keyword search has to read through every document in the
+corpus and check which words it contains--for Wikipedia, that's ~4.2M
+documents per query. InvertedIndex instead stores, for every word in the
+vocabulary, the sorted list of doc ids which contain that word (the word's
+"postings"). A keyword search is then just an intersection of the postings
+for the required words, minus the postings for the excluded words.
+
+The postings are compressed. Each list is stored as the differences between
+consecutive doc ids ("delta" or "gap" encoding), and each difference is
+written as a variable number of bytes (7 bits per byte, with the high bit set
+on the last byte of each number). Common words have small gaps which fit in a
+single byte, so the whole index is a fraction of the size of the corpus.
+
+The encoding and decoding are done with numpy array operations rather than a
+Python loop over the values.
+"""
+
+from gensim import utils, matutils
+from ranking import topN
+import numpy as np
+import tempfile
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def encodeVarbyte(values):
+    """
+    Encode an array of non-negative integers as variable-length bytes.
+
+    Each value is split into 7-bit groups, least significant group first. The
+    high bit is set on the final byte of each value.
+
+    Returns a uint8 array.
+    """
+    values = np.asarray(values, dtype=np.uint64)
+
+    # The number of bytes needed for each value (at least one, even for 0).
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    remaining = values >> np.uint64(7)
+    while np.any(remaining):
+        num_bytes += (remaining > 0)
+        remaining >>= np.uint64(7)
+
+    # For every output byte, look up which value it belongs to and which of
+    # that value's 7-bit groups it holds.
+    owners = np.repeat(np.arange(len(values)), num_bytes)
+    starts = np.cumsum(num_bytes) - num_bytes
+    groups = np.arange(len(owners)) - starts[owners]
+
+    encoded = ((values[owners] >> (np.uint64(7) * groups.astype(np.uint64))) & np.uint64(0x7f)).astype(np.uint8)
+
+    # Mark the last byte of each value.
+    encoded[starts + num_bytes - 1] |= 0x80
+
+    return encoded
+
+
+def decodeVarbyte(encoded):
+    """
+    Decode a uint8 array written by `encodeVarbyte`.
+
+    Returns an int64 array of the values.
+    """
+    encoded = np.asarray(encoded, dtype=np.uint8)
+
+    if len(encoded) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Each value ends on a byte with the high bit set.
+    ends = np.flatnonzero(encoded & 0x80)
+    starts = np.concatenate(([0], ends[0:-1] + 1))
+
+    # The position of each byte within its value gives the amount to shift
+    # its 7 bits by.
+    groups = np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1)
+
+    parts = (encoded & 0x7f).astype(np.int64) << (7 * groups)
+
+    return np.add.reduceat(parts, starts)
+
+
+class InvertedIndex(utils.SaveLoad):
+    """
+    Maps every word id to the compressed, sorted list of doc ids which
+    contain that word.
+
+    The postings for all of the words are stored back-to-back in one byte
+    array:
+        postings  - The varbyte-encoded doc id gaps, for all words.
+        offsets   - The bytes for word `i` are offsets[i] to offsets[i + 1].
+        dfs       - The number of documents containing each word.
+
+    Optionally, the index also stores the number of times each word occurs in
+    each document, which is needed for ranked (BM25) search:
+        counts         - The varbyte-encoded term counts, in the same order
+                         as the postings.
+        count_offsets  - The bytes for word `i` are count_offsets[i] to
+                         count_offsets[i + 1].
+        doc_lens       - The length (total term count) of each document.
+        max_counts     - The largest count of each word in any document.
+        min_lens       - The shortest document containing each word.
+    """
+
+    # These are only present if the term counts were stored.
+    counts = None
+    count_offsets = None
+    doc_lens = None
+
+    def __init__(self, corpus, num_terms, chunksize=10000, words_per_block=4096,
+                 store_counts=False, idfs=None):
+        """
+        Build the index from `corpus`, a gensim corpus of sparse vectors (such
+        as the tf-idf corpus). If the corpus is a CsrCorpus, it's read one
+        chunk of rows at a time without any Python loops.
+
+        The corpus is read twice: once to count the number of documents for
+        each word, and once to fill in the postings. The uncompressed postings
+        are collected in a temporary file rather than in memory.
+
+        Parameters:
+            num_terms        The size of the vocabulary.
+            chunksize        The number of documents to process at once.
+            words_per_block  The number of words to compress at once.
+            store_counts     Also store the term counts, for `rankBM25`. The
+                             values in `corpus` must either be the term
+                             counts (a bag-of-words corpus), or un-normalized
+                             tf-idf weights, in which case pass the idf of
+                             each word as `idfs` to recover the counts.
+        """
+        self.num_terms = num_terms
+
+        if idfs is not None:
+            idfs = np.asarray(idfs, dtype=np.float64)
+
+        # Pass 1 - Count the number of documents containing each word, and
+        # the length of each document.
+        logger.info('counting document frequencies')
+
+        self.num_docs = 0
+        self.dfs = np.zeros(num_terms, dtype=np.int64)
+        doc_lens = []
+
+        for chunk in self._iterChunks(corpus, num_terms, chunksize):
+            self.dfs += np.bincount(chunk.indices, minlength=num_terms)
+            self.num_docs += chunk.shape[0]
+
+            if store_counts:
+                counts = self._getCounts(chunk.data, chunk.indices, idfs)
+                rows = np.repeat(np.arange(chunk.shape[0]), np.diff(chunk.indptr))
+                doc_lens.append(np.bincount(rows, weights=counts, minlength=chunk.shape[0]))
+
+        num_nnz = int(self.dfs.sum())
+
+        if store_counts:
+            self.doc_lens = np.concatenate(doc_lens).astype(np.int32) if len(doc_lens) > 0 else np.zeros(0, dtype=np.int32)
+
+        # Pass 2 - Write each document's id into the postings of each of its
+        # words. The documents are read in order, so every word's list of doc
+        # ids comes out sorted.
+        logger.info('collecting %d postings for %d words', num_nnz, num_terms)
+
+        word_starts = np.concatenate(([0], np.cumsum(self.dfs)))
+
+        with tempfile.TemporaryFile() as f_ids, tempfile.TemporaryFile() as f_counts:
+
+            doc_ids = self._createTempArray(f_ids, num_nnz)
+            if store_counts:
+                term_counts = self._createTempArray(f_counts, num_nnz)
+
+            # The next free position in the postings for each word.
+            next_pos = word_starts[0:-1].copy()
+
+            doc_offset = 0
+            for chunk in self._iterChunks(corpus, num_terms, chunksize):
+
+                # Transposing the chunk groups its values by word; each word's
+                # doc ids come out sorted.
+                chunk_csc = chunk.tocsc()
+                chunk_csc.sort_indices()
+
+                counts = np.diff(chunk_csc.indptr)
+
+                # The destination of each value is the next free position for
+                # its word, plus its place within the word's run in this chunk.
+                run_starts = np.repeat(chunk_csc.indptr[0:-1], counts)
+                dests = np.repeat(next_pos, counts) + (np.arange(chunk_csc.nnz) - run_starts)
+
+                doc_ids[dests] = chunk_csc.indices + doc_offset
+
+                if store_counts:
+                    word_ids = np.repeat(np.arange(num_terms), counts)
+                    term_counts[dests] = self._getCounts(chunk_csc.data, word_ids, idfs)
+
+                next_pos += counts
+                doc_offset += chunk.shape[0]
+
+            # Compress the postings, a block of words at a time. The doc ids
+            # are stored as gaps.
+            logger.info('compressing postings')
+
+            self.postings, self.offsets = self._compressLists(doc_ids, word_starts, words_per_block, gaps=True)
+
+            if store_counts:
+                self.counts, self.count_offsets = self._compressLists(term_counts, word_starts, words_per_block, gaps=False)
+
+                # Record the largest count and the shortest document for each
+                # word. These give an upper bound on the word's BM25 score.
+                present = np.flatnonzero(self.dfs > 0)
+
+                self.max_counts = np.zeros(num_terms, dtype=np.int32)
+                self.min_lens = np.zeros(num_terms, dtype=np.int32)
+
+                for start in range(0, len(present), words_per_block):
+                    words = present[start:start + words_per_block]
+                    first, last = word_starts[words[0]], word_starts[words[-1] + 1]
+
+                    block_counts = np.asarray(term_counts[first:last])
+                    block_lens = self.doc_lens[np.asarray(doc_ids[first:last])]
+
+                    self.max_counts[words] = np.maximum.reduceat(block_counts, word_starts[words] - first)
+                    self.min_lens[words] = np.minimum.reduceat(block_lens, word_starts[words] - first)
+
+                del term_counts
+
+            del doc_ids
+
+        logger.info('built inverted index: %d documents, %d postings in %d bytes',
+                    self.num_docs, num_nnz, len(self.postings))
+
+    @staticmethod
+    def _iterChunks(corpus, num_terms, chunksize):
+        """
+        Internal function which yields the corpus as scipy sparse CSR
+        matrices of up to `chunksize` documents each.
+        """
+        if hasattr(corpus, 'iterChunks'):
+            for chunk in corpus.iterChunks(chunksize):
+                yield chunk
+        else:
+            for chunk in utils.grouper(corpus, chunksize):
+                yield matutils.corpus2csc(chunk, num_terms=num_terms).T.tocsr()
+
+    @staticmethod
+    def _getCounts(values, word_ids, idfs):
+        """
+        Internal function which returns the term counts for the corpus
+        `values` of the words `word_ids`, dividing out the idf weights if
+        given.
+        """
+        values = np.asarray(values, dtype=np.float64)
+
+        if idfs is not None:
+            values = values / idfs[word_ids]
+
+        return np.maximum(np.rint(values), 1).astype(np.uint32)
+
+    @staticmethod
+    def _createTempArray(f_tmp, length):
+        """
+        Internal function which creates a uint32 array of `length` values,
+        backed by the temporary file `f_tmp`.
+        """
+        if length == 0:
+            return np.zeros(0, dtype=np.uint32)
+
+        return np.memmap(f_tmp, dtype=np.uint32, mode='w+', shape=(length,))
+
+    def _compressLists(self, values, word_starts, words_per_block, gaps):
+        """
+        Internal function which varbyte-encodes the lists of `values` for
+        every word, where the list for word `i` is values[word_starts[i]] to
+        values[word_starts[i + 1] - 1].
+
+        If `gaps` is True, each value (other than the first for each word) is
+        stored as the difference from the previous one.
+
+        Returns (encoded, offsets), where the bytes for word `i` are
+        encoded[offsets[i]:offsets[i + 1]].
+        """
+        blocks = []
+        num_bytes = np.zeros(self.num_terms, dtype=np.int64)
+
+        for start in range(0, self.num_terms, words_per_block):
+            end = min(start + words_per_block, self.num_terms)
+
+            block = np.asarray(values[word_starts[start]:word_starts[end]], dtype=np.int64)
+
+            # Replace each doc id with the gap from the previous one. The
+            # first doc id for each word is kept as-is.
+            if gaps:
+                firsts = word_starts[start:end][self.dfs[start:end] > 0] - word_starts[start]
+
+                block_gaps = np.diff(np.concatenate(([0], block)))
+                block_gaps[firsts] = block[firsts]
+                block = block_gaps
+
+            encoded = encodeVarbyte(block)
+            blocks.append(encoded)
+
+            # Count the bytes used by each word. The last byte of each value
+            # has its high bit set, so this gives the byte offset at which
+            # each value ends.
+            value_ends = np.concatenate(([0], np.flatnonzero(encoded & 0x80) + 1))
+            num_bytes[start:end] = np.diff(value_ends[word_starts[start:end + 1] - word_starts[start]])
+
+        if len(blocks) > 0:
+            encoded = np.concatenate(blocks)
+        else:
+            encoded = np.zeros(0, dtype=np.uint8)
+
+        return encoded, np.concatenate(([0], np.cumsum(num_bytes))).astype(np.int64)
+
+    def __len__(self):
+        return self.num_docs
+
+    def getPostings(self, word_id):
+        """
+        Return the sorted doc ids of the documents containing `word_id`, as an
+        int64 array.
+        """
+        if word_id < 0 or word_id >= self.num_terms:
+            return np.zeros(0, dtype=np.int64)
+
+        encoded = self.postings[self.offsets[word_id]:self.offsets[word_id + 1]]
+
+        # Undo the gap encoding.
+        return np.cumsum(decodeVarbyte(encoded))
+
+    def getCounts(self, word_id):
+        """
+        Return the number of times `word_id` occurs in each of the documents
+        in its postings (see `getPostings`), as an int64 array.
+        """
+        if self.counts is None:
+            raise ValueError('The term counts were not stored in this index.')
+
+        if word_id < 0 or word_id >= self.num_terms:
+            return np.zeros(0, dtype=np.int64)
+
+        return decodeVarbyte(self.counts[self.count_offsets[word_id]:self.count_offsets[word_id + 1]])
+
+    def rankBM25(self, query_bow, topn=10, k1=1.2, b=0.75, mask=None):
+        """
+        Find the `topn` documents with the highest BM25 scores for the query
+        `query_bow`, a bag-of-words vector (list of (word_id, count) tuples).
+        Requires the term counts (see `store_counts`).
+
+        Rather than scoring every posting of every query word, this uses the
+        "MaxScore" strategy. Each word has an upper bound on the score it can
+        add to a document. The words are processed from the highest bound to
+        the lowest, keeping a set of candidate documents. Once the bounds of
+        the remaining words add up to less than the current top-n cut-off, no
+        new document can make it into the results--so for the remaining
+        words, only the existing candidates are scored, and candidates which
+        can no longer make the cut are dropped.
+
+        `mask` is an optional boolean array over all of the documents; only
+        the documents marked True are scored.
+
+        Returns a list of tuples in the form:
+            (doc_id, score)
+        """
+        if self.counts is None:
+            raise ValueError('The term counts were not stored in this index.')
+
+        (word_ids, idfs, avg_len) = self._getQueryWeights(query_bow)
+
+        if len(word_ids) == 0:
+            return []
+
+        def score(i, counts, lens):
+            """
+            The BM25 score contribution of query word `i`.
+            """
+            counts = np.asarray(counts, dtype=np.float64)
+            return idfs[i] * counts * (k1 + 1) / (counts + k1 * (1 - b + b * lens / avg_len))
+
+        # The highest score each word can contribute comes from its largest
+        # count in its shortest document.
+        bounds = np.asarray([score(i, self.max_counts[word_id], self.min_lens[word_id])
+                             for (i, word_id) in enumerate(word_ids)])
+
+        order = np.argsort(-bounds, kind='mergesort')
+
+        # remaining[j] is the most that words order[j:] can add to a score.
+        remaining = np.concatenate((np.cumsum(bounds[order][::-1])[::-1], [0]))
+
+        cand_ids = np.zeros(0, dtype=np.int64)
+        cand_scores = np.zeros(0, dtype=np.float64)
+        threshold = 0.0
+
+        for (j, i) in enumerate(order):
+            doc_ids = self.getPostings(word_ids[i])
+            counts = self.getCounts(word_ids[i])
+
+            # Drop the filtered out documents.
+            if mask is not None:
+                keep = mask[doc_ids]
+                doc_ids = doc_ids[keep]
+                counts = counts[keep]
+
+            if len(doc_ids) == 0:
+                continue
+
+            # If the remaining words can't lift a new document above the
+            # cut-off, just score the current candidates.
+            if len(cand_ids) >= topn and remaining[j] < threshold:
+                pos = np.minimum(np.searchsorted(doc_ids, cand_ids), len(doc_ids) - 1)
+                found = np.flatnonzero(doc_ids[pos] == cand_ids)
+
+                cand_scores[found] += score(i, counts[pos[found]], self.doc_lens[cand_ids[found]])
+
+            # Otherwise, score all of the word's documents and add them to
+            # the candidates.
+            else:
+                scores = score(i, counts, self.doc_lens[doc_ids])
+
+                cand_ids, inverse = np.unique(np.concatenate((cand_ids, doc_ids)), return_inverse=True)
+                cand_scores = np.bincount(inverse, weights=np.concatenate((cand_scores, scores)))
+
+            # The scores so far are lower bounds, so the n-th best of them is
+            # a lower bound on the final cut-off.
+            if len(cand_ids) >= topn:
+                threshold = np.partition(cand_scores, len(cand_ids) - topn)[len(cand_ids) - topn]
+
+                # Drop the candidates which can't reach the cut-off.
+                keep = cand_scores + remaining[j + 1] >= threshold
+                cand_ids = cand_ids[keep]
+                cand_scores = cand_scores[keep]
+
+        return topN(cand_scores, topn, doc_ids=cand_ids)
+
+    def _getQueryWeights(self, query_bow):
+        """
+        Internal function which prepares a BM25 query. Repeated words are
+        combined, and words which aren't in the index are dropped.
+
+        Returns (word_ids, idfs, avg_len), where `idfs` holds the idf of each
+        word times its count in the query, and `avg_len` is the average
+        document length.
+        """
+        query = {}
+        for (word_id, count) in query_bow:
+            if word_id >= 0 and word_id < self.num_terms and self.dfs[word_id] > 0:
+                query[word_id] = query.get(word_id, 0) + count
+
+        if len(query) == 0 or self.num_docs == 0:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0), 1.0)
+
+        word_ids = np.asarray(list(query.keys()), dtype=np.int64)
+        weights = np.asarray(list(query.values()), dtype=np.float64)
+
+        avg_len = max(float(np.mean(self.doc_lens)), 1.0)
+
+        dfs = self.dfs[word_ids].astype(np.float64)
+        idfs = weights * np.log(1.0 + (self.num_docs - dfs + 0.5) / (dfs + 0.5))
+
+        return (word_ids, idfs, avg_len)
+
+    def scoreBM25(self, query_bow, doc_bows, k1=1.2, b=0.75):
+        """
+        Score documents which aren't in the index (e.g., documents added
+        since it was built) against the query `query_bow`, with the same BM25
+        formula as `rankBM25`. The word statistics (document frequencies and
+        average length) are taken from the indexed documents.
+
+        `doc_bows` is a list of bag-of-words vectors.
+
+        Returns an array with the score of each document.
+        """
+        if self.counts is None:
+            raise ValueError('The term counts were not stored in this index.')
+
+        (word_ids, idfs, avg_len) = self._getQueryWeights(query_bow)
+
+        idf_of = dict(zip(word_ids.tolist(), idfs.tolist()))
+
+        scores = np.zeros(len(doc_bows), dtype=np.float64)
+
+        for (i, doc_bow) in enumerate(doc_bows):
+            doc_len = float(sum(count for (word_id, count) in doc_bow))
+
+            for (word_id, count) in doc_bow:
+                if word_id in idf_of:
+                    scores[i] += idf_of[word_id] * count * (k1 + 1) / \
+                                 (count + k1 * (1 - b + b * doc_len / avg_len))
+
+        return scores
+
+    def search(self, include_ids=[], exclude_ids=[], docs=None):
+        """
+        Find the documents which contain all of the words `include_ids` and
+        none of the words `exclude_ids`.
+
+        `docs` optionally restricts the search to a list of doc ids.
+
+        Returns an int64 array of the matching doc ids, sorted (or in the
+        order given in `docs`).
+        """
+        # Start from the least common word; the intersections can only shrink
+        # from there.
+        include_ids = sorted(include_ids, key=lambda word_id: self.dfs[word_id])
+
+        if docs is not None:
+            results = np.unique(np.asarray(docs, dtype=np.int64))
+        elif len(include_ids) > 0:
+            results = self.getPostings(include_ids[0])
+            include_ids = include_ids[1:]
+        else:
+            results = np.arange(self.num_docs, dtype=np.int64)
+
+        for word_id in include_ids:
+            if len(results) == 0:
+                break
+            results = np.intersect1d(results, self.getPostings(word_id), assume_unique=True)
+
+        for word_id in exclude_ids:
+            if len(results) == 0:
+                break
+            if word_id < 0:
+                continue
+            results = np.setdiff1d(results, self.getPostings(word_id), assume_unique=True)
+
+        # Return the matches in the order they were given.
+        if docs is not None:
+            docs = np.asarray(docs, dtype=np.int64)
+            return docs[np.in1d(docs, results)]
+
+        return results
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+An approximate nearest-neighbour index for the LSI vectors, for use in place
+of a gensim MatrixSimilarity.
+
+A MatrixSimilarity compares every query against every document, so search
+time grows with the size of the corpus. IVFIndex (an "inverted file" index)
+instead clusters the document vectors with k-means. Each document is filed
+under its nearest cluster centroid. To perform a search, the query is first
+compared to the centroids, and then only the documents in the `nprobe`
+nearest clusters are scored.
+
+With ~4,000-8,000 clusters for Wikipedia, a search only needs to score a
+percent or two of the corpus. The results are approximate--a true match may
+be filed under a cluster that wasn't probed. Increasing `nprobe` trades
+speed for recall; `benchmark_index.py` measures this trade-off.
+"""
+
+from gensim import utils
+from scipy import sparse
+from ranking import topN
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class IVFIndex(utils.SaveLoad):
+    """
+    Clusters a [num_docs x num_features] matrix of unit-length LSI vectors,
+    and performs approximate similarity searches against it.
+
+    The vectors are stored re-ordered so that the documents in each cluster
+    are contiguous:
+        vectors    - The LSI vectors, grouped by cluster.
+        doc_ids    - The doc id of each row in `vectors`.
+        offsets    - The rows for cluster `i` are offsets[i] to offsets[i + 1].
+        positions  - The row in `vectors` for each doc id.
+    """
+
+    def __init__(self, vectors, num_lists=None, num_iters=10,
+                 sample_size=None, nprobe=32, block_size=4096, seed=0):
+        """
+        Build the index from the LSI vectors `vectors`, which should already
+        be normalized to unit length. Typically this is the `index` property
+        of a MatrixSimilarity (which may be memory-mapped).
+
+        Parameters:
+            num_lists    The number of clusters. Defaults to 4 x sqrt(num_docs).
+            num_iters    The number of k-means iterations.
+            sample_size  The number of documents to train the k-means
+                         clustering on. Defaults to 64 per cluster.
+            nprobe       The default number of clusters to search.
+            block_size   The number of documents to process at once when
+                         assigning documents to clusters.
+        """
+        self.num_docs, self.num_features = vectors.shape
+        self.nprobe = nprobe
+
+        if num_lists is None:
+            num_lists = int(4 * np.sqrt(self.num_docs))
+        num_lists = max(1, min(num_lists, self.num_docs))
+
+        if sample_size is None:
+            sample_size = 64 * num_lists
+        sample_size = max(num_lists, min(sample_size, self.num_docs))
+
+        rng = np.random.RandomState(seed)
+
+        # Learn the cluster centroids from a sample of the documents.
+        self.centroids = self._trainCentroids(vectors, num_lists, num_iters,
+                                              sample_size, block_size, rng)
+
+        # Assign every document to its nearest centroid.
+        logger.info('assigning %d documents to %d clusters', self.num_docs, num_lists)
+
+        assignments = np.empty(self.num_docs, dtype=np.int32)
+        for start in range(0, self.num_docs, block_size):
+            end = min(start + block_size, self.num_docs)
+            block = np.asarray(vectors[start:end], dtype=np.float32)
+            assignments[start:end] = self._assign(block, self.centroids)
+
+        # Group the documents by cluster. The sort is stable, so the doc ids
+        # within each cluster stay in increasing order.
+        self.doc_ids = np.argsort(assignments, kind='mergesort').astype(np.int32)
+
+        counts = np.bincount(assignments, minlength=num_lists)
+        self.offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+        self.positions = np.empty(self.num_docs, dtype=np.int32)
+        self.positions[self.doc_ids] = np.arange(self.num_docs, dtype=np.int32)
+
+        # Copy the vectors over in their new order.
+        self.vectors = np.empty((self.num_docs, self.num_features), dtype=np.float32)
+        for start in range(0, self.num_docs, block_size):
+            end = min(start + block_size, self.num_docs)
+            self.vectors[start:end] = vectors[self.doc_ids[start:end]]
+
+    def _trainCentroids(self, vectors, num_lists, num_iters, sample_size,
+                        block_size, rng):
+        """
+        Internal function which runs spherical k-means (k-means using cosine
+        similarity) on a random sample of the vectors.
+
+        Returns a [num_lists x num_features] array of unit-length centroids.
+        """
+        # Read in the sample, in doc id order.
+        sample_ids = np.sort(rng.choice(self.num_docs, sample_size, replace=False))
+        sample = np.asarray(vectors[sample_ids], dtype=np.float32)
+
+        # Start from randomly chosen sample vectors.
+        centroids = sample[rng.choice(sample_size, num_lists, replace=False)].copy()
+
+        for i in range(0, num_iters):
+            logger.info('k-means iteration %d of %d', i + 1, num_iters)
+
+            # Assign each sample vector to its nearest centroid.
+            assignments = np.concatenate([
+                self._assign(sample[start:start + block_size], centroids)
+                for start in range(0, sample_size, block_size)])
+
+            # Sum up the vectors in each cluster, using a sparse matrix
+            # product rather than a Python loop.
+            members = sparse.csr_matrix(
+                (np.ones(sample_size, dtype=np.float32),
+                 (assignments, np.arange(sample_size))),
+                shape=(num_lists, sample_size))
+
+            centroids = np.asarray(members.dot(sample), dtype=np.float32)
+
+            # Re-start any empty clusters from a random sample vector.
+            empty = np.flatnonzero(np.bincount(assignments, minlength=num_lists) == 0)
+            if len(empty) > 0:
+                centroids[empty] = sample[rng.choice(sample_size, len(empty), replace=False)]
+
+            # Normalize the centroids to unit length.
+            norms = np.sqrt(np.sum(centroids ** 2, axis=1))
+            norms[norms == 0] = 1.0
+            centroids /= norms[:, np.newaxis]
+
+        return centroids
+
+    def _assign(self, block, centroids):
+        """
+        Internal function which returns the index of the nearest centroid for
+        each vector in `block`.
+        """
+        return np.argmax(np.dot(block, centroids.T), axis=1)
+
+    def __len__(self):
+        return self.num_docs
+
+    def getVectors(self, doc_ids):
+        """
+        Return the LSI vectors for the specified documents.
+        """
+        return np.asarray(self.vectors[self.positions[doc_ids]])
+
+    def findTopN(self, query_vecs, topn=10, query_ids=None, exclude_ids=None,
+                 mask=None, nprobe=None):
+        """
+        Find (approximately) the `topn` most similar documents for each of the
+        normalized LSI vectors in `query_vecs` (one per row).
+
+        Only the documents in the `nprobe` clusters nearest to each query are
+        searched. Defaults to the `nprobe` property of the index.
+
+        See `SimSearch.findSimilarToVectorsBatch` for the other parameters.
+        `mask` is an optional boolean array over all of the documents; only
+        the documents marked True can appear in the results.
+
+        Returns a list with one entry per query; each entry is a list of
+        tuples in the form:
+            (doc_id, similarity_value)
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        nprobe = min(nprobe, self.centroids.shape[0])
+
+        query_vecs = np.asarray(query_vecs, dtype=np.float32)
+
+        if exclude_ids is None:
+            exclude_ids = []
+
+        # Compare all of the queries to the centroids in one step, and pick
+        # the nearest clusters for each.
+        centroid_sims = np.dot(query_vecs, self.centroids.T)
+
+        results = []
+        for i in range(0, query_vecs.shape[0]):
+
+            if nprobe < centroid_sims.shape[1]:
+                probes = np.argpartition(-centroid_sims[i], nprobe - 1)[0:nprobe]
+            else:
+                probes = np.arange(centroid_sims.shape[1])
+
+            # Gather the rows for all of the probed clusters. Each cluster is
+            # a contiguous run of rows.
+            rows = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1])
+                                   for p in np.sort(probes)])
+
+            # Drop the filtered out documents before scoring.
+            if mask is not None:
+                rows = rows[mask[self.doc_ids[rows]]]
+
+            # Score just these documents.
+            sims = np.dot(self.vectors[rows], query_vecs[i])
+
+            # Leave the query document out of its own results.
+            if query_ids is not None:
+                excludes = list(exclude_ids) + [query_ids[i]]
+            else:
+                excludes = exclude_ids
+
+            results.append(topN(sims, topn, exclude_ids=excludes,
+                                doc_ids=self.doc_ids[rows]))
+
+        return results
@@ -7,9 +7,20 @@ Created on Tue Nov 22 11:31:44 2016
 
 import textwrap
 import pickle
-import nltk
+import glob
+import os
+import numpy as np
 from gensim import corpora
+from gensim import matutils
+from gensim import utils
 from gensim.models import TfidfModel
+from csrcorpus import CsrCorpus
+from tfidfcorpus import TfidfCorpus, getIdfArray
+from textvec import TOKENIZERS, textsToTfidf
+from titlestore import TitleStore
+from deltaindex import DeltaCorpus
+from invindex import InvertedIndex
+from ranking import makeFilterMask, topN
 
 
 # I lazily made this a global constant so that I wouldn't have to include
@@ -27,12 +38,16 @@ class KeySearch(object):
       1. It has functions for converting new text sources (that is, texts not
          already in the corpus) into tf-idf vectors.
       2. It stores the corpus vocabulary in the form of a gensim dictionary.
-      3. It supports boolean keyword search (though this is NOT indexed!).
+      3. It supports boolean keyword search. Build the inverted index with
+         `buildInvertedIndex` to make this fast; otherwise every document in
+         the corpus is scanned.
       4. It stores the document metadata:
            - Title
            - Text source file
            - Line numbers in source file
            - Tags
+      5. It supports adding, updating, and deleting documents after the
+         corpus has been built (see `addDocuments`).
     
     
     Saving & Loading
@@ -47,7 +62,8 @@ class KeySearch(object):
 
     """
     def __init__(self, dictionary, tfidf_model, corpus_tfidf, titles, 
-                  tagsToDocs={}, docsToTags={}, files=[], doc_line_nums=[]):
+                  tagsToDocs={}, docsToTags={}, files=[], doc_line_nums=[],
+                  inv_index=None, tokenizer='nltk'):
         """
         KeySearch requires a completed gensim corpus, along with some 
         additional metadata
@@ -55,12 +71,19 @@ class KeySearch(object):
         Parameters:
             dictionary - gensim dictionary
             tfidf_model - gensim TfidfModel
-            corpus_tfidf - gensim corpora
-            titles - List of string titles.
+            corpus_tfidf - gensim corpora, or a TfidfCorpus which computes the
+                           tf-idf vectors from a bag-of-words CsrCorpus
+            titles - List of string titles, or a TitleStore.
             tagsToDocs - Mapping of tags to doc ids
             docsToTags - List of tags for each doc
             files - Unique files in the corpus
             doc_line_nums - 
+            inv_index - Optional InvertedIndex over `corpus_tfidf`, for fast
+                        keyword search (see `buildInvertedIndex`).
+            tokenizer - How to split new text into words; this should match
+                        how the corpus was tokenized. 'nltk' uses NLTK's
+                        word_tokenize, and 'wiki' matches gensim's WikiCorpus
+                        (see textvec.py).
         """
         self.dictionary = dictionary
         self.tfidf_model = tfidf_model
@@ -74,6 +97,14 @@ class KeySearch(object):
 
         self.files = files
         self.doc_line_nums = doc_line_nums
+        
+        self.inv_index = inv_index
+        
+        self.tokenizer = tokenizer
+        
+        # Boolean array marking the deleted documents, or None if no 
+        # documents have been deleted since the last compaction.
+        self.tombstones = None
     
     def printTags(self):
         """
@@ -90,10 +121,10 @@ class KeySearch(object):
         for tag in tags:
             print '%20s %3d' % (tag, len(self.tagsToDocs[tag]))       
         
-    def getTfidfForText(self, text):
+    def getBowForText(self, text):
         """
         This function takes new input `text` (not part of the original corpus),
-        and processes it into a tf-idf vector.
+        and processes it into a bag-of-words vector of (word_id, count) tuples.
         
         The input text should be a single string.
         """
@@ -112,8 +143,9 @@ class KeySearch(object):
         # If the string ends in a newline, remove it.
         text = text.replace('\n', ' ')
 
-        # Convert everything to lowercase, then use NLTK to tokenize.
-        tokens = nltk.word_tokenize(text.lower())
+        # Convert everything to lowercase, then tokenize (with NLTK, or the
+        # same way as WikiCorpus).
+        tokens = TOKENIZERS[self.tokenizer](text)
 
         # We don't need to do any special filtering of tokens here (stopwords, 
         # infrequent words, etc.). If a token is not in the dictionary, it is 
@@ -121,11 +153,59 @@ class KeySearch(object):
         # filtering for us.
 
         # Convert the tokenized text into a bag of words representation.
-        bow_vec = self.dictionary.doc2bow(tokens) 
+        return self.dictionary.doc2bow(tokens) 
+        
+    def getTagMask(self, tags):
+        """
+        Return a boolean array with one entry per document, which is True for
+        the documents tagged with any of `tags` (a tag, or a list of tags).
+        
+        The mask can be passed as the `allow` or `deny` filter to the search
+        functions. Build it once and re-use it for multiple searches.
+        """
+        if isinstance(tags, basestring):
+            tags = [tags]
+        
+        mask = np.zeros(len(self.corpus_tfidf), dtype=np.bool_)
+        
+        for tag in tags:
+            mask[list(self.tagsToDocs.get(tag, []))] = True
+            
+        return mask
+    
+    def getTfidfForText(self, text):
+        """
+        This function takes new input `text` (not part of the original corpus),
+        and processes it into a tf-idf vector.
+        
+        The input text should be a single string.
+        """
+        bow_vec = self.getBowForText(text)
         
         # Convert the bag-of-words representation to tf-idf
         return self.tfidf_model[bow_vec]
     
+    def getTfidfForTexts(self, texts, processes=None, chunksize=1000):
+        """
+        Convert a batch of new texts (not part of the original corpus) into
+        tf-idf vectors, all at once. Large batches are split up over a pool
+        of `processes` worker processes, `chunksize` texts at a time (see 
+        textvec.py).
+        
+        Returns a scipy sparse matrix with one row per text, which can be 
+        passed directly to `SimSearch.findSimilarToVectorsBatch`.
+        """
+        try:
+            idfs, normalize = getIdfArray(self.tfidf_model, self.getVocabSize())
+        except ValueError:
+            # Other kinds of tf-idf model are applied one text at a time.
+            vecs = [self.getTfidfForText(text) for text in texts]
+            
+            return matutils.corpus2csc(vecs, num_terms=self.getVocabSize()).T.tocsr()
+        
+        return textsToTfidf(texts, self.dictionary.token2id, idfs, normalize,
+                            self.tokenizer, processes, chunksize)
+    
     def getTfidfForFile(self, filename):
         """
         Convert the text in the provided file to a tf-idf vector.
@@ -146,6 +226,55 @@ class KeySearch(object):
         """        
         return self.corpus_tfidf[doc_id]
 
+    def getTfidfForDocs(self, doc_ids):
+        """
+        Return the tf-idf vectors for the specified documents as a scipy 
+        sparse matrix, with one row per document.
+        
+        With a CsrCorpus, the rows are gathered directly from the 
+        memory-mapped arrays.
+        """
+        if hasattr(self.corpus_tfidf, 'getRows'):
+            return self.corpus_tfidf.getRows(doc_ids)
+        
+        # Otherwise, look up the documents one at a time.
+        vecs = [self.corpus_tfidf[doc_id] for doc_id in doc_ids]
+        
+        return matutils.corpus2csc(vecs, num_terms=self.getVocabSize()).T.tocsr()
+
+    def buildInvertedIndex(self, corpus_bow=None):
+        """
+        Build the inverted index (word id -> sorted list of doc ids) over the
+        tf-idf corpus, so that `keywordSearch` doesn't have to scan every
+        document. The index is stored by `save`.
+        
+        For ranked search (`rankedKeywordSearch`), the index also needs the 
+        number of times each word occurs in each document. If the tf-idf 
+        model isn't normalized, these are recovered from the tf-idf weights.
+        Otherwise, supply the bag-of-words corpus as `corpus_bow`.
+        
+        After documents have been added or deleted, the index covers just
+        the original corpus (see `addDocuments`).
+        """
+        corpus_tfidf = self.corpus_tfidf
+        if isinstance(corpus_tfidf, DeltaCorpus):
+            corpus_tfidf = corpus_tfidf.base
+        
+        if corpus_bow is not None:
+            self.inv_index = InvertedIndex(corpus_bow, self.getVocabSize(), 
+                                           store_counts=True)
+        
+        elif self.tfidf_model.normalize in (False, utils.identity):
+            # The tf-idf weights are just count x idf.
+            idfs = np.zeros(self.getVocabSize())
+            for (word_id, idf) in self.tfidf_model.idfs.items():
+                idfs[word_id] = idf
+        
+            self.inv_index = InvertedIndex(corpus_tfidf, self.getVocabSize(), 
+                                           store_counts=True, idfs=idfs)
+        else:
+            self.inv_index = InvertedIndex(corpus_tfidf, self.getVocabSize())
+
     def keywordSearch(self, includes=[], excludes=[], docs=[]):
         """
         Performs a boolean keyword search over the corpus.
@@ -161,12 +290,14 @@ class KeySearch(object):
             docs        The list of documents to search in, represented by
                         by doc_ids. If this list is empty, the entire corpus
                         is searched.
+                        
+        If the inverted index has been built, the search is answered by
+        intersecting the doc id lists for each of the words. Otherwise, every
+        document is checked.
+        
+        Returns a list of the matching doc ids.
         """
         
-        # If no doc ids were supplied, search the entire corpus.
-        if not docs:
-            docs = range(0, len(self.corpus_tfidf))
-    
         # Convert all the keywords to their IDs.
         # Force them to lower case in the process.
         include_ids = []
@@ -187,6 +318,64 @@ class KeySearch(object):
         for word in excludes:
             exclude_ids.append(self.getIDForWord(word.lower()))
         
+        # Use the inverted index, if we have one.
+        if self.inv_index is not None:
+            if not docs:
+                docs = None
+                
+            results = self._searchInvertedIndex(include_ids, exclude_ids, docs)
+        else:
+            # If no doc ids were supplied, search the entire corpus.
+            if not docs:
+                docs = range(0, len(self.corpus_tfidf))
+            
+            results = self._scanDocs(docs, include_ids, exclude_ids)
+        
+        # Leave out any deleted documents.
+        if self.tombstones is not None:
+            results = [doc_id for doc_id in results if not self.tombstones[doc_id]]
+        
+        return results
+    
+    def _searchInvertedIndex(self, include_ids, exclude_ids, docs=None):
+        """
+        Internal function which answers a keyword search with the inverted 
+        index. Returns a list of the matching doc ids.
+        """
+        corpus = self.corpus_tfidf
+        
+        if not isinstance(corpus, DeltaCorpus):
+            return self.inv_index.search(include_ids, exclude_ids, docs).tolist()
+        
+        # The inverted index only covers the documents in the base corpus,
+        # by their rows in it. The documents added since are scanned.
+        if docs is None:
+            base_ids = corpus.toDocIds(self.inv_index.search(include_ids, exclude_ids))
+            
+            delta_ids = corpus.toDocIds(np.arange(corpus.num_base, corpus.num_base + len(corpus.delta)))
+            delta_ids = delta_ids[delta_ids >= 0].tolist()
+            
+            results = np.concatenate((base_ids[base_ids >= 0], 
+                                      self._scanDocs(delta_ids, include_ids, exclude_ids)))
+            
+            return np.sort(results).astype(np.int64).tolist()
+        
+        # Otherwise, return the matches in the order they were given.
+        docs = np.asarray(docs, dtype=np.int64)
+        rows = corpus.toRows(docs)
+        in_base = rows < corpus.num_base
+        
+        matched = np.zeros(len(docs), dtype=np.bool_)
+        matched[in_base] = np.in1d(rows[in_base], self.inv_index.search(include_ids, exclude_ids, rows[in_base]))
+        matched[~in_base] = np.in1d(docs[~in_base], self._scanDocs(docs[~in_base].tolist(), include_ids, exclude_ids))
+        
+        return docs[matched].tolist()
+    
+    def _scanDocs(self, docs, include_ids, exclude_ids):
+        """
+        Internal function which performs a keyword search by checking each
+        of the documents `docs`. Returns a list of the matching doc ids.
+        """
         results = []
     
         # For each of the documents to search...
@@ -223,6 +412,261 @@ class KeySearch(object):
         return results
             
     
+    def rankedKeywordSearch(self, text, topn=10, k1=1.2, b=0.75, allow=None,
+                            deny=None):
+        """
+        Performs a ranked keyword search over the corpus, scoring the 
+        documents against the words in `text` using BM25. 
+        
+        Requires the inverted index, built with the term counts (see 
+        `buildInvertedIndex`).
+        
+        Parameters:
+            text    The query, as a single string.
+            topn    The number of results to return.
+            k1, b   The BM25 parameters. `k1` controls how quickly repeated
+                    occurrences of a word stop adding to the score, and `b`
+                    how much the score is normalized by document length.
+            allow   Optional list of doc ids (or boolean mask, see 
+                    `getTagMask`) to restrict the search to.
+            deny    Optional list of doc ids (or boolean mask) to leave out.
+        
+        Documents added with `addDocuments` aren't in the inverted index. 
+        They're ranked if they were added with their bag-of-words vectors, 
+        using the word statistics of the original documents; otherwise 
+        they're left out until the corpus is rebuilt.
+        
+        Returns a list of tuples in the form:
+            (doc_id, score)
+        """
+        if self.inv_index is None or self.inv_index.counts is None:
+            raise ValueError('Ranked search requires the inverted index with '
+                             'term counts; see `buildInvertedIndex`.')
+        
+        corpus = self.corpus_tfidf
+        
+        if not isinstance(corpus, DeltaCorpus):
+            mask = makeFilterMask(len(self.inv_index), allow, 
+                                  self.addDeletedToDeny(deny))
+        
+            return self.inv_index.rankBM25(self.getBowForText(text), topn, k1, 
+                                           b, mask)
+        
+        # The inverted index only covers the documents in the base corpus, by
+        # their rows in it. Translate the filter to the rows of the base 
+        # corpus.
+        mask = makeFilterMask(len(corpus), allow, self.addDeletedToDeny(deny))
+        
+        if mask is None:
+            doc_ids = np.arange(len(corpus))
+        else:
+            doc_ids = np.flatnonzero(mask)
+        
+        rows = corpus.toRows(doc_ids)
+        
+        row_mask = np.zeros(corpus.num_base, dtype=np.bool_)
+        row_mask[rows[rows < corpus.num_base]] = True
+        
+        query_bow = self.getBowForText(text)
+        
+        results = self.inv_index.rankBM25(query_bow, topn, k1, b, row_mask)
+        
+        results = [(int(corpus.toDocIds(row)), score) for (row, score) in results]
+        
+        # Score the added documents which have their word counts, and merge
+        # them into the results.
+        delta_ids = [doc_id for doc_id in doc_ids[rows >= corpus.num_base].tolist()
+                     if corpus.getBow(doc_id) is not None]
+        
+        if len(delta_ids) == 0:
+            return results
+        
+        scores = self.inv_index.scoreBM25(query_bow, [corpus.getBow(doc_id) for doc_id in delta_ids], 
+                                          k1, b)
+        
+        doc_ids = [doc_id for (doc_id, score) in results] + delta_ids
+        scores = np.concatenate(([score for (doc_id, score) in results], scores))
+        
+        return [(doc_id, score) for (doc_id, score) in topN(scores, topn, doc_ids=doc_ids)
+                if score > 0]
+    
+    def addDocuments(self, vecs_tfidf, titles, tags=None, line_nums=None,
+                     vecs_bow=None):
+        """
+        Add new documents to the corpus, without rebuilding it. The documents
+        are given the next doc ids after the end of the corpus.
+        
+        The new vectors are kept in a "delta" segment (see deltaindex.py),
+        which `save` writes out next to the original corpus. Use 
+        `SimSearch.addDocuments` to add them to the LSI index as well.
+        
+        Parameters:
+            vecs_tfidf  List of tf-idf vectors (see `getTfidfForText`).
+            titles      The title of each document, in the same form as the
+                        existing titles.
+            tags        Optional list of tags for each document.
+            line_nums   Optional location of each document in its source 
+                        file, in the same form as `doc_line_nums`.
+            vecs_bow    Optional list of bag-of-words vectors (see 
+                        `getBowForText`). The word counts are needed to rank
+                        the documents in `rankedKeywordSearch`.
+                        
+        Returns the doc ids of the new documents.
+        """
+        if not isinstance(self.corpus_tfidf, DeltaCorpus):
+            self.corpus_tfidf = DeltaCorpus(self.corpus_tfidf, self.getVocabSize())
+        
+        num_docs = len(self.corpus_tfidf)
+        
+        doc_ids = self.corpus_tfidf.append(vecs_tfidf, vecs_bow)
+        
+        # The titles are either a list (or a TitleStore, which can be added
+        # to the same way), or a dictionary of doc id to (pageid, title).
+        if isinstance(self.titles, dict):
+            self.titles.update(zip(doc_ids, titles))
+        else:
+            self.titles.extend(titles)
+        
+        if tags is None:
+            tags = [[] for doc_id in doc_ids]
+        
+        for (doc_id, doc_tags) in zip(doc_ids, tags):
+            for tag in doc_tags:
+                self.tagsToDocs.setdefault(tag, []).append(doc_id)
+            
+            if isinstance(self.docsToTags, dict):
+                if len(doc_tags) > 0:
+                    self.docsToTags[doc_id] = doc_tags
+            else:
+                self.docsToTags.append(doc_tags)
+        
+        # Only keep up the line numbers if there are line numbers for the
+        # existing documents.
+        if line_nums is not None:
+            self.doc_line_nums.extend(line_nums)
+        elif num_docs > 0 and len(self.doc_line_nums) == num_docs:
+            self.doc_line_nums.extend([None] * len(doc_ids))
+        
+        if self.tombstones is not None:
+            self.tombstones = np.concatenate((self.tombstones, 
+                                              np.zeros(len(doc_ids), dtype=np.bool_)))
+        
+        return doc_ids
+    
+    def deleteDocuments(self, doc_ids):
+        """
+        Delete the documents `doc_ids`. They're marked as deleted (with a 
+        "tombstone") and left out of all search results, but keep their doc
+        ids until `compact` is called.
+        """
+        if self.tombstones is None:
+            self.tombstones = np.zeros(len(self.corpus_tfidf), dtype=np.bool_)
+        
+        self.tombstones[np.asarray(doc_ids, dtype=np.int64)] = True
+    
+    def updateDocument(self, doc_id, vec_tfidf, title=None, tags=None,
+                       line_nums=None, vec_bow=None):
+        """
+        Replace the document `doc_id` with a new version, given by its tf-idf
+        vector (and optionally its bag-of-words vector, see `addDocuments`).
+        The old version is deleted, and the new version is added to the end
+        of the corpus, so it gets a new doc id. 
+        
+        The title, tags, and line numbers are carried over from the old 
+        version unless new ones are given.
+        
+        Returns the doc id of the new version.
+        """
+        if title is None:
+            title = self.titles[doc_id]
+        
+        if tags is None:
+            if isinstance(self.docsToTags, dict):
+                tags = self.docsToTags.get(doc_id, [])
+            elif doc_id < len(self.docsToTags):
+                tags = self.docsToTags[doc_id]
+            else:
+                tags = []
+        
+        if line_nums is None and doc_id < len(self.doc_line_nums):
+            line_nums = self.doc_line_nums[doc_id]
+        
+        self.deleteDocuments([doc_id])
+        
+        return self.addDocuments([vec_tfidf], [title], [tags], 
+                                 None if line_nums is None else [line_nums],
+                                 None if vec_bow is None else [vec_bow])[0]
+    
+    def addDeletedToDeny(self, deny=None):
+        """
+        Add the deleted documents to the `deny` filter (doc ids or a boolean
+        mask) used by the search functions.
+        
+        Returns the combined filter, as a boolean mask over the corpus (or 
+        `deny` unchanged, if no documents have been deleted).
+        """
+        if self.tombstones is None or not self.tombstones.any():
+            return deny
+        
+        mask = self.tombstones.copy()
+        
+        if deny is not None:
+            mask |= ~makeFilterMask(len(mask), None, deny)
+        
+        return mask
+    
+    def compact(self):
+        """
+        Remove the deleted documents from the corpus and the document 
+        metadata, and re-number the remaining documents to fill the gaps. 
+        
+        The rows of the deleted documents in the stored corpus and inverted
+        index aren't reclaimed until the corpus is rebuilt; they're just no
+        longer reachable.
+        
+        Returns an array which maps each old doc id to its new doc id, or -1
+        for the deleted documents.
+        """
+        num_docs = len(self.corpus_tfidf)
+        
+        if self.tombstones is None:
+            keep = np.ones(num_docs, dtype=np.bool_)
+        else:
+            keep = ~self.tombstones
+        
+        remap = np.full(num_docs, -1, dtype=np.int64)
+        remap[keep] = np.arange(np.count_nonzero(keep))
+        
+        if not isinstance(self.corpus_tfidf, DeltaCorpus):
+            self.corpus_tfidf = DeltaCorpus(self.corpus_tfidf, self.getVocabSize())
+        
+        self.corpus_tfidf.compact(keep)
+        
+        # Re-number the metadata.
+        def compactTable(table):
+            if isinstance(table, TitleStore):
+                return table.compact(keep)
+            
+            if isinstance(table, dict):
+                return dict([(int(remap[doc_id]), value) for (doc_id, value) 
+                             in table.items() if doc_id < num_docs and keep[doc_id]])
+            
+            if len(table) != num_docs:
+                return table
+            
+            return [value for (doc_id, value) in enumerate(table) if keep[doc_id]]
+        
+        self.titles = compactTable(self.titles)
+        self.docsToTags = compactTable(self.docsToTags)
+        self.doc_line_nums = compactTable(self.doc_line_nums)
+        
+        self.tagsToDocs = dict([(tag, [int(remap[doc_id]) for doc_id in doc_ids if keep[doc_id]])
+                                for (tag, doc_ids) in self.tagsToDocs.items()])
+        
+        self.tombstones = None
+        
+        return remap
+    
     def printTopNWords(self, topn=10):
         """
         Print the 'topn' most frequent words in the corpus.
@@ -262,12 +706,8 @@ class KeySearch(object):
         # All words in dictionary are lower case.
         input_word = input_word.lower()
         
-        # First check if the word exists in the dictionary.
-        if not input_word in self.dictionary.values():
-            return -1            
-        # If it is, look up the ID.    
-        else:
-            return self.dictionary.token2id[input_word]
+        # Look up the ID in the dictionary's map of word -> ID.
+        return self.dictionary.token2id.get(input_word, -1)
                
     def getDocLocation(self, doc_id):
         """
@@ -345,24 +785,86 @@ class KeySearch(object):
         # Store the tag tables.
         pickle.dump((self.tagsToDocs, self.docsToTags), open(save_dir + 'tag-tables.pickle', 'wb'))
         
-        # Store the document titles.
-        pickle.dump(self.titles, open(save_dir + 'titles.pickle', 'wb'))
+        # Store the document titles. A TitleStore is written out in its own
+        # format (unless that's where it was loaded from, unchanged).
+        if isinstance(self.titles, TitleStore):
+            if self.titles.fname != save_dir + 'titles.store' or self.titles.isModified():
+                self.titles = TitleStore.serialize(save_dir + 'titles.store', self.titles,
+                                                   self.titles.getPageIds())
+            
+            if os.path.exists(save_dir + 'titles.pickle'):
+                os.remove(save_dir + 'titles.pickle')
+        else:
+            pickle.dump(self.titles, open(save_dir + 'titles.pickle', 'wb'))
+            
+            # A title store from an earlier save would take precedence in 
+            # `load`.
+            for ext in ['', '.blob', '.offsets', '.pageids', '.sorted']:
+                if os.path.exists(save_dir + 'titles.store' + ext):
+                    os.remove(save_dir + 'titles.store' + ext)
         
         # Write out the tfidf model.
         self.tfidf_model.save(save_dir + 'documents.tfidf_model')
         
-        # Write out the tfidf corpus.
-        corpora.MmCorpus.serialize(save_dir + 'documents_tfidf.mm', self.corpus_tfidf)  
+        # If documents have been added or deleted, the original corpus is
+        # wrapped in a DeltaCorpus. The original corpus is written out as
+        # usual, and the changes on top of it are saved separately.
+        if isinstance(self.corpus_tfidf, DeltaCorpus):
+            corpus_tfidf = self.corpus_tfidf.base
+        else:
+            corpus_tfidf = self.corpus_tfidf
+        
+        # If the tfidf corpus is computed on the fly from a bag-of-words 
+        # corpus, just write out the bag-of-words vectors.
+        # Otherwise, write out the tfidf corpus itself. Both are stored in the
+        # binary CSR format which supports fast random access. (Unless that's
+        # where the corpus was loaded from!)
+        if isinstance(corpus_tfidf, TfidfCorpus):
+            corpus_bow = corpus_tfidf.corpus_bow
+            
+            if getattr(corpus_bow, 'fname', None) != save_dir + 'documents_bow.csr':
+                CsrCorpus.serializeChunks(save_dir + 'documents_bow.csr', corpus_bow.iterChunks(),
+                                          num_terms=self.getVocabSize())
+        
+        elif getattr(corpus_tfidf, 'fname', None) != save_dir + 'documents_tfidf.csr':
+            CsrCorpus.serialize(save_dir + 'documents_tfidf.csr', corpus_tfidf,
+                                num_terms=self.getVocabSize())  
+        
+        # Save the added documents and the doc id maps. (Remove any left over
+        # from an earlier save.)
+        for fname in glob.glob(save_dir + 'documents.delta*'):
+            os.remove(fname)
+        
+        if isinstance(self.corpus_tfidf, DeltaCorpus):
+            self.corpus_tfidf.save(save_dir + 'documents.delta')
 
         # Write out the dictionary.
         self.dictionary.save(save_dir + 'documents.dict')
         
+        # Write out the inverted index, if it's been built. It only covers 
+        # the original corpus, so it doesn't change when documents are added.
+        # (Its postings may be memory-mapped from the file, so it mustn't be
+        # written over itself.)
+        if self.inv_index is not None and \
+                getattr(self.inv_index, 'fname', None) != save_dir + 'documents.invindex':
+            self.inv_index.save(save_dir + 'documents.invindex', sep_limit=0)
+        
         # Save the filenames.
         pickle.dump(self.files, open(save_dir + 'files.pickle', 'wb'))
         
         # Save the file ID and line numbers for each document.
         pickle.dump(self.doc_line_nums, open(save_dir + 'doc_line_nums.pickle', 'wb'))
         
+        # Save which tokenizer to use for new text.
+        pickle.dump(self.tokenizer, open(save_dir + 'tokenizer.pickle', 'wb'))
+        
+        # Save the deleted documents, if there are any. (Remove any left over
+        # from an earlier save.)
+        if self.tombstones is not None:
+            pickle.dump(self.tombstones, open(save_dir + 'tombstones.pickle', 'wb'))
+        elif os.path.exists(save_dir + 'tombstones.pickle'):
+            os.remove(save_dir + 'tombstones.pickle')
+        
         # Objects that are not saved:
         #  - stop_list - You don't need to filter stop words for new input
         #                text, they simply aren't found in the dictionary.
@@ -378,16 +880,48 @@ class KeySearch(object):
         tables = pickle.load(open(save_dir + 'tag-tables.pickle', 'rb'))
         tagsToDocs = tables[0]
         docsToTags = tables[1]        
-        titles = pickle.load(open(save_dir + 'titles.pickle', 'rb'))
+        
+        if os.path.exists(save_dir + 'titles.store'):
+            titles = TitleStore(save_dir + 'titles.store')
+        else:
+            titles = pickle.load(open(save_dir + 'titles.pickle', 'rb'))
+        
         tfidf_model = TfidfModel.load(fname=save_dir + 'documents.tfidf_model')
-        corpus_tfidf = corpora.MmCorpus(save_dir + 'documents_tfidf.mm')
+        
+        # The tfidf corpus is either computed from the bag-of-words vectors, or
+        # stored directly. Older saves stored it in Matrix Market format.
+        if os.path.exists(save_dir + 'documents_bow.csr'):
+            corpus_tfidf = TfidfCorpus(CsrCorpus(save_dir + 'documents_bow.csr'), tfidf_model)
+        elif os.path.exists(save_dir + 'documents_tfidf.csr'):
+            corpus_tfidf = CsrCorpus(save_dir + 'documents_tfidf.csr')
+        else:
+            corpus_tfidf = corpora.MmCorpus(save_dir + 'documents_tfidf.mm')
+        
+        # Apply any documents added or deleted since the corpus was built.
+        if os.path.exists(save_dir + 'documents.delta'):
+            corpus_tfidf = DeltaCorpus.load(save_dir + 'documents.delta', corpus_tfidf)
+            
         dictionary = corpora.Dictionary.load(fname=save_dir + 'documents.dict')
         files = pickle.load(open(save_dir + 'files.pickle', 'rb'))
         doc_line_nums = pickle.load(open(save_dir + 'doc_line_nums.pickle', 'rb'))
         
+        # The inverted index is optional. Its postings are memory-mapped.
+        if os.path.exists(save_dir + 'documents.invindex'):
+            inv_index = InvertedIndex.load(save_dir + 'documents.invindex', mmap='r')
+            inv_index.fname = save_dir + 'documents.invindex'
+        else:
+            inv_index = None
+        
         ksearch = KeySearch(dictionary, tfidf_model, 
                             corpus_tfidf, titles, tagsToDocs,
-                            docsToTags, files, doc_line_nums) 
+                            docsToTags, files, doc_line_nums, inv_index) 
+        
+        # Older saves always used NLTK.
+        if os.path.exists(save_dir + 'tokenizer.pickle'):
+            ksearch.tokenizer = pickle.load(open(save_dir + 'tokenizer.pickle', 'rb'))
+        
+        if os.path.exists(save_dir + 'tombstones.pickle'):
+            ksearch.tombstones = pickle.load(open(save_dir + 'tombstones.pickle', 'rb'))
         
         return ksearch
             
\ No newline at end of file
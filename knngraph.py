@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+A precomputed table of the most similar documents to every document in the
+corpus (the "k-nearest-neighbour graph").
+
+"Find articles similar to article X" is the most common search, and its
+answer only changes when the LSI index is rebuilt. `findSimilarToDoc`
+answers it by scoring the document against all ~4.2M rows of the index.
+
+`buildKnnGraph` instead finds the top `k` neighbours of every document ahead
+of time, as an offline job. The documents are scored against each other with
+blocked matrix-matrix products (see `blockedTopN` in ranking.py), one chunk
+of query documents per task, spread across a pool of worker processes. The
+results are written straight into memory-mapped arrays on disk:
+    ids     - (int32)    [num_docs x k] The neighbours of each document, most
+                         similar first. Padded with -1 if there are fewer
+                         than k other documents.
+    scores  - (float16)  [num_docs x k] Their similarity values.
+
+The job checkpoints the chunks it has finished, so if it's interrupted it
+picks up where it left off. Once the graph is built, a lookup is just a row
+of each array.
+"""
+
+from gensim import utils
+from ranking import blockedTopN
+import multiprocessing
+import numpy as np
+import logging
+import shutil
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# The state shared with the worker processes. It's set before the pool is
+# created, so the workers inherit it (including the memory-mapped index
+# vectors) when they're forked.
+_graph_state = {}
+
+
+def _getBlock(vectors, start, end):
+    """
+    Internal function which returns the LSI vectors for documents `start`
+    through `end - 1`, from an array or from an index with `getVectors`.
+    """
+    if isinstance(vectors, np.ndarray):
+        return vectors[start:end]
+
+    return vectors.getVectors(np.arange(start, end))
+
+
+def _buildChunk(start):
+    """
+    Worker function which finds the neighbours of the documents in the chunk
+    beginning at `start`, and writes them into the graph's arrays.
+    """
+    vectors = _graph_state['vectors']
+    num_docs = _graph_state['num_docs']
+    k = _graph_state['k']
+    fname = _graph_state['fname']
+
+    end = min(start + _graph_state['chunksize'], num_docs)
+
+    def scoreBlock(query_vecs, block_start, block_end):
+        return np.dot(query_vecs, _getBlock(vectors, block_start, block_end).T)
+
+    # Each document is left out of its own neighbours.
+    results = blockedTopN(scoreBlock, num_docs, _getBlock(vectors, start, end),
+                          k, query_ids=np.arange(start, end),
+                          block_size=_graph_state['block_size'])
+
+    ids = np.memmap(fname + '.ids', dtype=np.int32, mode='r+', shape=(num_docs, k))
+    scores = np.memmap(fname + '.scores', dtype=np.float16, mode='r+', shape=(num_docs, k))
+
+    for (i, result) in enumerate(results):
+        ids[start + i, 0:len(result)] = [doc_id for (doc_id, sim) in result]
+        scores[start + i, 0:len(result)] = [sim for (doc_id, sim) in result]
+
+    ids.flush()
+    scores.flush()
+    del ids, scores
+
+    return start
+
+
+def buildKnnGraph(vectors, fname, k=100, processes=None, chunksize=4096,
+                  block_size=32768, resume=True):
+    """
+    Find the `k` most similar documents to every document, and write them out
+    to `fname`.
+
+    Parameters:
+        vectors     The normalized LSI vectors, as an array (e.g., the
+                    `index` of a MatrixSimilarity, memory-mapped), or an
+                    index with `getVectors` (e.g., a ShardedIndex).
+        k           The number of neighbours to keep for each document.
+        processes   The number of worker processes. Defaults to the number
+                    of cores.
+        chunksize   The number of documents per task. Each task scores its
+                    documents against the whole index, `block_size`
+                    documents at a time.
+
+    The finished chunks are recorded in [fname].checkpoint, so if the job is
+    interrupted, calling this again with the same parameters continues from
+    there. Pass resume=False to start over (e.g., if the index has changed
+    since).
+
+    Returns the KnnGraph.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    num_docs = len(vectors)
+    k = min(k, max(num_docs - 1, 1))
+
+    checkpoint_fname = fname + '.checkpoint'
+
+    # The header is written last, so it's only present for a complete graph.
+    if os.path.exists(fname):
+        os.remove(fname)
+
+    params = {'num_docs': num_docs, 'k': k, 'chunksize': chunksize}
+
+    if resume and os.path.exists(checkpoint_fname) and utils.unpickle(checkpoint_fname)['params'] == params:
+        done = utils.unpickle(checkpoint_fname)['done']
+
+        logger.info('resuming the k-NN graph with %d chunks done', len(done))
+    else:
+        done = set()
+
+        # Allocate the arrays, with every neighbour missing to start.
+        np.memmap(fname + '.ids', dtype=np.int32, mode='w+', shape=(num_docs, k))[:] = -1
+        np.memmap(fname + '.scores', dtype=np.float16, mode='w+', shape=(num_docs, k))[:] = 0
+
+    num_chunks = len(range(0, num_docs, chunksize))
+    chunk_starts = [start for start in range(0, num_docs, chunksize) if start not in done]
+
+    logger.info('finding the %d nearest neighbours of %d documents (%d chunks left) with %d processes',
+                k, num_docs, len(chunk_starts), processes)
+
+    _graph_state.update({'vectors': vectors, 'num_docs': num_docs, 'k': k,
+                         'fname': fname, 'chunksize': chunksize,
+                         'block_size': block_size})
+
+    t0 = time.time()
+    num_done = 0
+
+    pool = multiprocessing.Pool(max(1, min(processes, len(chunk_starts))))
+    try:
+        for start in pool.imap_unordered(_buildChunk, chunk_starts):
+            # Record the checkpoint once the chunk is safely written.
+            done.add(start)
+            utils.pickle({'params': params, 'done': done}, checkpoint_fname + '.tmp')
+            os.rename(checkpoint_fname + '.tmp', checkpoint_fname)
+
+            num_done += min(chunksize, num_docs - start)
+            elapsed = time.time() - t0
+
+            logger.info('PROGRESS: found neighbours for %d more documents, %d of %d chunks done (%.0f docs/sec)',
+                        num_done, len(done), num_chunks, num_done / max(elapsed, 1e-6))
+    finally:
+        pool.terminate()
+        _graph_state.clear()
+
+    utils.pickle({'num_docs': num_docs, 'k': k}, fname)
+
+    if os.path.exists(checkpoint_fname):
+        os.remove(checkpoint_fname)
+
+    logger.info('built the k-NN graph in %.1f seconds', time.time() - t0)
+
+    return KnnGraph(fname)
+
+
+class KnnGraph(object):
+    """
+    The precomputed neighbours of every document. Use `buildKnnGraph` to
+    build one, then `KnnGraph(fname)` to open it.
+
+    The files are:
+        [fname]         - Pickled header (sizes).
+        [fname].ids     - Raw int32 [num_docs x k] array.
+        [fname].scores  - Raw float16 [num_docs x k] array.
+    """
+
+    def __init__(self, fname, mmap='r'):
+        """
+        Open the graph saved at `fname`. By default, the arrays are
+        memory-mapped read-only; pass mmap=None to read them into memory.
+        """
+        self.fname = fname
+
+        header = utils.unpickle(fname)
+
+        self.num_docs = header['num_docs']
+        self.k = header['k']
+
+        shape = (self.num_docs, self.k)
+
+        if mmap is None:
+            self.ids = np.fromfile(fname + '.ids', dtype=np.int32).reshape(shape)
+            self.scores = np.fromfile(fname + '.scores', dtype=np.float16).reshape(shape)
+        else:
+            self.ids = np.memmap(fname + '.ids', dtype=np.int32, mode=mmap, shape=shape)
+            self.scores = np.memmap(fname + '.scores', dtype=np.float16, mode=mmap, shape=shape)
+
+    def __len__(self):
+        return self.num_docs
+
+    def save(self, fname):
+        """
+        Copy the graph's files to `fname`, header last. Does nothing if the
+        graph is already stored there.
+
+        Returns the KnnGraph stored at `fname`.
+        """
+        if os.path.abspath(fname) == os.path.abspath(self.fname):
+            return self
+
+        for ext in ['.ids', '.scores', '']:
+            shutil.copyfile(self.fname + ext, fname + ext)
+
+        return KnnGraph(fname)
+
+    def getNeighbors(self, doc_id, topn=10, mask=None):
+        """
+        Look up the `topn` most similar documents to `doc_id`.
+
+        `mask` is an optional boolean array over all of the documents; only
+        the documents marked True are returned. (So with a mask, there may be
+        fewer than `topn` results.)
+
+        Returns the results as a list of tuples in the form:
+            (doc_id, similarity_value)
+        """
+        ids = np.asarray(self.ids[doc_id])
+        scores = np.asarray(self.scores[doc_id], dtype=np.float32)
+
+        keep = ids >= 0
+        if mask is not None:
+            keep[keep] = mask[ids[keep]]
+
+        ids = ids[keep][0:topn]
+        scores = scores[keep][0:topn]
+
+        return list(zip(ids.astype(np.int64).tolist(), scores.tolist()))
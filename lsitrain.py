@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Trains an LSI model with randomized SVD, using multiple processes.
+
+gensim's LsiModel processes the corpus one chunk at a time in a single
+process, merging the decomposition of each chunk into the running result.
+For Wikipedia, that took over two hours.
+
+`trainLsi` instead computes the truncated SVD of the whole term-document
+matrix directly, using the randomized algorithm of Halko, Martinsson, and
+Tropp ("Finding structure with randomness", 2011):
+
+  1. Multiply the matrix by a random matrix, to sample its range:
+         Y = A * Omega
+  2. Refine the sample with `power_iters` power iterations, which sharpens
+     the separation of the top singular vectors from the rest:
+         Q = orth(Y),  Y = A * (A^T * Q)
+  3. Project the matrix onto the sampled range, and take the SVD of that
+     small matrix:
+         Q = orth(Y),  B * B^T = (Q^T * A) * (Q^T * A)^T = U_b * S^2 * U_b^T
+         U = Q * U_b
+
+Each of these is a pass over the corpus made of sparse x dense matrix
+products, one chunk of documents at a time. The chunks are read straight out
+of the binary CSR files (see csrcorpus.py and tfidfcorpus.py), and divided up
+among a pool of worker processes, each of which sums the products for its
+share of the chunks.
+
+The result is stored as a regular gensim LsiModel, so it's saved, loaded,
+and used exactly the same way.
+"""
+
+from gensim.models import LsiModel
+from gensim import matutils
+from scipy import sparse
+import multiprocessing
+import numpy as np
+import tempfile
+import logging
+import shutil
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# The state shared with the worker processes for the current pass. It's set
+# before the pool is created, so the workers inherit it when they're forked.
+_pass_state = {}
+
+
+def _getChunk(corpus, start, end):
+    """
+    Internal function which returns documents `start` through `end - 1` of
+    `corpus` (a CsrCorpus, TfidfCorpus, or scipy sparse matrix) as a CSR
+    matrix.
+    """
+    if sparse.issparse(corpus):
+        return corpus[start:end]
+
+    return corpus.getChunk(start, end)
+
+
+def _runPassWorker(args):
+    """
+    Worker function which performs one pass over its share of the chunks,
+    `args` = (worker_num, chunk_starts).
+
+    For the first pass, the sum is A * Omega; for the power iterations,
+    A * (A^T * Q); and for the final pass, (Q^T * A) * (Q^T * A)^T. The sum
+    is written out to a temporary file, whose name is returned.
+    """
+    worker_num, chunk_starts = args
+
+    corpus = _pass_state['corpus']
+    Q = _pass_state['Q']
+    kind = _pass_state['kind']
+    num_samples = _pass_state['num_samples']
+    chunksize = _pass_state['chunksize']
+
+    total = None
+
+    for start in chunk_starts:
+        # The corpus is stored as [docs x terms], so each chunk is A^T for
+        # its documents.
+        chunk = _getChunk(corpus, start, start + chunksize).astype(np.float64)
+
+        if kind == 'range':
+            # Each chunk gets its own random matrix, seeded by its position,
+            # so the result doesn't depend on how the chunks are divided up.
+            omega = np.random.RandomState(_pass_state['seed'] + start).normal(
+                size=(chunk.shape[0], num_samples))
+            part = chunk.T.dot(omega)
+
+        elif kind == 'power':
+            part = chunk.T.dot(chunk.dot(Q))
+
+        else:
+            projected = chunk.dot(Q)
+            part = projected.T.dot(projected)
+
+        if total is None:
+            total = part
+        else:
+            total += part
+
+    fname = os.path.join(_pass_state['temp_dir'], 'pass_%d.npy' % worker_num)
+    np.save(fname, total)
+
+    return fname
+
+
+def _runPass(corpus, kind, Q, num_samples, chunksize, processes, seed, temp_dir):
+    """
+    Internal function which performs one pass over the corpus on a pool of
+    `processes` workers, and returns the sum of their results.
+    """
+    num_docs = corpus.shape[0] if sparse.issparse(corpus) else len(corpus)
+
+    # Deal the chunks out to the workers in turn.
+    chunk_starts = list(range(0, num_docs, chunksize))
+    processes = max(1, min(processes, len(chunk_starts)))
+    tasks = [(i, chunk_starts[i::processes]) for i in range(0, processes)]
+
+    _pass_state.update({'corpus': corpus, 'kind': kind, 'Q': Q,
+                        'num_samples': num_samples, 'chunksize': chunksize,
+                        'seed': seed, 'temp_dir': temp_dir})
+
+    t0 = time.time()
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        total = None
+        for fname in pool.imap_unordered(_runPassWorker, tasks):
+            part = np.load(fname)
+            os.remove(fname)
+
+            if total is None:
+                total = part
+            else:
+                total += part
+    finally:
+        pool.terminate()
+        _pass_state.clear()
+
+    elapsed = time.time() - t0
+    logger.info('%s pass over %d documents took %.1f seconds (%.0f docs/sec)',
+                kind, num_docs, elapsed, num_docs / max(elapsed, 1e-6))
+
+    return total
+
+
+def trainLsi(corpus, num_topics, id2word, power_iters=2, extra_samples=100,
+             chunksize=20000, processes=None, seed=0):
+    """
+    Train an LSI model on `corpus` using randomized SVD.
+
+    Parameters:
+        corpus         The tf-idf vectors, as a CsrCorpus or TfidfCorpus (or
+                       a scipy sparse [num_docs x num_terms] matrix).
+        num_topics     The number of LSI topics.
+        id2word        The dictionary.
+        power_iters    The number of power iterations. More iterations give
+                       a more accurate result, at the cost of one more pass
+                       over the corpus each.
+        extra_samples  The number of extra random vectors to sample beyond
+                       `num_topics`, which also improves accuracy.
+        chunksize      The number of documents to read at a time.
+        processes      The number of worker processes. Defaults to the
+                       number of cores.
+        seed           Seed for the random matrix.
+
+    Returns a gensim LsiModel.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    num_docs = corpus.shape[0] if sparse.issparse(corpus) else len(corpus)
+    num_samples = num_topics + extra_samples
+
+    logger.info('training LSI with %d topics on %d documents using randomized SVD '
+                '(%d samples, %d power iterations, %d processes)',
+                num_topics, num_docs, num_samples, power_iters, processes)
+
+    t0 = time.time()
+
+    # The workers hand back their results through temporary files.
+    temp_dir = tempfile.mkdtemp(prefix='lsitrain')
+
+    try:
+        # 1. Sample the range of the matrix.
+        Y = _runPass(corpus, 'range', None, num_samples, chunksize, processes, seed, temp_dir)
+
+        # 2. Power iterations.
+        for i in range(0, power_iters):
+            Q = np.linalg.qr(Y)[0]
+            Y = _runPass(corpus, 'power', Q, num_samples, chunksize, processes, seed, temp_dir)
+
+        # 3. Project the matrix onto the range, and decompose the result.
+        Q = np.linalg.qr(Y)[0]
+        del Y
+
+        X = _runPass(corpus, 'project', Q, num_samples, chunksize, processes, seed, temp_dir)
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    # The eigenvalues of B * B^T are the squared singular values.
+    eigvals, U_b = np.linalg.eigh(X)
+
+    # Put them in decreasing order, and keep the top `num_topics`.
+    order = np.argsort(eigvals)[::-1][0:num_topics]
+    s = np.sqrt(np.maximum(eigvals[order], 0.0))
+    U = np.dot(Q, U_b[:, order])
+
+    # Store the result in a regular LsiModel.
+    model = LsiModel(corpus=None, num_topics=num_topics, id2word=id2word,
+                     power_iters=power_iters, extra_samples=extra_samples)
+    model.projection.u = U
+    model.projection.s = s
+    model.docs_processed = num_docs
+
+    elapsed = time.time() - t0
+    logger.info('trained LSI on %d documents in %.1f seconds (%.0f docs/sec)',
+                num_docs, elapsed, num_docs / max(elapsed, 1e-6))
+
+    return model
+
+
+def compareLsi(corpus, num_topics, id2word, sample_size=20000, seed=0, **kwargs):
+    """
+    Compare `trainLsi` to gensim's LsiModel on a random sample of
+    `sample_size` documents from `corpus`. Both are trained on the sample
+    (gensim's trainer would take hours on the full corpus).
+
+    Any other keyword arguments are passed to `trainLsi`.
+
+    Returns a dictionary with:
+        sample_size       The number of documents in the sample.
+        gensim_seconds    Training time for each method.
+        randomized_seconds
+        gensim_captured   The fraction of the sample's energy (squared
+        randomized_captured  Frobenius norm) captured by each model's topics.
+                          Higher is better; 1 - captured is the relative
+                          squared reconstruction error.
+        max_sv_error      The largest relative difference between the
+                          singular values of the two models.
+        subspace_overlap  How closely the two models' topic subspaces
+                          match, from 0 to 1 (the mean squared cosine of
+                          the principal angles between them).
+    """
+    num_docs = len(corpus)
+
+    rng = np.random.RandomState(seed)
+    doc_ids = np.sort(rng.choice(num_docs, size=min(sample_size, num_docs), replace=False))
+
+    sample = corpus.getRows(doc_ids).astype(np.float64)
+    sample = sparse.csr_matrix(sample)
+
+    logger.info('comparing LSI trainers on a sample of %d documents', len(doc_ids))
+
+    t0 = time.time()
+    model_gensim = LsiModel(corpus=matutils.Sparse2Corpus(sample, documents_columns=False),
+                            num_topics=num_topics, id2word=id2word)
+    gensim_seconds = time.time() - t0
+
+    t0 = time.time()
+    model_rand = trainLsi(sample, num_topics, id2word, seed=seed, **kwargs)
+    rand_seconds = time.time() - t0
+
+    U_g = model_gensim.projection.u[:, 0:num_topics]
+    U_r = model_rand.projection.u[:, 0:num_topics]
+    s_g = model_gensim.projection.s[0:num_topics]
+    s_r = model_rand.projection.s[0:num_topics]
+
+    total_energy = sample.multiply(sample).sum()
+
+    def captured(U):
+        return np.sum(sample.dot(U) ** 2) / total_energy
+
+    report = {'sample_size': len(doc_ids),
+              'gensim_seconds': gensim_seconds,
+              'randomized_seconds': rand_seconds,
+              'gensim_captured': captured(U_g),
+              'randomized_captured': captured(U_r),
+              'max_sv_error': np.max(np.abs(s_r - s_g) / s_g),
+              'subspace_overlap': np.sum(np.dot(U_g.T, U_r) ** 2) / num_topics}
+
+    logger.info('LSI comparison: %s', report)
+
+    return report
+
@@ -13,6 +13,17 @@ from gensim.models import TfidfModel, LsiModel
 from gensim.corpora import Dictionary, WikiCorpus, MmCorpus
 from gensim import similarities
 from gensim import utils
+from quantindex import QuantizedIndex
+from ivfindex import IVFIndex
+from shardindex import ShardedIndex
+from knngraph import buildKnnGraph
+from csrcorpus import CsrCorpus
+from titlestore import TitleStore
+from tfidfcorpus import TfidfCorpus
+from invindex import InvertedIndex
+from wikibuild import buildWikiCorpus
+from lsitrain import trainLsi, compareLsi
+from pipeline import Pipeline
 import time
 import sys
 import logging
@@ -61,11 +72,131 @@ if __name__ == '__main__':
     # On Jan 18th, 2017 it was ~13GB
     dump_file = './data/enwiki-latest-pages-articles.xml.bz2'
     
+    # The single-pass build (below) is faster still with the "multistream"
+    # version of the dump, which can be decompressed on multiple cores (see 
+    # wikidump.py). If you've downloaded it and its index, they'll be used:
+    # https://dumps.wikimedia.org/enwiki/latest/enwiki-latest-pages-articles-multistream.xml.bz2
+    # https://dumps.wikimedia.org/enwiki/latest/enwiki-latest-pages-articles-multistream-index.txt.bz2
+    multistream_file = './data/enwiki-latest-pages-articles-multistream.xml.bz2'
+    index_file = './data/enwiki-latest-pages-articles-multistream-index.txt.bz2'
+    
+    # Steps 1 and 2 each parse the entire dump. With `single_pass`, the dump
+    # is instead parsed just once, by `buildWikiCorpus` (see wikibuild.py),
+    # which produces the same dictionary and bag-of-words vectors in roughly
+    # half the time.
+    single_pass = True
+    
+    # The dictionary filtering parameters (see step 1).
+    keep_words = 100000
+    no_below = 20
+    no_above = 0.1
+    
+    # The number of LSI topics (see step 5).
+    num_topics = 300
+    
+    # How to train the LSI model (see step 5): 'randomized' for the 
+    # multi-process randomized SVD in lsitrain.py, or 'gensim' for gensim's
+    # LsiModel. `power_iters` is the number of extra passes over the corpus
+    # which the randomized SVD makes to refine its result. After training, 
+    # the two methods are compared on a sample of `lsi_check_sample` 
+    # articles (set this to 0 to skip the check).
+    lsi_trainer = 'randomized'
+    power_iters = 2
+    lsi_check_sample = 20000
+    
+    # A MatrixSimilarity holds all of the LSI vectors in one array, which has
+    # to fit in memory (4.69 GB for me). Alternatively, set `shard_size` to
+    # write the vectors out as a ShardedIndex, in files of `shard_size` 
+    # articles each. Only one shard is held in memory while building it, and
+    # the shards are memory-mapped and searched in parallel. 
+    # (Steps 7 and 8 require the MatrixSimilarity, so they're skipped when 
+    # using shards.)
+    shard_size = None
+    
+    # The LSI index is ~4.2M articles x 300 topics of 32-bit floats, or 
+    # 4.69 GB. We can also store compressed copies of it which are smaller
+    # and faster to search (see step 7):
+    #   'float16' - 2.35 GB, with nearly identical similarity values.
+    #   'int8'    - 1.19 GB, each vector scaled and rounded to 8-bit integers.
+    # Run `benchmark_index.py` to compare their recall against the original.
+    # Set this to an empty list to skip this step.
+    quantize_dtypes = ['float16', 'int8']
+    
+    # The number of k-means clusters for the approximate search index (see 
+    # step 8). With 8,192 clusters, each one holds ~500 articles on average.
+    num_lists = 8192
+    
+    # The number of neighbours to precompute for every article (see step 
+    # 10), so that "find articles similar to X" is a table lookup. The table
+    # takes 6 bytes per neighbour, or ~2.5 GB for 100 neighbours of ~4.2M 
+    # articles. Set this to None to skip this step.
+    knn_k = 100
+    
+    # ======== Stage runner ========
+    # Each of the steps below is run as a "stage" (see pipeline.py), which
+    # declares the files it reads and writes, and the parameters above that
+    # affect it. When a stage finishes, fingerprints of its files and its 
+    # parameters are recorded in './data/pipeline.json'.
+    #
+    # If you re-run the script, any stage which is already up to date is
+    # skipped--so after a crash, just run it again. If you change a 
+    # parameter (e.g., `num_topics`), only that stage, and the stages whose
+    # inputs change as a result, are re-run. To force a stage to re-run, 
+    # delete its output files.
+    pipeline = Pipeline('./data/pipeline.json')
+    
+    # The bag-of-words corpus is stored as a CsrCorpus (see csrcorpus.py).
+    bow_file = './data/bow.csr'
+    
+    def loadTfidfCorpus():
+        """
+        Load the bag-of-words vectors and the tf-idf model back from disk, 
+        and return the tf-idf corpus. The tf-idf vectors aren't stored; 
+        they're computed from the bag-of-words vectors as they're read (see 
+        tfidfcorpus.py).
+        """
+        return TfidfCorpus(CsrCorpus(bow_file), TfidfModel.load('./data/tfidf.tfidf_model'))
+    
+    # ======== STEPS 1 & 2: Single-pass dictionary and bag-of-words ========
+    # Use the multistream dump if it's available. Without its index, the
+    # stream offsets are found by scanning the dump instead.
+    if os.path.exists(multistream_file):
+        source_file = multistream_file
+        source_index = index_file if os.path.exists(index_file) else None
+    else:
+        source_file = dump_file
+        source_index = None
+    
+    def buildSinglePass(resume):
+        print('Parsing Wikipedia to build the dictionary and bag-of-words...')
+        sys.stdout.flush()
+        
+        t0 = time.time()
+        
+        # Tokenizes the articles across a pool of processes, spooling the word
+        # counts to disk, then filters the dictionary and re-maps the spooled
+        # vectors to the final word ids. The log reports the pages per second
+        # through each stage.
+        buildWikiCorpus(source_file, './data/', keep_words=keep_words,
+                        no_below=no_below, no_above=no_above,
+                        index_file=source_index)
+        
+        print('    Building dictionary and bag-of-words took %s' % formatTime(time.time() - t0))
+        sys.stdout.flush()
+    
+    if single_pass:
+        pipeline.run('dictionary_bow', buildSinglePass,
+                     inputs=[source_file] + ([source_index] if source_index else []),
+                     outputs=['./data/dictionary.txt.bz2', bow_file, 
+                              './data/titles_to_id.pickle'],
+                     params={'keep_words': keep_words, 'no_below': no_below,
+                             'no_above': no_above})
+    
     # ======== STEP 1: Build Dictionary =========            
     # The first step is to parse through all of Wikipedia and identify all of
     # the unique words that we want to have in our dictionary.   
     # This is a long process--it took 3.2hrs. on my Intel Core i7 4770
-    if True:    
+    def buildDictionary(resume):
 
         # Create an empty dictionary
         dictionary = Dictionary()
@@ -104,32 +235,33 @@ if __name__ == '__main__':
         print('    %d unique tokens before pruning.' % len(dictionary))
         sys.stdout.flush()
         
-        keep_words = 100000    
-    
         # The initial dictionary is huge (~8.75M words in my Wikipedia dump), 
         # so let's filter it down. We want to keep the words that are neither 
         # very rare or overly common. To do this, we will keep only words that 
         # exist within at least 20 articles, but not more than 10% of all 
         # documents. Finally, we'll also put a hard limit on the dictionary 
         # size and just keep the 'keep_words' most frequent works.
-        wiki.dictionary.filter_extremes(no_below=20, no_above=0.1, keep_n=keep_words)
+        wiki.dictionary.filter_extremes(no_below=no_below, no_above=no_above, keep_n=keep_words)
         
         # Write out the dictionary to disk.
         # For my run, this file is 769KB when compressed.
         # TODO -- This text format lets you peruse it, but you can
         # compress it better as binary...
         wiki.dictionary.save_as_text('./data/dictionary.txt.bz2')
-    else:
-        # Nothing to do here.
-        print('')
+    
+    if not single_pass:
+        pipeline.run('dictionary', buildDictionary, inputs=[dump_file],
+                     outputs=['./data/dictionary.txt.bz2'],
+                     params={'keep_words': keep_words, 'no_below': no_below,
+                             'no_above': no_above})
     
     # ======== STEP 2: Convert Articles To Bag-of-words ========    
     # Now that we have our finalized dictionary, we can create bag-of-words
     # representations for the Wikipedia articles. This means taking another
     # pass over the Wikipedia dump!
-    if True:
+    def buildBow(resume):
     
-        # Load the dictionary if you're just running this section.
+        # Load the dictionary.
         dictionary = Dictionary.load_from_text('./data/dictionary.txt.bz2')
         wiki = WikiCorpus(dump_file, dictionary=dictionary)    
     
@@ -141,18 +273,27 @@ if __name__ == '__main__':
         
         t0 = time.time()
     
+        # With metadata = True, iterating over `wiki` yields each article's
+        # bag-of-words vector along with its (pageid, article_title). Record
+        # the titles as the vectors go by.
+        id_to_titles = {}
+        
+        def vectors():
+            for (bow, (pageid, title)) in wiki:
+                id_to_titles[len(id_to_titles)] = (pageid, title)
+                yield bow
+        
         # Generate bag-of-words vectors (term-document frequency matrix) and 
-        # write these directly to disk.
+        # write these directly to disk, in the binary CSR format.
         # On my machine, this took 3.53 hrs. 
-        # By setting metadata = True, this will also record all of the article
-        # titles into a separate pickle file, 'bow.mm.metadata.cpickle'
-        MmCorpus.serialize('./data/bow.mm', wiki, metadata=True, progress_cnt=10000)
+        CsrCorpus.serialize(bow_file, vectors(), num_terms=len(dictionary),
+                            progress_cnt=10000)
         
         print('    Conversion to bag-of-words took %s' % formatTime(time.time() - t0))
         sys.stdout.flush()
 
-        # Load the article titles back
-        id_to_titles = utils.unpickle('./data/bow.mm.metadata.cpickle')
+        # Store the article titles, in the same format as MmCorpus does.
+        utils.pickle(id_to_titles, bow_file + '.metadata.cpickle')
     
         # Create the reverse mapping, from article title to index.
         titles_to_id = {}
@@ -166,42 +307,48 @@ if __name__ == '__main__':
         
         # Store the resulting map.
         utils.pickle(titles_to_id, './data/titles_to_id.pickle')
-
-        # We're done with the article titles so free up their memory.
-        del id_to_titles
-        del titles_to_id
     
+    if not single_pass:
+        pipeline.run('bow', buildBow, 
+                     inputs=[dump_file, './data/dictionary.txt.bz2'],
+                     outputs=[bow_file, './data/titles_to_id.pickle'])
     
-        # To clean up some memory, we can delete our original dictionary and 
-        # wiki objects, and load back the dictionary directly from the file.
-        del dictionary
-        del wiki  
+    # ======== Store the article titles ========
+    # Unpickling the (pageid, title) for every article takes several seconds,
+    # and gigabytes of memory, in every search process. Write them out again
+    # as a memory-mapped TitleStore, which can also look articles up by 
+    # title or title prefix.
+    def buildTitleStore(resume):
+        print('\nWriting the title store...')
+        t0 = time.time()
         
-        # Load the dictionary back from disk.
-        # (0.86sec on my machine loading from an SSD)
-        dictionary = Dictionary.load_from_text('./data/dictionary.txt.bz2')
-    
-        # Load the bag-of-words vectors back from disk.
-        # (0.8sec on my machine loading from an SSD)
-        corpus_bow = MmCorpus('./data/bow.mm')    
+        id_to_titles = utils.unpickle(bow_file + '.metadata.cpickle')
+        
+        doc_ids = sorted(id_to_titles.keys())
+        
+        TitleStore.serialize('./data/titles.store', 
+                             [id_to_titles[doc_id][1] for doc_id in doc_ids],
+                             [int(id_to_titles[doc_id][0]) for doc_id in doc_ids])
+        
+        print('    Writing the title store took %s' % formatTime(time.time() - t0))
     
-    # If we previously completed this step, just load the pieces we need.
-    else:
-        print('\nLoading the bag-of-words corpus from disk.')
-        # Load the bag-of-words vectors back from disk.
-        # (0.8sec on my machine loading from an SSD)
-        corpus_bow = MmCorpus('./data/bow.mm')    
-
+    pipeline.run('title_store', buildTitleStore, 
+                 inputs=[bow_file + '.metadata.cpickle'],
+                 outputs=['./data/titles.store'])
     
     # ======== STEP 3: Learn tf-idf model ========
     # At this point, we're all done with the original Wikipedia text, and we 
     # just have our bag-of-words representation.
     # Now we can look at the word frequencies and document frequencies to 
     # build a tf-idf model which we'll use in the next step.
-    if True:
+    def buildTfidfModel(resume):
         print('\nLearning tf-idf model from data...')
         t0 = time.time()
         
+        # (0.86sec on my machine loading from an SSD)
+        dictionary = Dictionary.load_from_text('./data/dictionary.txt.bz2')
+        corpus_bow = CsrCorpus(bow_file)
+        
         # Build a Tfidf Model from the bag-of-words dataset.
         # This took 47 min. on my machine.
         # TODO - Why not normalize?
@@ -210,48 +357,59 @@ if __name__ == '__main__':
         print('    Building tf-idf model took %s' % formatTime(time.time() - t0))
         model_tfidf.save('./data/tfidf.tfidf_model')
     
-    # If we previously completed this step, just load the pieces we need.
-    else:
-        print('\nLoading the tf-idf model from disk.')
-        model_tfidf = TfidfModel.load('./data/tfidf.tfidf_model') 
-        
+    pipeline.run('tfidf_model', buildTfidfModel, 
+                 inputs=['./data/dictionary.txt.bz2', bow_file],
+                 outputs=['./data/tfidf.tfidf_model'],
+                 params={'normalize': False})
 
     # ======== STEP 4: Convert articles to tf-idf ======== 
-    # We've learned the word statistics and built a tf-idf model, now it's time
-    # to apply it and convert the vectors to the tf-idf representation.
-    if True:
-        print('\nApplying tf-idf model to all vectors...')
-        t0 = time.time()
-        
-        # Apply the tf-idf model to all of the vectors.
-        # This took 1hr. and 40min. on my machine.
-        # The resulting corpus file is large--17.9 GB for me.        
-        MmCorpus.serialize('./data/corpus_tfidf.mm', model_tfidf[corpus_bow], progress_cnt=10000)
-        
-        print('    Applying tf-idf model took %s' % formatTime(time.time() - t0))
-    else:
-        # Nothing to do here.
-        print('')
+    # This step used to apply the tf-idf model to all of the vectors and write
+    # them out as another corpus. This took 1hr. and 40min. on my machine, and
+    # the Matrix Market file was 17.9 GB! 
+    #
+    # But a tf-idf vector is just the bag-of-words vector with each word count
+    # multiplied by the word's idf weight, so now the later steps just read
+    # the bag-of-words vectors through a `TfidfCorpus`, which applies the 
+    # weights on the fly (see `loadTfidfCorpus` above).
 
     # ======== STEP 5: Train LSI on the articles ========
     # Learn an LSI model from the tf-idf vectors.
-    if True:
-        
-        # The number of topics to use.
-        num_topics = 300
+    def buildLsiModel(resume):
         
         # Load the tf-idf corpus back from disk.
-        corpus_tfidf = MmCorpus('./data/corpus_tfidf.mm')        
+        dictionary = Dictionary.load_from_text('./data/dictionary.txt.bz2')
+        corpus_tfidf = loadTfidfCorpus()
         
         # Train LSI
         print('\nLearning LSI model from the tf-idf vectors...')
         t0 = time.time()
         
         # Build the LSI model
-        # This took 2hrs. and 7min. on my machine.
-        model_lsi = LsiModel(corpus_tfidf, num_topics=num_topics, id2word=dictionary)   
+        # With gensim's LsiModel, this took 2hrs. and 7min. on my machine. 
+        # The randomized SVD makes `power_iters` + 2 passes over the corpus,
+        # each spread across all of the cores.
+        if lsi_trainer == 'randomized':
+            model_lsi = trainLsi(corpus_tfidf, num_topics, dictionary, 
+                                 power_iters=power_iters)
+        else:
+            model_lsi = LsiModel(corpus_tfidf, num_topics=num_topics, id2word=dictionary)   
     
-        print('    Building LSI model took %s' % formatTime(time.time() - t0))
+        print('    Building LSI model took %s (%.0f articles/sec)' % 
+              (formatTime(time.time() - t0), len(corpus_tfidf) / (time.time() - t0)))
+        
+        # Check the accuracy of the randomized SVD against gensim's LsiModel,
+        # by training both on a sample of the articles.
+        if lsi_trainer == 'randomized' and lsi_check_sample > 0:
+            print('    Comparing against gensim on a sample of %d articles...' % lsi_check_sample)
+            
+            report = compareLsi(corpus_tfidf, num_topics, dictionary, 
+                                sample_size=lsi_check_sample, 
+                                power_iters=power_iters)
+            
+            print('      Energy captured: %.4f (gensim: %.4f)' % 
+                  (report['randomized_captured'], report['gensim_captured']))
+            print('      Largest singular value error: %.2f%%' % (100 * report['max_sv_error']))
+            print('      Topic subspace overlap: %.3f' % report['subspace_overlap'])
 
         # Write out the LSI model to disk.
         # The LSI model is big but not as big as the corpus.
@@ -260,15 +418,25 @@ if __name__ == '__main__':
         #  This is saved as `lsi.lsi_model.projection.u.npy` 
         model_lsi.save('./data/lsi.lsi_model')
     
-    # If we previously completed this step, just load the pieces we need.
-    else:
-        # Load the tf-idf corpus and trained LSI model back from disk.
-        corpus_tfidf = MmCorpus('./data/corpus_tfidf.mm')
-        model_lsi = LsiModel.load('./data/lsi.lsi_model')
+    pipeline.run('lsi_model', buildLsiModel,
+                 inputs=['./data/dictionary.txt.bz2', bow_file, 
+                         './data/tfidf.tfidf_model'],
+                 outputs=['./data/lsi.lsi_model'],
+                 params={'num_topics': num_topics, 'lsi_trainer': lsi_trainer,
+                         'power_iters': power_iters})
     
     # ========= STEP 6: Convert articles to LSI with index ========
     # Transform corpus to LSI space and index it
-    if True:
+    if shard_size is None:
+        lsi_index_file = './data/lsi_index.mm'
+    else:
+        lsi_index_file = './data/lsi_index.shards'
+    
+    def buildLsiIndex(resume):
+        
+        # Load the tf-idf corpus and trained LSI model back from disk.
+        corpus_tfidf = loadTfidfCorpus()
+        model_lsi = LsiModel.load('./data/lsi.lsi_model')
         
         print('\nApplying LSI model to all vectors...')
         t0 = time.time()
@@ -279,7 +447,121 @@ if __name__ == '__main__':
                 
         # Instead, we'll convert the vectors to LSI and store them as a dense
         # matrix, all in one step.     
-        index = similarities.MatrixSimilarity(model_lsi[corpus_tfidf], num_features=num_topics)
-        index.save('./data/lsi_index.mm')
+        if shard_size is None:
+            index = similarities.MatrixSimilarity(model_lsi[corpus_tfidf], num_features=num_topics)
+            index.save(lsi_index_file)
+        
+        # Or write them out one shard at a time.
+        else:
+            ShardedIndex(lsi_index_file, model_lsi[corpus_tfidf], num_features=num_topics, shard_size=shard_size)
         
         print('    Applying LSI model took %s' % formatTime(time.time() - t0))
+
+    pipeline.run('lsi_index', buildLsiIndex,
+                 inputs=[bow_file, './data/tfidf.tfidf_model', 
+                         './data/lsi.lsi_model'],
+                 outputs=[lsi_index_file],
+                 params={'shard_size': shard_size})
+
+    # ========= STEP 7: Compress the LSI index (optional) ========
+    # Each compressed copy (see `quantize_dtypes`) is its own stage.
+    def buildQuantizedIndex(dtype):
+        
+        def build(resume):
+            # Memory-map the full index rather than reading it all in; it's
+            # converted a block of rows at a time.
+            index = similarities.MatrixSimilarity.load(lsi_index_file, mmap='r')
+        
+            print('\nCompressing the LSI index to %s...' % dtype)
+            t0 = time.time()
+            
+            qindex = QuantizedIndex(index.index, dtype=dtype)
+            qindex.save('./data/lsi_index_%s.qi' % dtype, sep_limit=0)
+            
+            print('    Compressing the LSI index took %s' % formatTime(time.time() - t0))
+            print('    Compressed size: %.2f GB' % (qindex.memorySize() / 2.0**30))
+        
+        return build
+    
+    if shard_size is None:
+        for dtype in quantize_dtypes:
+            pipeline.run('quantize_' + dtype, buildQuantizedIndex(dtype),
+                         inputs=[lsi_index_file],
+                         outputs=['./data/lsi_index_%s.qi' % dtype])
+
+    # ========= STEP 8: Build an approximate search index (optional) ========
+    # Cluster the LSI vectors with k-means and file each article under its 
+    # nearest cluster. A search then only has to score the articles in the
+    # few clusters nearest to the query, rather than all ~4.2M of them. The
+    # index holds its own (re-ordered) copy of the LSI vectors.
+    # Run `benchmark_index.py` to see the recall / speed trade-off.
+    def buildIvfIndex(resume):
+        print('\nBuilding the approximate (IVF) search index...')
+        t0 = time.time()
+        
+        index = similarities.MatrixSimilarity.load(lsi_index_file, mmap='r')
+        
+        ivf_index = IVFIndex(index.index, num_lists=num_lists)
+        ivf_index.save('./data/lsi_index.ivf', sep_limit=0)
+        
+        print('    Building the IVF index took %s' % formatTime(time.time() - t0))
+    
+    if shard_size is None:
+        pipeline.run('ivf_index', buildIvfIndex, inputs=[lsi_index_file],
+                     outputs=['./data/lsi_index.ivf'],
+                     params={'num_lists': num_lists})
+
+    # ========= STEP 9: Build the inverted index for keyword search ========
+    # Record which articles contain each word, so that boolean keyword 
+    # searches (KeySearch.keywordSearch) don't have to scan all of the 
+    # articles. The doc id lists are compressed, and are memory-mapped when
+    # loaded.
+    # The index also stores how many times each word occurs in each article,
+    # for ranked (BM25) keyword search. Our tf-idf vectors aren't normalized,
+    # so these counts are just the tf-idf values divided by the idf.
+    def buildInvertedIndex(resume):
+        print('\nBuilding the inverted index for keyword search...')
+        t0 = time.time()
+        
+        dictionary = Dictionary.load_from_text('./data/dictionary.txt.bz2')
+        model_tfidf = TfidfModel.load('./data/tfidf.tfidf_model')
+        
+        idfs = [model_tfidf.idfs.get(word_id, 0.0) for word_id in range(0, len(dictionary))]
+        
+        inv_index = InvertedIndex(loadTfidfCorpus(), num_terms=len(dictionary),
+                                  store_counts=True, idfs=idfs)
+        inv_index.save('./data/corpus_tfidf.invindex', sep_limit=0)
+        
+        print('    Building the inverted index took %s' % formatTime(time.time() - t0))
+        print('    Compressed postings: %.2f GB' % ((inv_index.postings.nbytes + inv_index.counts.nbytes) / 2.0**30))
+    
+    pipeline.run('inverted_index', buildInvertedIndex,
+                 inputs=['./data/dictionary.txt.bz2', './data/tfidf.tfidf_model',
+                         bow_file],
+                 outputs=['./data/corpus_tfidf.invindex'])
+
+    # ========= STEP 10: Precompute the nearest neighbours (optional) ========
+    # Find the `knn_k` most similar articles to every article, by scoring 
+    # all of the articles against each other a block at a time, on all of 
+    # the cores. This is by far the longest step--hours for the full 
+    # Wikipedia index--so it checkpoints as it goes, and picks up where it
+    # left off if the script is re-run. SimSearch.findSimilarToDoc then 
+    # answers from the table (see knngraph.py).
+    def buildNeighbors(resume):
+        print('\nFinding the %d nearest neighbours of every article...' % knn_k)
+        t0 = time.time()
+        
+        # Memory-map the index; the worker processes share it.
+        if shard_size is None:
+            vectors = similarities.MatrixSimilarity.load(lsi_index_file, mmap='r').index
+        else:
+            vectors = ShardedIndex.load(lsi_index_file, mmap='r')
+        
+        buildKnnGraph(vectors, './data/lsi_index.knn', k=knn_k, resume=resume)
+        
+        print('    Finding the nearest neighbours took %s' % formatTime(time.time() - t0))
+    
+    if knn_k is not None:
+        pipeline.run('knn_graph', buildNeighbors, inputs=[lsi_index_file],
+                     outputs=['./data/lsi_index.knn'],
+                     params={'knn_k': knn_k})
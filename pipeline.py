@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+A small runner for the steps of a long build, like `make_wikicorpus.py`,
+which skips the steps that are already up to date.
+
+Each step (a "stage") declares the files it reads (its inputs), the files it
+writes (its outputs), and the parameters which affect its results. When a
+stage completes, a fingerprint of each of these files is recorded in a JSON
+manifest, along with the parameters. On the next run, the stage is skipped
+if its parameters are unchanged, its inputs have the same fingerprints, and
+its outputs are still there, unmodified.
+
+Because a stage's inputs are the outputs of the stages before it, changing
+a parameter rebuilds the stage it belongs to, and then only those later
+stages whose inputs actually came out different.
+
+A stage which is interrupted part-way can pick up where it left off: the
+stage function is told whether it's resuming the same work (same inputs and
+parameters) as the interrupted run, in which case it can continue from its
+own chunk checkpoints (see `CsrCorpus.serializeChunks`).
+"""
+
+import hashlib
+import logging
+import json
+import glob
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprintFile(fname, num_samples=16, sample_size=1 << 20):
+    """
+    Compute a fingerprint of the contents of `fname`.
+
+    Small files are hashed in full. Hashing a multi-gigabyte file on every
+    run would take minutes, so for large files just `num_samples` evenly
+    spaced blocks of `sample_size` bytes (including the first and last) are
+    hashed, along with the file size.
+
+    Returns the fingerprint as a hex string.
+    """
+    size = os.path.getsize(fname)
+
+    sha = hashlib.sha1(str(size).encode('ascii'))
+
+    with open(fname, 'rb') as f:
+        if size <= num_samples * sample_size:
+            for block in iter(lambda: f.read(sample_size), b''):
+                sha.update(block)
+        else:
+            for i in range(0, num_samples):
+                f.seek((size - sample_size) * i // (num_samples - 1))
+                sha.update(f.read(sample_size))
+
+    return sha.hexdigest()
+
+
+def expandFiles(fnames):
+    """
+    Expand a list of file names to include any companion files written
+    alongside each one (e.g., the .npy arrays which gensim saves separately
+    as [fname].*.npy, or the arrays of a CsrCorpus). Checkpoint files are
+    left out.
+    """
+    expanded = []
+
+    for fname in fnames:
+        expanded.append(fname)
+
+        for companion in sorted(glob.glob(fname + '.*')):
+            if '.checkpoint' not in companion:
+                expanded.append(companion)
+
+    return expanded
+
+
+class Pipeline(object):
+    """
+    Runs the stages of a build, skipping those which are up to date, and
+    records the state of each completed stage in a JSON manifest.
+    """
+
+    def __init__(self, manifest_fname):
+        """
+        Load the manifest from `manifest_fname`, if it exists.
+        """
+        self.manifest_fname = manifest_fname
+
+        if os.path.exists(manifest_fname):
+            with open(manifest_fname) as f:
+                self.manifest = json.load(f)
+        else:
+            self.manifest = {'stages': {}, 'pending': {}}
+
+    def _saveManifest(self):
+        """
+        Internal function which writes out the manifest, replacing the old
+        one only once the new one is complete.
+        """
+        with open(self.manifest_fname + '.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+
+        os.rename(self.manifest_fname + '.tmp', self.manifest_fname)
+
+    @staticmethod
+    def _fingerprintFiles(fnames):
+        """
+        Internal function which fingerprints each of the files (and their
+        companion files). Missing files are recorded as None.
+        """
+        fingerprints = {}
+
+        for fname in expandFiles(fnames):
+            if os.path.exists(fname):
+                fingerprints[fname] = fingerprintFile(fname)
+            else:
+                fingerprints[fname] = None
+
+        return fingerprints
+
+    def isUpToDate(self, name, inputs=(), outputs=(), params=None):
+        """
+        Check whether stage `name` has completed before with the same
+        parameters and inputs, and its outputs haven't changed since.
+        """
+        record = self.manifest['stages'].get(name)
+
+        if record is None:
+            return False
+
+        # JSON turns tuples into lists, etc., so compare the parameters in
+        # their JSON form.
+        if record['params'] != json.loads(json.dumps(params or {})):
+            logger.info('stage %s: parameters have changed', name)
+            return False
+
+        if record['inputs'] != self._fingerprintFiles(inputs):
+            logger.info('stage %s: inputs have changed', name)
+            return False
+
+        # The outputs must all be present.
+        if any(fp is None for fp in self._fingerprintFiles(outputs).values()) or \
+                record['outputs'] != self._fingerprintFiles(outputs):
+            logger.info('stage %s: outputs are missing or have changed', name)
+            return False
+
+        return True
+
+    def run(self, name, func, inputs=(), outputs=(), params=None, force=False):
+        """
+        Run stage `name`, unless it's already up to date.
+
+        Parameters:
+            func     The function which performs the stage. It's called as
+                     func(resume), where `resume` is True if a previous run
+                     of this stage, with the same inputs and parameters, was
+                     interrupted. The function can then continue from its
+                     checkpoints rather than starting over.
+            inputs   The files the stage reads.
+            outputs  The files the stage writes.
+            params   Dictionary of the parameters which affect the results.
+            force    Run the stage even if it's up to date.
+
+        Returns True if the stage was run, False if it was skipped.
+        """
+        params = json.loads(json.dumps(params or {}))
+
+        if not force and self.isUpToDate(name, inputs, outputs, params):
+            print('\nStage %s is up to date; skipping it.' % name)
+            logger.info('stage %s is up to date', name)
+            return False
+
+        input_fps = self._fingerprintFiles(inputs)
+
+        # Missing inputs mean an earlier stage hasn't been run.
+        missing = [fname for (fname, fp) in input_fps.items() if fp is None]
+        if len(missing) > 0:
+            raise IOError('stage %s is missing its inputs: %s' % (name, ', '.join(missing)))
+
+        # If this stage was interrupted while working on exactly the same
+        # inputs and parameters, let it resume.
+        state = {'params': params, 'inputs': input_fps}
+        resume = (self.manifest['pending'].get(name) == state)
+
+        # Mark the stage as in progress. Until it completes, it and the
+        # stages after it are out of date.
+        self.manifest['stages'].pop(name, None)
+        self.manifest['pending'][name] = state
+        self._saveManifest()
+
+        logger.info('running stage %s%s', name, ' (resuming)' if resume else '')
+
+        t0 = time.time()
+
+        func(resume)
+
+        # Record the completed stage.
+        state['outputs'] = self._fingerprintFiles(outputs)
+        state['seconds'] = time.time() - t0
+
+        missing = [fname for (fname, fp) in state['outputs'].items() if fp is None]
+        if len(missing) > 0:
+            raise IOError('stage %s did not write its outputs: %s' % (name, ', '.join(missing)))
+
+        del self.manifest['pending'][name]
+        self.manifest['stages'][name] = state
+        self._saveManifest()
+
+        return True
@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+A compressed version of the LSI index, for use in place of a gensim
+MatrixSimilarity.
+
+The Wikipedia LSI index is ~4.2M documents x 300 topics of 32-bit floats,
+which is 4.69 GB. Every search has to read through all of it, so the search
+time is mostly limited by memory bandwidth. QuantizedIndex stores the vectors
+with fewer bits:
+
+  * 'float16' - Half-precision floats. 2x smaller, and the similarity values
+                are nearly identical.
+  * 'int8'    - Each vector is scaled so that its largest value is 127, and
+                then rounded to 8-bit integers. The scale factor is kept for
+                each vector. 4x smaller.
+
+Searches are performed directly on the compressed vectors. If the original
+32-bit vectors are available (e.g., a memory-mapped MatrixSimilarity), they
+can be attached with `setExactVectors`. A search then selects a larger
+shortlist of candidates using the compressed vectors, and re-scores just the
+shortlist exactly.
+"""
+
+from gensim import utils, matutils
+from ranking import topN, blockedTopN
+import numpy as np
+
+
+class QuantizedIndex(utils.SaveLoad):
+    """
+    Stores a [num_docs x num_features] matrix of unit-length LSI vectors in a
+    compressed form, and performs similarity searches against it.
+    """
+
+    # The original vectors for re-scoring, if attached (see setExactVectors).
+    exact = None
+    rescore_factor = 1
+
+    def __init__(self, vectors, dtype='int8', block_size=65536):
+        """
+        Compress the LSI vectors `vectors`, which should already be normalized
+        to unit length. Typically this is the `index` property of a
+        MatrixSimilarity; it may be memory-mapped, since the vectors are
+        converted `block_size` rows at a time.
+
+        `dtype` is either 'float16' or 'int8'.
+        """
+        if dtype not in ('float16', 'int8'):
+            raise ValueError('Unsupported dtype \'%s\'' % dtype)
+
+        self.dtype = dtype
+        self.num_docs, self.num_features = vectors.shape
+
+        if dtype == 'float16':
+            self.vectors = np.empty(vectors.shape, dtype=np.float16)
+            self.scales = None
+        else:
+            self.vectors = np.empty(vectors.shape, dtype=np.int8)
+            self.scales = np.empty(self.num_docs, dtype=np.float32)
+
+        # Convert the vectors one block at a time.
+        for start in range(0, self.num_docs, block_size):
+            end = min(start + block_size, self.num_docs)
+            block = np.asarray(vectors[start:end], dtype=np.float32)
+
+            if dtype == 'float16':
+                self.vectors[start:end] = block
+            else:
+                # Scale each vector so that its largest magnitude value maps
+                # to 127. All-zero vectors just get a scale of 1.
+                scales = np.max(np.abs(block), axis=1) / 127.0
+                scales[scales == 0] = 1.0
+
+                self.vectors[start:end] = np.rint(block / scales[:, np.newaxis])
+                self.scales[start:end] = scales
+
+    def __len__(self):
+        return self.num_docs
+
+    def setExactVectors(self, vectors, rescore_factor=4):
+        """
+        Attach the original, uncompressed vectors (e.g., the `index` property
+        of a memory-mapped MatrixSimilarity) to use for re-scoring.
+
+        Searches will select `rescore_factor` times as many candidates as
+        requested using the compressed vectors, and then re-score those
+        candidates exactly to pick the final results.
+        """
+        self.exact = vectors
+        self.rescore_factor = rescore_factor
+
+    def getVectors(self, doc_ids):
+        """
+        Return the (de-compressed) 32-bit vectors for the specified documents.
+        """
+        vecs = np.asarray(self.vectors[doc_ids], dtype=np.float32)
+
+        if self.scales is not None:
+            vecs *= self.scales[doc_ids][:, np.newaxis]
+
+        return vecs
+
+    def scoreBlock(self, query_vecs, start, end):
+        """
+        Calculate the similarities between the normalized LSI vectors
+        `query_vecs` and the documents `start` through `end - 1`.
+
+        Returns a [num_queries x (end - start)] array.
+        """
+        # Convert the block to 32-bit floats so that the product can be done
+        # with the fast (BLAS) matrix multiply.
+        block = np.asarray(self.vectors[start:end], dtype=np.float32)
+
+        sims = np.dot(query_vecs, block.T)
+
+        # Apply the per-vector scale factors.
+        if self.scales is not None:
+            sims *= self.scales[start:end]
+
+        return sims
+
+    def findTopN(self, query_vecs, topn=10, query_ids=None, exclude_ids=None,
+                 chunksize=1024, block_size=16384, mask=None):
+        """
+        Find the `topn` most similar documents for each of the normalized LSI
+        vectors in `query_vecs` (one per row).
+
+        See `SimSearch.findSimilarToVectorsBatch` for the parameters.
+        `mask` is an optional boolean array over all of the documents; only
+        the documents marked True can appear in the results.
+
+        Returns a list with one entry per query; each entry is a list of
+        tuples in the form:
+            (doc_id, similarity_value)
+        """
+        query_vecs = np.asarray(query_vecs, dtype=np.float32)
+
+        # When re-scoring, select a larger shortlist of candidates.
+        if self.exact is not None:
+            num_cands = topn * self.rescore_factor
+        else:
+            num_cands = topn
+
+        results = blockedTopN(self.scoreBlock, self.num_docs, query_vecs,
+                              num_cands, query_ids, exclude_ids, chunksize,
+                              block_size, mask)
+
+        if self.exact is None:
+            return results
+
+        # Re-score the candidates for each query using the exact vectors.
+        for i in range(0, len(results)):
+            if len(results[i]) == 0:
+                continue
+
+            # Look up the candidates in sorted order, which is friendlier to a
+            # memory-mapped array.
+            cand_ids = np.sort([doc_id for (doc_id, sim) in results[i]])
+
+            sims = np.dot(self.exact[cand_ids], query_vecs[i])
+
+            results[i] = topN(sims, topn, doc_ids=cand_ids)
+
+        return results
+
+    def __getitem__(self, query):
+        """
+        Return the similarities between `query` and every document, the same
+        way a MatrixSimilarity does.
+
+        `query` is a single LSI vector, either sparse (a list of
+        (topic_id, value) tuples) or a dense numpy array.
+        """
+        if isinstance(query, np.ndarray):
+            query = np.asarray(query, dtype=np.float32).ravel()
+        else:
+            query = matutils.sparse2full(query, self.num_features)
+
+        # Normalize the query to unit length.
+        query = matutils.unitvec(query).astype(np.float32)
+
+        sims = np.empty(self.num_docs, dtype=np.float32)
+        for start in range(0, self.num_docs, 65536):
+            end = min(start + 65536, self.num_docs)
+            sims[start:end] = self.scoreBlock(query[np.newaxis, :], start, end)[0]
+
+        return sims
+
+    def save(self, fname, *args, **kwargs):
+        """
+        Save the index to disk. The exact vectors are not saved; re-attach
+        them with `setExactVectors` after loading.
+        """
+        # Set the exact vectors aside while saving.
+        exact = self.__dict__.pop('exact', None)
+        try:
+            super(QuantizedIndex, self).save(fname, *args, **kwargs)
+        finally:
+            if exact is not None:
+                self.exact = exact
+
+    def memorySize(self):
+        """
+        Return the size of the compressed vectors, in bytes.
+        """
+        num_bytes = self.vectors.nbytes
+        if self.scales is not None:
+            num_bytes += self.scales.nbytes
+        return num_bytes
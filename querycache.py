@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Least-recently-used caches for SimSearch, each limited to a budget of bytes.
+
+Search traffic repeats heavily: the same popular articles, and the same
+query text. SimSearch keeps three caches (see `SimSearch.setCacheSizes`):
+    text    - Query text -> tf-idf vector. Skips the tokenizing.
+    lsi     - tf-idf vector -> normalized LSI vector. Skips the projection.
+    results - (query, topn, filters) -> search results. Skips the scan of
+              the index.
+
+Each cache holds as many entries as fit in its budget, and evicts the least
+recently used ones to make room. The sizes are estimates of the memory used
+by the keys and values (see `sizeOf`).
+"""
+
+from collections import OrderedDict
+import numpy as np
+import threading
+import hashlib
+import sys
+
+
+def sizeOf(value):
+    """
+    Estimate the number of bytes of memory used by `value`: a numpy array,
+    or a (nested) list or tuple of numbers, strings, and arrays.
+    """
+    if isinstance(value, np.ndarray):
+        return sys.getsizeof(value) + (0 if value.base is None else value.nbytes)
+
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeOf(item) for item in value)
+
+    return sys.getsizeof(value)
+
+
+def filterKey(ids_or_mask):
+    """
+    Return a hashable key for an `allow` or `deny` filter (a list of doc ids
+    or a boolean array, see SimSearch), for use in a results cache key.
+    """
+    if ids_or_mask is None:
+        return None
+
+    if isinstance(ids_or_mask, np.ndarray) and ids_or_mask.dtype == np.bool_:
+        return ('mask', len(ids_or_mask), hashlib.md5(np.packbits(ids_or_mask).tostring()).hexdigest())
+
+    # The order of the doc ids doesn't matter.
+    ids = np.unique(np.asarray(list(ids_or_mask), dtype=np.int64))
+
+    return ('ids', hashlib.md5(ids.tostring()).hexdigest())
+
+
+class LRUCache(object):
+    """
+    A dictionary which holds up to `max_bytes` worth of entries, evicting the
+    least recently used entries when it's full. A budget of 0 disables the
+    cache.
+
+    It's safe to use from multiple threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        # The entries, least recently used first. Each value is stored with
+        # its size.
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """
+        Look up `key`, marking it as recently used.
+
+        Returns the value, or None if the key isn't in the cache.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # Move it to the most recently used end.
+            self.entries[key] = entry
+            self.hits += 1
+
+            return entry[0]
+
+    def put(self, key, value):
+        """
+        Store `value` under `key`, evicting the least recently used entries
+        as needed to stay within the budget. A value which is larger than the
+        whole budget isn't stored.
+        """
+        size = sizeOf(key) + sizeOf(value)
+
+        if size > self.max_bytes:
+            return
+
+        with self.lock:
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.num_bytes -= old_entry[1]
+
+            while self.num_bytes + size > self.max_bytes:
+                (old_key, old_entry) = self.entries.popitem(last=False)
+                self.num_bytes -= old_entry[1]
+
+            self.entries[key] = (value, size)
+            self.num_bytes += size
+
+    def resize(self, max_bytes):
+        """
+        Change the budget, evicting entries if it's now over.
+        """
+        with self.lock:
+            self.max_bytes = max_bytes
+
+            while self.num_bytes > self.max_bytes:
+                (old_key, old_entry) = self.entries.popitem(last=False)
+                self.num_bytes -= old_entry[1]
+
+    def clear(self):
+        """
+        Remove all of the entries. (The hit and miss counts are kept.)
+        """
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
+
+    def getStats(self):
+        """
+        Return the cache's statistics as a dictionary: hits, misses, entries,
+        bytes, and max_bytes.
+        """
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'entries': len(self.entries), 'bytes': self.num_bytes,
+                    'max_bytes': self.max_bytes}
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+Functions for selecting the top results out of a large array of similarity
+scores.
+
+Sorting all ~4.2M similarity values for Wikipedia just to keep the first 10
+takes several seconds, and it was by far the slowest part of a search. The
+functions here use numpy's `argpartition` to pull out the `topn` largest
+scores in linear time, and then only sort those few.
+"""
+
+import numpy as np
+
+
+def topN(sims, topn=10, skip=0, exclude_ids=None, doc_ids=None):
+    """
+    Select the `topn` largest similarity values from `sims`.
+
+    Parameters:
+        sims         1D array (or list) of similarity values.
+        topn         The number of results to return.
+        skip         The number of leading results to drop. If the query is
+                     itself a document in the corpus, use skip=1 to leave
+                     it out of the results.
+        exclude_ids  Doc ids which must not appear in the results.
+        doc_ids      Optional doc id for each entry in `sims`. Use this when
+                     `sims` only covers a subset of the corpus. By default,
+                     the position in `sims` is the doc id.
+
+    Returns the results as a list of tuples in the form:
+        (doc_id, similarity_value)
+    """
+    sims = np.asarray(sims).ravel()
+
+    if exclude_ids is None or len(exclude_ids) == 0:
+        exclude_ids = None
+    else:
+        exclude_ids = np.asarray(list(exclude_ids), dtype=np.int64)
+
+    # We need enough candidates that there are still `topn` left after
+    # dropping the skipped results and any excluded ids.
+    num_cands = topn + skip
+    if exclude_ids is not None:
+        num_cands += len(exclude_ids)
+
+    # Find the positions of the `num_cands` largest values. These come back
+    # in no particular order.
+    if num_cands < len(sims):
+        cands = np.argpartition(-sims, num_cands - 1)[0:num_cands]
+
+        # Put the candidates back in position order so that ties are broken
+        # the same way every time.
+        cands.sort()
+    else:
+        cands = np.arange(len(sims))
+
+    # Sort just the candidates, biggest to smallest.
+    cands = cands[np.argsort(-sims[cands], kind='mergesort')]
+    cand_sims = sims[cands]
+
+    # Translate positions into doc ids.
+    if doc_ids is not None:
+        cands = np.asarray(doc_ids)[cands]
+
+    # Drop any excluded documents.
+    if exclude_ids is not None:
+        keep = ~np.in1d(cands, exclude_ids)
+        cands = cands[keep]
+        cand_sims = cand_sims[keep]
+
+    cands = cands[skip:skip + topn]
+    cand_sims = cand_sims[skip:skip + topn]
+
+    return list(zip(cands.tolist(), cand_sims.tolist()))
+
+
+def topNRows(sims, topn, offset=0):
+    """
+    Select the `topn` largest values in every row of the 2D array `sims`
+    (one row per query).
+
+    `offset` is added to the column positions to turn them into doc ids, for
+    when `sims` only covers a block of the corpus.
+
+    Returns the arrays (ids, sims), each with one row per query. The results
+    within a row are *not* sorted; use `sortRows` for that.
+    """
+    rows = np.arange(sims.shape[0])[:, np.newaxis]
+
+    # Select the `topn` largest columns of each row.
+    if sims.shape[1] > topn:
+        cols = np.argpartition(-sims, topn - 1, axis=1)[:, 0:topn]
+    else:
+        cols = np.tile(np.arange(sims.shape[1]), (sims.shape[0], 1))
+
+    return (cols + offset, sims[rows, cols])
+
+
+def mergeTopN(ids1, sims1, ids2, sims2, topn):
+    """
+    Merge two sets of per-query candidates, as returned by `topNRows`,
+    keeping only the `topn` largest for each query.
+    """
+    ids = np.hstack((ids1, ids2))
+    sims = np.hstack((sims1, sims2))
+
+    # Pick out the winners, then translate the positions back to doc ids.
+    cols, sims = topNRows(sims, topn)
+    rows = np.arange(ids.shape[0])[:, np.newaxis]
+
+    return (ids[rows, cols], sims)
+
+
+def sortRows(ids, sims):
+    """
+    Convert per-query candidates, as returned by `topNRows` or `mergeTopN`,
+    into one list of results per query, sorted biggest to smallest.
+
+    Entries with a similarity of -inf mark excluded documents (or empty
+    slots) and are dropped.
+
+    Returns a list with one entry per query; each entry is a list of tuples
+    in the form:
+        (doc_id, similarity_value)
+    """
+    results = []
+    for i in range(0, ids.shape[0]):
+        order = np.argsort(-sims[i], kind='mergesort')
+        row_ids = ids[i][order]
+        row_sims = sims[i][order]
+
+        keep = row_sims > -np.inf
+        results.append(list(zip(row_ids[keep].tolist(), row_sims[keep].tolist())))
+
+    return results
+
+
+def blockedTopN(score_block, num_docs, query_vecs, topn=10, query_ids=None,
+                exclude_ids=None, chunksize=1024, block_size=32768, mask=None):
+    """
+    Find the `topn` most similar documents for each of a batch of queries,
+    scoring the corpus one block of documents at a time.
+
+    The queries are processed in chunks of `chunksize`, and the documents in
+    blocks of `block_size`, so only (chunksize x block_size) similarity
+    values are held in memory at once.
+
+    Parameters:
+        score_block  Function which takes (query_vecs, start, end) and returns
+                     the [num_queries x (end - start)] similarities between
+                     the queries and documents `start` through `end - 1`.
+        num_docs     The number of documents in the corpus.
+        query_vecs   [num_queries x num_features] array of query vectors.
+        topn         The number of results to return for each query.
+        query_ids    Optional doc id of each query. Each query document will
+                     be left out of its own results.
+        exclude_ids  Doc ids to leave out of all of the results.
+        mask         Optional boolean array over all of the documents. Only
+                     the documents marked True can appear in the results.
+
+    Returns a list with one entry per query; each entry is a list of tuples
+    in the form:
+        (doc_id, similarity_value)
+    """
+    if exclude_ids is not None and len(exclude_ids) > 0:
+        exclude_ids = np.unique(np.asarray(list(exclude_ids), dtype=np.int64))
+    else:
+        exclude_ids = None
+
+    if query_ids is not None:
+        query_ids = np.asarray(query_ids, dtype=np.int64)
+
+    results = []
+
+    # For each chunk of queries...
+    for q_start in range(0, query_vecs.shape[0], chunksize):
+        q_end = min(q_start + chunksize, query_vecs.shape[0])
+        chunk = query_vecs[q_start:q_end]
+
+        # The best results seen so far for each query in the chunk.
+        best_ids = np.zeros((q_end - q_start, 0), dtype=np.int64)
+        best_sims = np.zeros((q_end - q_start, 0), dtype=np.float32)
+
+        # For each block of documents...
+        for d_start in range(0, num_docs, block_size):
+            d_end = min(d_start + block_size, num_docs)
+
+            # Score the whole chunk of queries against this block;
+            # [num_queries x num_block_docs]
+            sims = score_block(chunk, d_start, d_end)
+
+            # Remove the filtered out documents in this block from contention.
+            if mask is not None:
+                sims[:, ~mask[d_start:d_end]] = -np.inf
+
+            # Remove the excluded documents in this block from contention.
+            if exclude_ids is not None:
+                cols = exclude_ids[(exclude_ids >= d_start) & (exclude_ids < d_end)]
+                sims[:, cols - d_start] = -np.inf
+
+            # Remove each query document from its own results.
+            if query_ids is not None:
+                ids = query_ids[q_start:q_end]
+                rows = np.flatnonzero((ids >= d_start) & (ids < d_end))
+                sims[rows, ids[rows] - d_start] = -np.inf
+
+            # Select the top results within this block, and merge them with
+            # the best results from the previous blocks.
+            block_ids, block_sims = topNRows(sims, topn, offset=d_start)
+            best_ids, best_sims = mergeTopN(best_ids, best_sims,
+                                            block_ids, block_sims, topn)
+
+        # Sort the final results for each query.
+        results.extend(sortRows(best_ids, best_sims))
+
+    return results
+
+
+def makeFilterMask(num_docs, allow=None, deny=None):
+    """
+    Combine an allow-list and a deny-list of documents into a single boolean
+    mask over the corpus, True for each document which may be returned.
+
+    Each of `allow` and `deny` may be either a list (or array) of doc ids, or
+    a boolean array with one entry per document (such as one built by 
+    `KeySearch.getTagMask`). If `allow` is None, all documents are allowed.
+
+    Returns None if there is no filter.
+    """
+    if allow is None and deny is None:
+        return None
+
+    if allow is None:
+        mask = np.ones(num_docs, dtype=np.bool_)
+    else:
+        mask = _toMask(num_docs, allow)
+
+    if deny is not None:
+        mask &= ~_toMask(num_docs, deny)
+
+    return mask
+
+
+def countAllowed(num_docs, allow):
+    """
+    Return the number of documents let through by the allow-list `allow`
+    (doc ids or a boolean mask; see `makeFilterMask`).
+    """
+    if allow is None:
+        return num_docs
+
+    allow = np.asarray(allow)
+    if allow.dtype == np.bool_:
+        return int(np.count_nonzero(allow))
+
+    return len(np.unique(allow))
+
+
+def _toMask(num_docs, doc_filter):
+    """
+    Internal function which converts a list of doc ids to a boolean mask
+    (or copies a mask which was given).
+    """
+    doc_filter = np.asarray(doc_filter)
+
+    if doc_filter.dtype == np.bool_:
+        if len(doc_filter) != num_docs:
+            raise ValueError('Filter mask has %d entries, but there are %d '
+                             'documents' % (len(doc_filter), num_docs))
+        return doc_filter.copy()
+
+    mask = np.zeros(num_docs, dtype=np.bool_)
+    mask[doc_filter.astype(np.int64)] = True
+
+    return mask
+
+
+def recallAtN(exact_results, approx_results):
+    """
+    Measure how well a set of approximate search results agrees with the 
+    exact results.
+
+    Both arguments are lists with one entry per query, where each entry is a
+    list of (doc_id, similarity_value) tuples, as returned by the search
+    functions.
+
+    Returns the fraction of the exact results (averaged over the queries)
+    which also appear in the approximate results.
+    """
+    recalls = []
+    for (exact, approx) in zip(exact_results, approx_results):
+        if len(exact) == 0:
+            continue
+
+        exact_ids = set([doc_id for (doc_id, sim) in exact])
+        approx_ids = set([doc_id for (doc_id, sim) in approx])
+
+        recalls.append(len(exact_ids & approx_ids) / float(len(exact_ids)))
+
+    if len(recalls) == 0:
+        return 1.0
+
+    return float(np.mean(recalls))
+
+
+def fuseResults(result_lists, topn=10, method='rrf', weights=None, rrf_k=60):
+    """
+    Combine several ranked lists of results for the same query (e.g., from a
+    keyword search and a semantic search) into a single ranking.
+
+    Parameters:
+        result_lists  List of result lists, each a list of 
+                      (doc_id, score) tuples sorted best first.
+        topn          The number of results to return.
+        method        How to combine the lists:
+                        'rrf'    - Reciprocal rank fusion. Each list adds
+                                   weight / (rrf_k + rank) to a document's
+                                   score, so only the ranks matter and the
+                                   lists' scores don't need to be comparable.
+                        'linear' - Each list's scores are rescaled to the
+                                   range 0 - 1 (best = 1), and a document's 
+                                   score is the weighted sum.
+        weights       Optional weight for each list. Defaults to 1 each.
+        rrf_k         Rank offset for 'rrf'. Larger values give the lower
+                      ranked results more of a say.
+
+    Returns the results as a list of tuples in the form:
+        (doc_id, fused_score)
+    """
+    if method not in ('rrf', 'linear'):
+        raise ValueError('Unsupported fusion method \'%s\'' % method)
+
+    if weights is None:
+        weights = [1.0] * len(result_lists)
+
+    all_ids = []
+    all_scores = []
+
+    for (results, weight) in zip(result_lists, weights):
+        if len(results) == 0:
+            continue
+
+        ids = np.asarray([doc_id for (doc_id, score) in results], dtype=np.int64)
+        scores = np.asarray([score for (doc_id, score) in results], dtype=np.float64)
+
+        if method == 'rrf':
+            # Ranks start at 1.
+            scores = 1.0 / (rrf_k + np.arange(1, len(ids) + 1))
+        else:
+            low = scores.min()
+            high = scores.max()
+            if high > low:
+                scores = (scores - low) / (high - low)
+            else:
+                scores = np.ones(len(scores))
+
+        all_ids.append(ids)
+        all_scores.append(weight * scores)
+
+    if len(all_ids) == 0:
+        return []
+
+    # Add up the scores for each document.
+    doc_ids, inverse = np.unique(np.concatenate(all_ids), return_inverse=True)
+    fused = np.bincount(inverse, weights=np.concatenate(all_scores))
+
+    return topN(fused, topn, doc_ids=doc_ids)
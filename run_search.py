@@ -6,23 +6,31 @@ Created on Wed Feb 15 12:10:20 2017
 """
 from gensim import similarities
 from gensim import utils
+from ranking import topN
 import time
 import sys
 import operator
+import os
 
 # Load the Wikipedia LSI vectors.
-# This matrix is large (4.69 GB for me) and takes ~15 seconds to load.
-print 'Loading Wikipedia LSI index (15-30sec.)...'
+# This matrix is large (4.69 GB for me) and takes ~15 seconds to read into
+# memory. Memory-mapping it read-only (mmap='r') is nearly instant, and the
+# pages are read from disk as the search touches them.
+print 'Loading Wikipedia LSI index...'
 t0 = time.time()
 
-index = similarities.MatrixSimilarity.load('./data/lsi_index.mm')
+index = similarities.MatrixSimilarity.load('./data/lsi_index.mm', mmap='r')
 
 print '   Loading LSI vectors took %.2f seconds' % (time.time() - t0)
 
 # Load the article titles. These have the format (pageid, article title)
 print '\nLoading Wikipedia article titles...'
 
-id_to_titles = utils.unpickle('./data/bow.mm.metadata.cpickle')
+# (The single-pass build in wikibuild.py writes them alongside bow.csr.)
+if os.path.exists('./data/bow.csr.metadata.cpickle'):
+    id_to_titles = utils.unpickle('./data/bow.csr.metadata.cpickle')
+else:
+    id_to_titles = utils.unpickle('./data/bow.mm.metadata.cpickle')
 titles_to_id = utils.unpickle('./data/titles_to_id.pickle')
 
 # Name of the article to use as the input to the search.
@@ -47,11 +55,11 @@ print '    Similarity search took %.0f ms' % ((time.time() - t0) * 1000)
 
 t0 = time.time()
 
-# Sort in descending order.
-# `sims` is of type numpy.ndarray, so the sort() method is different...
-sims = sorted(enumerate(sims), key=lambda item: -item[1])
+# Select the top 10 results. Rather than sorting all ~4.2M similarities, this
+# only sorts the handful of largest values.
+sims = topN(sims, topn=10)
 
-print '    Sorting took %.2f seconds' % (time.time() - t0)
+print '    Selecting top results took %.0f ms' % ((time.time() - t0) * 1000)
 
 print '\nResults:'
 
@@ -7,13 +7,22 @@ Created on Wed Feb 22 14:19:43 2017
 
 from simsearch import SimSearch
 from keysearch import KeySearch
+from quantindex import QuantizedIndex
+from ivfindex import IVFIndex
+from shardindex import ShardedIndex
+from csrcorpus import CsrCorpus
+from tfidfcorpus import TfidfCorpus
+from invindex import InvertedIndex
+from titlestore import TitleStore, TitleIdMap
+from knngraph import KnnGraph
 
 from gensim.models import TfidfModel, LsiModel
-from gensim.corpora import Dictionary, MmCorpus
+from gensim.corpora import Dictionary
 from gensim.similarities import MatrixSimilarity
 from gensim import utils
 
 import time
+import os
 
 import sys
 
@@ -24,10 +33,28 @@ def fprint(msg):
     print(msg)
     sys.stdout.flush()
 
-def createSearchObjs():
+def createSearchObjs(mmap='r', warm_up=False, index_type='float32', 
+                     rescore=True, nprobe=32):
     """
     Creates the SimSearch and KeySearch objects using the data structures
     created in `make_wikicorpus.py`.
+    
+    By default, the LSI index and projection matrix are memory-mapped 
+    read-only (mmap='r') rather than read into memory. Pass mmap=None to load
+    them fully into memory instead. Set `warm_up` to read through the mapped
+    pages before returning, so that the first searches aren't slowed down by
+    disk reads.
+    
+    Set `index_type` to 'float16' or 'int8' to search one of the compressed
+    LSI indexes from step 7 of `make_wikicorpus.py`. With `rescore`, the 
+    top candidates are re-scored using the (memory-mapped) 32-bit index.
+    
+    Set `index_type` to 'ivf' to use the approximate search index from step
+    8, searching the `nprobe` nearest clusters for each query.
+    
+    Set `index_type` to 'sharded' if step 6 wrote the LSI vectors as shards.
+    The shards are memory-mapped and searched in parallel.
+    
     Returns (simsearch, keysearch, titles_to_id)
     """
     
@@ -35,13 +62,24 @@ def createSearchObjs():
     fprint('Loading Wikipedia article titles...')
     t0 = time.time()
     
-    id_to_titles = utils.unpickle('./data/bow.mm.metadata.cpickle')
-    titles_to_id = utils.unpickle('./data/titles_to_id.pickle')
+    # The title store is memory-mapped, so this is instant, and it can look
+    # up articles by title as well (see titlestore.py).
+    if os.path.exists('./data/titles.store'):
+        titles = TitleStore('./data/titles.store')
+        titles_to_id = TitleIdMap(titles)
+    else:
+        # The single-pass build (see wikibuild.py) writes the titles 
+        # alongside bow.csr instead.
+        if os.path.exists('./data/bow.csr.metadata.cpickle'):
+            id_to_titles = utils.unpickle('./data/bow.csr.metadata.cpickle')
+        else:
+            id_to_titles = utils.unpickle('./data/bow.mm.metadata.cpickle')
+        titles_to_id = utils.unpickle('./data/titles_to_id.pickle')
 
-    # id_to_titles is actually a map of indeces to (pageid, article title)
-    # The 'pageid' property is unused.
-    # Convert id_to_titles into a simple list of titles.
-    titles = [item[1][1] for item in id_to_titles.items()]
+        # id_to_titles is actually a map of indeces to (pageid, article title)
+        # The 'pageid' property is unused.
+        # Convert id_to_titles into a simple list of titles.
+        titles = [item[1][1] for item in id_to_titles.items()]
     
     fprint('    Took %.2f seconds' % (time.time() - t0))        
     
@@ -61,19 +99,32 @@ def createSearchObjs():
     
     fprint('    Took %.2f seconds' % (time.time() - t0))        
     
-    # We must not use `load`--that would attempt to load the corpus into 
-    # memory, and it's 16.7 GB!!
-    #corpus_tfidf = MmCorpus.load('./data/corpus_tfidf.mm')
-    
+    # The corpus is far too big to load into memory. The CSR files are
+    # memory-mapped instead, so this is instant and looking up a document is
+    # just a slice of the arrays. The tf-idf vectors aren't stored; they're
+    # computed from the bag-of-words vectors as they're read. (Builds from
+    # before this stored the tf-idf vectors in `corpus_tfidf.csr`.)
     fprint('\nCreating tf-idf corpus object (leaves the vectors on disk)...')
     t0 = time.time()
     
-    corpus_tfidf = MmCorpus('./data/corpus_tfidf.mm')
+    if os.path.exists('./data/bow.csr'):
+        corpus_tfidf = TfidfCorpus(CsrCorpus('./data/bow.csr'), tfidf_model)
+    else:
+        corpus_tfidf = CsrCorpus('./data/corpus_tfidf.csr')
     
     fprint('    Took %.2f seconds' % (time.time() - t0))            
     
+    # Memory-map the inverted index for keyword search, if it's been built
+    # (step 9 of `make_wikicorpus.py`).
+    if os.path.exists('./data/corpus_tfidf.invindex'):
+        inv_index = InvertedIndex.load('./data/corpus_tfidf.invindex', mmap='r')
+    else:
+        inv_index = None
+    
     # Create the KeySearch and SimSearch objects.    
-    ksearch = KeySearch(dictionary, tfidf_model, corpus_tfidf, titles)
+    # Tokenize new text the same way the articles were (by WikiCorpus).
+    ksearch = KeySearch(dictionary, tfidf_model, corpus_tfidf, titles, 
+                        inv_index=inv_index, tokenizer='wiki')
     simsearch = SimSearch(ksearch)
     
     # TODO - SimSearch doesn't currently have a clean way to provide the index
@@ -81,21 +132,51 @@ def createSearchObjs():
     
     fprint('\nLoading LSI model...')
     t0 = time.time()    
-    simsearch.lsi = LsiModel.load('./data/lsi.lsi_model')
+    simsearch.lsi = LsiModel.load('./data/lsi.lsi_model', mmap=mmap)
     
     fprint('    Took %.2f seconds' % (time.time() - t0))        
     
-    # Load the Wikipedia LSI vectors into memory.
-    # The matrix is 4.69GB for me, and takes ~15 seconds on my machine to load.
+    # Load the Wikipedia LSI vectors.
+    # The matrix is 4.69GB for me. Reading it into memory takes ~15 seconds on
+    # my machine, while memory-mapping it takes about a second. Memory-mapped,
+    # the vectors live in the OS page cache, so several search processes on
+    # the same machine share one copy of them.
     fprint('\nLoading Wikipedia LSI index...')
     t0 = time.time()
         
-    simsearch.index = MatrixSimilarity.load('./data/lsi_index.mm')
+    if index_type == 'float32':
+        simsearch.index = MatrixSimilarity.load('./data/lsi_index.mm', mmap=mmap)
+    elif index_type == 'sharded':
+        simsearch.index = ShardedIndex.load('./data/lsi_index.shards', mmap=mmap)
+    elif index_type == 'ivf':
+        simsearch.index = IVFIndex.load('./data/lsi_index.ivf', mmap=mmap)
+        simsearch.index.nprobe = nprobe
+    else:
+        simsearch.index = QuantizedIndex.load('./data/lsi_index_%s.qi' % index_type, mmap=mmap)
+        
+        # Only the shortlisted rows of the 32-bit index are read for 
+        # re-scoring, so it's always memory-mapped.
+        if rescore:
+            exact_index = MatrixSimilarity.load('./data/lsi_index.mm', mmap='r')
+            simsearch.index.setExactVectors(exact_index.index)
     
     fprint('    Took %.2f seconds' % (time.time() - t0))    
 
-    # TODO - It would be interesting to try the 'Similarity' class which 
-    #       shards the dataset on disk for you...
+    # Load the precomputed neighbours of every article, if they've been built
+    # (step 10 of `make_wikicorpus.py`), so that `findSimilarToDoc` is just a
+    # table lookup.
+    if os.path.exists('./data/lsi_index.knn'):
+        simsearch.knn_graph = KnnGraph('./data/lsi_index.knn', mmap=mmap)
+
+    # Optionally, read through the memory-mapped pages now rather than 
+    # during the first few searches.
+    if mmap and warm_up:
+        fprint('\nWarming up the memory-mapped index...')
+        t0 = time.time()
+        
+        num_bytes = simsearch.warmUp()
+        
+        fprint('    Read %.2f GB in %.2f seconds' % (num_bytes / 2.0**30, time.time() - t0))
 
     return (simsearch, ksearch, titles_to_id)
 
@@ -111,7 +192,8 @@ def example1(simsearch, ksearch, titles_to_id):
     t0 = time.time()
     
     # Search for the top 10 most similar Wikipedia articles to the query.
-    # This takes about 12 seconds on my machine, mostly in the sorting step.
+    # Only the top results are sorted, so nearly all of the time here is in
+    # the similarity calculation itself.
     results = simsearch.findSimilarToDoc(titles_to_id[query_article], topn=10)
     simsearch.printResultsByTitle(results)
     
@@ -194,17 +276,18 @@ def example3(simsearch, ksearch, titles_to_id):
 
 # ======== main ========
 # Entry point to the script.
+if __name__ == '__main__':
+    # Load the corpus, model, etc.
+    # With the LSI index memory-mapped, this takes a few seconds on my machine (I
+    # have an SSD). Reading the index fully into memory instead takes about 15
+    # seconds and requires at least 5GB of RAM.
+    simsearch, ksearch, titles_to_id = createSearchObjs()
 
-# Load the corpus, model, etc.
-# This takes about 15 second on my machine (I have an SSD), and requires at
-# least 5GB of RAM.
-simsearch, ksearch, titles_to_id = createSearchObjs()
-
-# Search for articles similar to 'Topic model'
-example1(simsearch, ksearch, titles_to_id)
+    # Search for articles similar to 'Topic model'
+    example1(simsearch, ksearch, titles_to_id)
 
-# Search for articles similar to one of my blog posts.
-#example2(simsearch, ksearch, titles_to_id)
+    # Search for articles similar to one of my blog posts.
+    #example2(simsearch, ksearch, titles_to_id)
 
-# Display and record the top words for each topic.
-#example3(simsearch, ksearch, titles_to_id)
+    # Display and record the top words for each topic.
+    #example3(simsearch, ksearch, titles_to_id)
@@ -0,0 +1,514 @@
+# -*- coding: utf-8 -*-
+"""
+A long-running search server, which loads the Wikipedia search objects once
+(see `createSearchObjs` in searchWithSimSearch.py) and answers searches over
+HTTP, with JSON responses. It only listens on localhost.
+
+Endpoints (GET, with the parameters in the query string):
+    /similar_to_doc   id=<doc id> or title=<article title>, topn=10
+    /similar_to_text  text=<query text>, topn=10
+    /keyword          text=<query text>, topn=10 for a ranked (BM25) search,
+                      or include=<word,word,...>, exclude=<word,...> for a
+                      boolean search.
+    /explain          id=<doc id>, title=<article title> or text=<text>,
+                      topn=10, words=5. Runs the search and lists the words
+                      which contributed most to each result.
+    /stats            Latency percentiles for each endpoint, batching and
+                      queue statistics, and cache statistics.
+The text endpoints also accept a POST with a JSON object of the parameters.
+
+Search results are returned as:
+    {"results": [{"doc_id": 123, "title": "...", "score": 0.87}, ...],
+     "took_ms": 12.3}
+
+Micro-batching
+==============
+Scoring a single query against the ~4.2M rows of the index reads the whole
+index, and most of the time goes to the memory traffic rather than the
+arithmetic. Scoring several queries at once, with a matrix-matrix product,
+costs little more than scoring one. So the server doesn't run each search
+as soon as it arrives: the `MicroBatcher` collects the searches which arrive
+within a short window (`max_wait`, a few milliseconds) and scores them
+together with one call to `SimSearch._searchLsiVectors`. Under load, the
+requests share the scans of the index; when idle, a search is only delayed by
+the window.
+
+Each request is handled on its own thread (the asyncio library isn't
+available in Python 2), and waits for its batch to finish. The batches are
+run on a single worker thread.
+"""
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from collections import deque
+import numpy as np
+import threading
+import logging
+import urlparse
+import Queue
+import json
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class LatencyStats(object):
+    """
+    Records the durations of the most recent `max_samples` events, for
+    reporting percentiles. It's safe to use from multiple threads.
+    """
+
+    def __init__(self, max_samples=10000):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            self.count += 1
+
+    def getStats(self):
+        """
+        Return the number of events, and the mean, median (p50), p99, and
+        maximum of the recent durations in milliseconds, as a dictionary.
+        """
+        with self.lock:
+            samples = np.asarray(self.samples) * 1000.0
+            count = self.count
+
+        if len(samples) == 0:
+            return {'count': count}
+
+        return {'count': count, 'mean_ms': float(np.mean(samples)),
+                'p50_ms': float(np.percentile(samples, 50)),
+                'p99_ms': float(np.percentile(samples, 99)),
+                'max_ms': float(np.max(samples))}
+
+
+class _BatchRequest(object):
+    """
+    Internal record of one search waiting in the MicroBatcher's queue.
+    """
+
+    def __init__(self, query_vec, topn, query_id):
+        self.query_vec = query_vec
+        self.topn = topn
+        self.query_id = query_id
+        self.queued_time = time.time()
+
+        self.results = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher(object):
+    """
+    Combines the searches arriving from concurrent threads into batches,
+    which are each scored against the index in one pass.
+
+    Attach it to a SimSearch (`simsearch.batcher = MicroBatcher(simsearch)`)
+    and unfiltered searches are routed through it (see
+    `SimSearch._searchOne`).
+    """
+
+    def __init__(self, simsearch, max_batch=64, max_wait=0.005):
+        """
+        Parameters:
+            simsearch  The SimSearch to run the searches on.
+            max_batch  The largest number of searches to score at once.
+            max_wait   How long (in seconds) to wait for more searches to
+                       arrive after the first one in a batch.
+        """
+        self.simsearch = simsearch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.queue = Queue.Queue()
+
+        # Statistics.
+        self.num_batches = 0
+        self.num_queries = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=10000)
+        self.queue_depths = deque(maxlen=10000)
+        self.queue_latency = LatencyStats()
+        self.batch_latency = LatencyStats()
+        self.stats_lock = threading.Lock()
+
+        self.thread = threading.Thread(target=self._run, name='MicroBatcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def search(self, query_vec, topn=10, query_id=None):
+        """
+        Find the `topn` most similar documents to the normalized LSI vector
+        `query_vec`, leaving out the document `query_id` (if given). Blocks
+        until the search's batch has been run.
+
+        Returns the results as a list of tuples in the form:
+            (doc_id, similarity_value)
+        """
+        request = _BatchRequest(np.asarray(query_vec, dtype=np.float32), topn,
+                                query_id)
+
+        self.queue.put(request)
+
+        request.done.wait()
+
+        if request.error is not None:
+            raise request.error
+
+        return request.results
+
+    def _collectBatch(self):
+        """
+        Internal function which waits for a search to arrive, then collects
+        any more which arrive within `max_wait`, up to `max_batch`.
+        """
+        batch = [self.queue.get()]
+
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.time()
+
+            try:
+                if remaining > 0:
+                    batch.append(self.queue.get(timeout=remaining))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+
+        return batch
+
+    def _run(self):
+        """
+        Internal function which runs the batches, on the worker thread.
+        """
+        while True:
+            batch = self._collectBatch()
+
+            t0 = time.time()
+
+            with self.stats_lock:
+                # The searches still waiting behind this batch.
+                depth = self.queue.qsize()
+                self.queue_depths.append(depth)
+                self.max_queue_depth = max(self.max_queue_depth, depth + len(batch))
+
+            for request in batch:
+                self.queue_latency.add(t0 - request.queued_time)
+
+            try:
+                self._runBatch(batch)
+            except Exception as e:
+                logger.exception('batch of %d searches failed', len(batch))
+
+                for request in batch:
+                    request.error = e
+
+            self.batch_latency.add(time.time() - t0)
+
+            with self.stats_lock:
+                self.num_batches += 1
+                self.num_queries += len(batch)
+                self.batch_sizes.append(len(batch))
+
+            for request in batch:
+                request.done.set()
+
+    def _runBatch(self, batch):
+        """
+        Internal function which scores a batch of searches against the index
+        in one pass.
+        """
+        query_vecs = np.vstack([request.query_vec for request in batch])
+
+        # Run every search for the largest `topn` in the batch, plus one, so
+        # that each query document can be removed from its own results
+        # afterwards. (The top N results excluding a document are the top
+        # N + 1, with that document removed.)
+        topn = max(request.topn for request in batch) + 1
+
+        results = self.simsearch._searchLsiVectors(query_vecs, topn)
+
+        for (request, result) in zip(batch, results):
+            if request.query_id is not None:
+                result = [(doc_id, sim) for (doc_id, sim) in result
+                          if doc_id != request.query_id]
+
+            request.results = result[0:request.topn]
+
+    def getStats(self):
+        """
+        Return the batching statistics as a dictionary.
+        """
+        with self.stats_lock:
+            batch_sizes = np.asarray(self.batch_sizes)
+            queue_depths = np.asarray(self.queue_depths)
+
+            stats = {'batches': self.num_batches, 'queries': self.num_queries,
+                     'queue_depth': self.queue.qsize(),
+                     'max_queue_depth': self.max_queue_depth}
+
+        if len(batch_sizes) > 0:
+            stats['mean_batch_size'] = float(np.mean(batch_sizes))
+            stats['max_batch_size'] = int(np.max(batch_sizes))
+            stats['mean_queue_depth'] = float(np.mean(queue_depths))
+            stats['p99_queue_depth'] = float(np.percentile(queue_depths, 99))
+
+        stats['queue_wait'] = self.queue_latency.getStats()
+        stats['batch_time'] = self.batch_latency.getStats()
+
+        return stats
+
+
+class SearchService(object):
+    """
+    The search operations behind the HTTP endpoints. Each takes a dictionary
+    of the request parameters and returns a dictionary for the JSON
+    response. Bad parameters raise a ValueError or KeyError.
+    """
+
+    def __init__(self, simsearch, ksearch, titles_to_id, max_batch=64,
+                 max_wait=0.005):
+        self.simsearch = simsearch
+        self.ksearch = ksearch
+        self.titles_to_id = titles_to_id
+
+        self.batcher = MicroBatcher(simsearch, max_batch, max_wait)
+        self.simsearch.batcher = self.batcher
+
+        self.endpoints = {'/similar_to_doc': self.similarToDoc,
+                          '/similar_to_text': self.similarToText,
+                          '/keyword': self.keyword,
+                          '/explain': self.explain,
+                          '/stats': self.stats}
+
+        self.latency = dict((path, LatencyStats()) for path in self.endpoints)
+
+        self.start_time = time.time()
+
+    def handle(self, path, params):
+        """
+        Run the endpoint at `path` with the request parameters `params`.
+
+        Returns the response dictionary, or None if there's no such endpoint.
+        """
+        if path not in self.endpoints:
+            return None
+
+        t0 = time.time()
+
+        response = self.endpoints[path](params)
+
+        elapsed = time.time() - t0
+        self.latency[path].add(elapsed)
+
+        response['took_ms'] = elapsed * 1000.0
+
+        return response
+
+    def _getInt(self, params, name, default):
+        """
+        Internal function which reads an integer parameter.
+        """
+        value = int(params.get(name, default))
+
+        if value < 0:
+            raise ValueError('%s must not be negative' % name)
+
+        return value
+
+    def _getDocId(self, params):
+        """
+        Internal function which reads the document to search on, given as
+        either `id` or `title`.
+        """
+        if 'id' in params:
+            doc_id = int(params['id'])
+        elif 'title' in params:
+            doc_id = self.titles_to_id[params['title']]
+        else:
+            raise ValueError('specify the document as id or title')
+
+        if doc_id < 0 or doc_id >= len(self.simsearch.index):
+            raise ValueError('doc id %d out of range' % doc_id)
+
+        return doc_id
+
+    def _formatResults(self, results):
+        """
+        Internal function which converts a list of (doc_id, score) tuples to
+        a list of dictionaries, with the titles.
+        """
+        return [{'doc_id': int(doc_id), 'title': self.ksearch.titles[doc_id],
+                 'score': float(score)} for (doc_id, score) in results]
+
+    def similarToDoc(self, params):
+        doc_id = self._getDocId(params)
+
+        results = self.simsearch.findSimilarToDoc(doc_id, self._getInt(params, 'topn', 10))
+
+        return {'results': self._formatResults(results)}
+
+    def similarToText(self, params):
+        results = self.simsearch.findSimilarToText(params['text'], self._getInt(params, 'topn', 10))
+
+        return {'results': self._formatResults(results)}
+
+    def keyword(self, params):
+        # Boolean search.
+        if 'include' in params or 'exclude' in params:
+            includes = [word for word in params.get('include', '').split(',') if word]
+            excludes = [word for word in params.get('exclude', '').split(',') if word]
+
+            doc_ids = self.ksearch.keywordSearch(includes, excludes)
+
+            topn = self._getInt(params, 'topn', len(doc_ids))
+
+            return {'num_matches': len(doc_ids),
+                    'results': [{'doc_id': int(doc_id), 'title': self.ksearch.titles[doc_id]}
+                                for doc_id in doc_ids[0:topn]]}
+
+        # Ranked search.
+        results = self.ksearch.rankedKeywordSearch(params['text'], self._getInt(params, 'topn', 10))
+
+        return {'results': self._formatResults(results)}
+
+    def explain(self, params):
+        topn = self._getInt(params, 'topn', 10)
+
+        if 'text' in params:
+            input_tfidf = self.simsearch.getTfidfForText(params['text'])
+            results = self.simsearch.findSimilarToVector(input_tfidf, topn)
+        else:
+            doc_id = self._getDocId(params)
+            input_tfidf = self.ksearch.corpus_tfidf[doc_id]
+            results = self.simsearch.findSimilarToDoc(doc_id, topn)
+
+        explanations = self.simsearch.explainResults(input_tfidf, results,
+                                                     self._getInt(params, 'words', 5))
+
+        response = self._formatResults(results)
+
+        for (result, (doc_id, pos_words, neg_words)) in zip(response, explanations):
+            result['positive_words'] = [[word, float(sim)] for (word, sim) in pos_words]
+            result['negative_words'] = [[word, float(sim)] for (word, sim) in neg_words]
+
+        return {'results': response}
+
+    def stats(self, params):
+        return {'uptime_s': time.time() - self.start_time,
+                'latency': dict((path[1:], stats.getStats())
+                                for (path, stats) in self.latency.items()),
+                'batching': self.batcher.getStats(),
+                'caches': self.simsearch.getCacheStats()}
+
+
+class SearchRequestHandler(BaseHTTPRequestHandler):
+    """
+    Parses the HTTP requests, and passes them to the server's SearchService.
+    """
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+
+        # Keep the last value of each parameter.
+        params = dict((name, values[-1]) for (name, values)
+                      in urlparse.parse_qs(url.query).items())
+
+        self._respond(url.path, params)
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+
+        try:
+            length = int(self.headers.getheader('content-length', 0))
+            params = json.loads(self.rfile.read(length) or '{}')
+
+            if not isinstance(params, dict):
+                raise ValueError('expected a JSON object')
+        except ValueError as e:
+            self._sendJson(400, {'error': 'bad request body: %s' % e})
+            return
+
+        self._respond(url.path, params)
+
+    def _respond(self, path, params):
+        try:
+            response = self.server.service.handle(path, params)
+        except (ValueError, KeyError, IndexError) as e:
+            self._sendJson(400, {'error': '%s: %s' % (type(e).__name__, e)})
+            return
+        except Exception as e:
+            logger.exception('error handling %s', self.path)
+            self._sendJson(500, {'error': str(e)})
+            return
+
+        if response is None:
+            self._sendJson(404, {'error': 'unknown endpoint %s' % path})
+        else:
+            self._sendJson(200, response)
+
+    def _sendJson(self, status, response):
+        body = json.dumps(response)
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class SearchServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server which handles each request on its own thread.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, service, host='127.0.0.1', port=8080):
+        HTTPServer.__init__(self, (host, port), SearchRequestHandler)
+        self.service = service
+
+
+if __name__ == '__main__':
+    from searchWithSimSearch import createSearchObjs
+
+    logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s',
+                        level=logging.INFO)
+
+    # The server only listens on localhost.
+    host = '127.0.0.1'
+    port = 8080
+
+    # Which LSI index to search (see `createSearchObjs`).
+    index_type = 'float32'
+
+    # Searches which arrive within `max_wait` seconds of each other are
+    # scored together, up to `max_batch` at a time.
+    max_batch = 64
+    max_wait = 0.005
+
+    # Load everything once, and read through the memory-mapped index so
+    # that the first searches aren't slowed down by disk reads.
+    simsearch, ksearch, titles_to_id = createSearchObjs(warm_up=True, index_type=index_type)
+
+    service = SearchService(simsearch, ksearch, titles_to_id, max_batch, max_wait)
+
+    server = SearchServer(service, host, port)
+
+    logger.info('serving searches on http://%s:%d/', host, port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
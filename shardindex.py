@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+A sharded, on-disk version of the LSI index, for use in place of a gensim
+MatrixSimilarity.
+
+A MatrixSimilarity holds the entire [num_docs x num_topics] matrix in a
+single array, so the whole thing has to fit in one process's memory.
+ShardedIndex instead splits the LSI vectors into fixed-size shards, each
+stored in its own .npy file. The shards are memory-mapped, so the corpus can
+be larger than the available RAM; the OS pages them in as they're searched.
+
+To perform a search, every shard is scanned in parallel on a pool of
+threads. Each thread keeps just the top results for its own shard, and these
+are merged at the end. numpy releases the GIL during the matrix products, so
+one query makes use of all of the cores. (For the best performance, limit
+BLAS to a single thread per shard, e.g. by setting OMP_NUM_THREADS=1.)
+"""
+
+from gensim import utils, matutils
+from multiprocessing.pool import ThreadPool
+from multiprocessing import cpu_count
+from ranking import topN, blockedTopN
+import numpy as np
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedIndex(utils.SaveLoad):
+    """
+    Stores unit-length LSI vectors in fixed-size shards on disk, and searches
+    the shards in parallel.
+
+    The shard files are written alongside the index file as:
+        [fname].shard000.npy, [fname].shard001.npy, ...
+    """
+
+    # These are set up when the index is loaded, and are not saved.
+    shards = None
+    pool = None
+
+    def __init__(self, fname, corpus_lsi, num_features, shard_size=262144,
+                 chunksize=10000):
+        """
+        Build the index from `corpus_lsi`, a stream of sparse LSI vectors
+        (e.g., `model_lsi[corpus_tfidf]`), writing out each shard as soon as
+        it fills up. Only one shard is ever held in memory.
+
+        The index is saved to `fname`, and is ready to use.
+
+        Parameters:
+            num_features  The number of LSI topics.
+            shard_size    The number of documents per shard.
+            chunksize     The number of documents to convert at once.
+        """
+        self.num_features = num_features
+        self.shard_size = shard_size
+        self.shard_fnames = []
+        self.shard_offsets = [0]
+        self.num_threads = None
+
+        # The directory holding the shard files.
+        self.dirname = os.path.dirname(os.path.abspath(fname))
+
+        # The shard currently being filled.
+        shard = np.empty((shard_size, num_features), dtype=np.float32)
+        shard_len = 0
+
+        for chunk in utils.grouper(corpus_lsi, chunksize):
+
+            # Convert the chunk to dense vectors, one per row, and normalize
+            # them to unit length.
+            vecs = np.asarray(matutils.corpus2dense(chunk, num_features).T, dtype=np.float32)
+            norms = np.sqrt(np.sum(vecs ** 2, axis=1))
+            norms[norms == 0] = 1.0
+            vecs /= norms[:, np.newaxis]
+
+            # Copy the vectors into the shard, writing the shard out whenever
+            # it fills up.
+            start = 0
+            while start < vecs.shape[0]:
+                count = min(vecs.shape[0] - start, shard_size - shard_len)
+                shard[shard_len:shard_len + count] = vecs[start:start + count]
+                shard_len += count
+                start += count
+
+                if shard_len == shard_size:
+                    self._writeShard(fname, shard, shard_len)
+                    shard_len = 0
+
+        # Write out the final, partial shard.
+        if shard_len > 0:
+            self._writeShard(fname, shard, shard_len)
+
+        self.num_docs = self.shard_offsets[-1]
+
+        self.save(fname)
+
+    @classmethod
+    def fromVectors(cls, fname, vectors, shard_size=262144):
+        """
+        Build a sharded index from an existing [num_docs x num_features]
+        array of unit-length vectors, such as the `index` property of a
+        MatrixSimilarity.
+        """
+        # Wrap the rows as a stream of sparse vectors.
+        corpus = matutils.Dense2Corpus(vectors, documents_columns=False)
+
+        return cls(fname, corpus, vectors.shape[1], shard_size)
+
+    def _writeShard(self, fname, shard, shard_len):
+        """
+        Internal function which writes out the first `shard_len` rows of
+        `shard` as the next shard file.
+        """
+        shard_fname = '%s.shard%03d.npy' % (os.path.basename(fname), len(self.shard_fnames))
+
+        logger.info('writing %d documents to %s', shard_len, shard_fname)
+
+        np.save(os.path.join(self.dirname, shard_fname), shard[0:shard_len])
+
+        self.shard_fnames.append(shard_fname)
+        self.shard_offsets.append(self.shard_offsets[-1] + shard_len)
+
+    def _openShards(self, mmap='r'):
+        """
+        Internal function which opens (or memory-maps) all of the shard
+        files.
+        """
+        self.shards = [np.load(os.path.join(self.dirname, shard_fname), mmap_mode=mmap)
+                       for shard_fname in self.shard_fnames]
+
+    def _getShards(self):
+        """
+        Internal function which returns the list of shards, memory-mapping
+        them first if they haven't been opened yet.
+        """
+        if self.shards is None:
+            self._openShards(mmap='r')
+
+        return self.shards
+
+    def __len__(self):
+        return self.num_docs
+
+    def getVectors(self, doc_ids):
+        """
+        Return the LSI vectors for the specified documents.
+        """
+        doc_ids = np.asarray(doc_ids)
+        vecs = np.empty((len(doc_ids), self.num_features), dtype=np.float32)
+
+        # Look up which shard each document is in.
+        shard_ids = np.searchsorted(self.shard_offsets, doc_ids, side='right') - 1
+
+        shards = self._getShards()
+        for s in np.unique(shard_ids):
+            rows = np.flatnonzero(shard_ids == s)
+            vecs[rows] = shards[s][doc_ids[rows] - self.shard_offsets[s]]
+
+        return vecs
+
+    def findTopN(self, query_vecs, topn=10, query_ids=None, exclude_ids=None,
+                 mask=None):
+        """
+        Find the `topn` most similar documents for each of the normalized LSI
+        vectors in `query_vecs` (one per row), scanning all of the shards in
+        parallel.
+
+        See `SimSearch.findSimilarToVectorsBatch` for the parameters.
+        `mask` is an optional boolean array over all of the documents; only
+        the documents marked True can appear in the results.
+
+        Returns a list with one entry per query; each entry is a list of
+        tuples in the form:
+            (doc_id, similarity_value)
+        """
+        query_vecs = np.asarray(query_vecs, dtype=np.float32)
+
+        if query_ids is not None:
+            query_ids = np.asarray(query_ids, dtype=np.int64)
+
+        if exclude_ids is not None and len(exclude_ids) > 0:
+            exclude_ids = np.asarray(list(exclude_ids), dtype=np.int64)
+        else:
+            exclude_ids = None
+
+        shards = self._getShards()
+
+        def searchShard(s):
+            """
+            Find the top results within shard `s`.
+            """
+            shard = shards[s]
+            offset = self.shard_offsets[s]
+
+            def scoreBlock(vecs, start, end):
+                return np.dot(vecs, shard[start:end].T)
+
+            # Translate the doc ids into positions within this shard. Any ids
+            # which fall outside of the shard are simply ignored.
+            shard_query_ids = None
+            if query_ids is not None:
+                shard_query_ids = query_ids - offset
+
+            shard_exclude_ids = None
+            if exclude_ids is not None:
+                shard_exclude_ids = exclude_ids - offset
+
+            shard_mask = None
+            if mask is not None:
+                shard_mask = mask[offset:offset + shard.shape[0]]
+
+            return blockedTopN(scoreBlock, shard.shape[0], query_vecs, topn,
+                               shard_query_ids, shard_exclude_ids, 
+                               mask=shard_mask)
+
+        # Create the thread pool the first time it's needed.
+        if self.pool is None:
+            self.pool = ThreadPool(self.num_threads or cpu_count())
+
+        # Search all of the shards in parallel.
+        shard_results = self.pool.map(searchShard, range(0, len(shards)))
+
+        # Merge the results from each shard.
+        results = []
+        for i in range(0, query_vecs.shape[0]):
+            doc_ids = []
+            sims = []
+
+            for s in range(0, len(shards)):
+                for (doc_id, sim) in shard_results[s][i]:
+                    doc_ids.append(doc_id + self.shard_offsets[s])
+                    sims.append(sim)
+
+            results.append(topN(np.asarray(sims), topn, doc_ids=doc_ids))
+
+        return results
+
+    def save(self, fname, *args, **kwargs):
+        """
+        Save the index to disk. Only the list of shards is written here; the
+        shards themselves were written when the index was built.
+        """
+        # Set aside the open shards and the thread pool while saving.
+        asides = {}
+        for attrib in ['shards', 'pool']:
+            if attrib in self.__dict__:
+                asides[attrib] = self.__dict__.pop(attrib)
+        try:
+            super(ShardedIndex, self).save(fname, *args, **kwargs)
+        finally:
+            self.__dict__.update(asides)
+
+    @classmethod
+    def load(cls, fname, mmap='r', num_threads=None):
+        """
+        Load a saved index. By default the shards are memory-mapped; pass
+        mmap=None to read them all into memory instead.
+
+        `num_threads` is the number of shards to search at once, and defaults
+        to the number of cores.
+        """
+        index = super(ShardedIndex, cls).load(fname)
+
+        # The shards are kept in the same directory as the index file.
+        index.dirname = os.path.dirname(os.path.abspath(fname))
+        index.num_threads = num_threads
+        index._openShards(mmap)
+
+        return index
@@ -7,8 +7,18 @@ Created on Fri Oct 14 21:00:58 2016
 
 from gensim.models import LsiModel
 from gensim import similarities
+from gensim import matutils
+from gensim import utils
 from keysearch import KeySearch
+from deltaindex import DeltaIndex
+from knngraph import KnnGraph, buildKnnGraph
+from querycache import LRUCache, filterKey
+from ranking import topN, blockedTopN, fuseResults, makeFilterMask, countAllowed
+from scipy import sparse
 import numpy as np
+import mmap
+import glob
+import os
 
 class SimSearch(object):
     """
@@ -16,8 +26,62 @@ class SimSearch(object):
     conceptually similar text as the search query, as opposed to the typical 
     keyword-based approach. This technique is also referred to as semantic 
     search or concept search.    
+    
+    Filtering
+    =========
+    The search functions accept an optional `allow` list and `deny` list, to
+    restrict the results to a subset of the corpus. Each can be either a list
+    of doc ids, or a boolean array over the corpus (e.g., from 
+    `KeySearch.getTagMask`). When the allowed documents are a small part of
+    the corpus (less than `gather_fraction`), only their rows of the index 
+    are scored. Otherwise the whole index is scored, with the filtered out
+    documents removed before selecting the top results.
+    
+    Adding and Deleting Documents
+    =============================
+    New documents can be added to a built index with `addDocuments`. They're
+    projected onto the LSI space with the existing model, and searched along
+    with the rest of the index. Deleted documents (`deleteDocuments`) are 
+    left out of the results. Call `compact` now and then to remove them for
+    good; this re-numbers the remaining documents.
+    
+    Precomputed Neighbours
+    ======================
+    `buildKnnGraph` finds the most similar documents to every document ahead
+    of time (see knngraph.py). `findSimilarToDoc` then answers from that 
+    table, rather than scoring the whole index, whenever it can. Adding 
+    documents or compacting the index drops the table, since its neighbours
+    would be out of date.
+    
+    Caching
+    =======
+    SimSearch caches the tf-idf vectors of query text, the LSI vectors of 
+    tf-idf vectors, and the results of searches, each in a least-recently-
+    used cache with a budget of bytes (see `setCacheSizes` and querycache.py).
+    So a repeated search is answered without tokenizing, projecting, or 
+    scanning the index. The caches are cleared whenever `index` or `lsi` is 
+    replaced, and whenever documents are added or deleted through SimSearch.
     """
     
+    # The largest fraction of the corpus for which a filtered search scores
+    # just the allowed rows, rather than scanning the whole index.
+    gather_fraction = 0.1
+    
+    # The precomputed neighbours of every document (a KnnGraph), if built.
+    knn_graph = None
+    
+    # The default budgets for the caches, in bytes (see `setCacheSizes`).
+    text_cache_bytes = 16 * 2**20
+    lsi_cache_bytes = 16 * 2**20
+    results_cache_bytes = 32 * 2**20
+    
+    # An optional object which combines concurrent searches into batches 
+    # (see `_searchOne`).
+    batcher = None
+    
+    _index = None
+    _lsi = None
+    
     def __init__(self, key_search):
         """
         Initialize the SimSearch with a KeySearch object, which holds:
@@ -27,6 +91,114 @@ class SimSearch(object):
         
         """        
         self.ksearch = key_search
+        
+        self.text_cache = LRUCache(self.text_cache_bytes)
+        self.lsi_cache = LRUCache(self.lsi_cache_bytes)
+        self.results_cache = LRUCache(self.results_cache_bytes)
+    
+    @property
+    def index(self):
+        """
+        The LSI index. Replacing it clears the caches.
+        """
+        return self._index
+    
+    @index.setter
+    def index(self, index):
+        self._index = index
+        self.clearCaches()
+    
+    @property
+    def lsi(self):
+        """
+        The LSI model. Replacing it clears the caches.
+        """
+        return self._lsi
+    
+    @lsi.setter
+    def lsi(self, lsi):
+        self._lsi = lsi
+        self.clearCaches()
+    
+    def setCacheSizes(self, text_bytes=None, lsi_bytes=None, 
+                      results_bytes=None):
+        """
+        Set the budgets, in bytes, of the text -> tf-idf, tf-idf -> LSI, and
+        search results caches. Leave a size as None to keep it unchanged, or
+        set it to 0 to disable that cache.
+        """
+        if text_bytes is not None:
+            self.text_cache.resize(text_bytes)
+        if lsi_bytes is not None:
+            self.lsi_cache.resize(lsi_bytes)
+        if results_bytes is not None:
+            self.results_cache.resize(results_bytes)
+    
+    def clearCaches(self):
+        """
+        Empty all of the caches. This is done automatically when the index or
+        model is replaced, or documents are added or deleted through 
+        SimSearch; call it if you modify them some other way.
+        """
+        # The caches don't exist yet while the class attributes are set up.
+        for name in ['text_cache', 'lsi_cache', 'results_cache']:
+            if name in vars(self):
+                vars(self)[name].clear()
+    
+    def getCacheStats(self):
+        """
+        Return the hit and miss counts and sizes of the caches, as a 
+        dictionary of cache name ('text', 'lsi', 'results') -> statistics 
+        (see `LRUCache.getStats`).
+        """
+        return {'text': self.text_cache.getStats(),
+                'lsi': self.lsi_cache.getStats(),
+                'results': self.results_cache.getStats()}
+    
+    def getTfidfForText(self, text):
+        """
+        Convert `text` to a tf-idf vector with KeySearch, caching the result.
+        """
+        tfidf_vec = self.text_cache.get(text)
+        
+        if tfidf_vec is None:
+            tfidf_vec = self.ksearch.getTfidfForText(text)
+            self.text_cache.put(text, tfidf_vec)
+        
+        return tfidf_vec
+    
+    def getLsiVector(self, input_tfidf):
+        """
+        Project one tf-idf vector onto the LSI space (see `getLsiVectors`),
+        caching the result.
+        
+        Returns a [1 x num_topics] array. Don't modify it; it's shared with 
+        the cache.
+        """
+        key = tuple((int(word_id), float(weight)) for (word_id, weight) in input_tfidf)
+        
+        lsi_vec = self.lsi_cache.get(key)
+        
+        if lsi_vec is None:
+            lsi_vec = self.getLsiVectors([input_tfidf])
+            self.lsi_cache.put(key, lsi_vec)
+        
+        return lsi_vec
+    
+    def _getCachedResults(self, key, search):
+        """
+        Internal function which looks up the results for the search `key` in
+        the results cache, or runs `search()` and caches its results.
+        
+        Returns a copy of the results, so the caller is free to modify them.
+        """
+        results = self.results_cache.get(key)
+        
+        if results is None:
+            results = search()
+            self.results_cache.put(key, results)
+        
+        return list(results)
            
 
     def trainLSI(self, num_topics=100):
@@ -45,76 +217,405 @@ class SimSearch(object):
         self.index = similarities.MatrixSimilarity(self.lsi[self.ksearch.corpus_tfidf], num_features=num_topics) 
     
     
-    def findSimilarToVector(self, input_tfidf, topn=10, in_corpus=False):
+    def findSimilarToVector(self, input_tfidf, topn=10, in_corpus=False,
+                            allow=None, deny=None):
         """
         Find documents in the corpus similar to the provided document, 
         represented by its tf-idf vector 'input_tfidf'.
+        
+        `allow` and `deny` optionally filter the results (see the class
+        documentation).
         """
         
         # Find the most similar entries to the input tf-idf vector.
         #  1. Project it onto the LSI vector space.
-        #  2. Compare the LSI vector to the entire collection.
-        sims = self.index[self.lsi[input_tfidf]]        
-        
-        # Sort the similarities from largest to smallest.
-        # 'sims' becomes a list of tuples of the form: 
-        #    (doc_id, similarity_value)
-        sims = sorted(enumerate(sims), key=lambda item: -item[1])   
-
-        # Select just the top N results.
-        # If the input vector exists in the corpus, skip the first one since
-        # this will just be the document itself.
-        if in_corpus:        
-            # Select just the top N results, skipping the first one.
-            results = sims[1:1 + topn]    
+        #  2. Compare the LSI vector to the entire collection, and select just
+        #     the top N results, as a list of tuples of the form:
+        #       (doc_id, similarity_value)
+        query_vec = self.getLsiVector(input_tfidf)
+
+        # If the input vector exists in the corpus, skip the first result 
+        # since this will just be the document itself.
+        if in_corpus:
+            skip = 1
         else:
-            results = sims[0:topn] 
-                    
-        return results
+            skip = 0
+        
+        # Repeated searches are answered from the results cache. The LSI 
+        # vector is hashable, unlike the tf-idf vector, and identifies the 
+        # query just as well.
+        key = ('vector', query_vec.tostring(), topn, skip, filterKey(allow), 
+               filterKey(deny))
+        
+        return self._getCachedResults(key, lambda: 
+            self._searchOne(query_vec, topn, skip=skip, allow=allow, 
+                            deny=deny))
     
-    def findSimilarToVectors(self, input_tfidfs, exclude_ids=[], topn=10):
+    def findSimilarToVectors(self, input_tfidfs, exclude_ids=[], topn=10,
+                             allow=None, deny=None, negative_tfidfs=None,
+                             neg_weight=0.25):
         """
         Find documents similar to a collection of input vectors.        
         
-        Combines the similarity scores from multiple query vectors.
+        Combines the similarity scores from multiple query vectors. 
+        Optionally, `negative_tfidfs` are examples of what *not* to find;
+        documents similar to them are pushed down the results (see 
+        `_feedbackQuery`). The negative examples count `neg_weight` as much as
+        the positive ones.
         """
-        # Calculate the combined similarities for all input vectors.
-        sims_sum = []
-        
-        for input_vec in input_tfidfs:
+        # Project the positive and negative examples together, in one matrix
+        # product.
+        if negative_tfidfs is None:
+            vecs = self.getLsiVectors(input_tfidfs)
+            num_pos = vecs.shape[0]
+        elif sparse.issparse(input_tfidfs) or sparse.issparse(negative_tfidfs):
+            # Either may be a scipy sparse matrix or a list of sparse vectors,
+            # so put them both in matrix form before stacking them.
+            def toMatrix(tfidfs):
+                if sparse.issparse(tfidfs):
+                    return sparse.csr_matrix(tfidfs)
+                return matutils.corpus2csc(tfidfs, num_terms=self.lsi.num_terms).T
             
-            # Calculate the similarities between this and all other entries.
-            sims = self.index[self.lsi[input_vec]]
+            pos_tfidfs = toMatrix(input_tfidfs)
+            
+            vecs = self.getLsiVectors(sparse.vstack([pos_tfidfs, toMatrix(negative_tfidfs)]))
+            num_pos = pos_tfidfs.shape[0]
+        else:
+            vecs = self.getLsiVectors(list(input_tfidfs) + list(negative_tfidfs))
+            num_pos = len(input_tfidfs)
         
-            # Accumulate the similarities across all input vectors.
-            if len(sims_sum) == 0:
-                sims_sum = sims
-            else:
-                sims_sum = np.sum([sims, sims_sum], axis=0)
-                    
-        # Sort the combined similarities.
-        sims_sum = sorted(enumerate(sims_sum), key=lambda item: -item[1])
-
-        # Look through the results until we've gathered 'topn' results.
-        results = []      
-        for i in range(0, len(sims_sum)):
+        query_vec = self._feedbackQuery(vecs[0:num_pos], vecs[num_pos:], 
+                                        neg_weight)
+        
+        # Select the top results, leaving out anything in the exclude list.
+        return self._searchLsiVectors(query_vec[np.newaxis, :], topn, 
+                                      exclude_ids=exclude_ids,
+                                      allow=allow, deny=deny)[0]
+
+    def _feedbackQuery(self, pos_vecs, neg_vecs, neg_weight=0.25):
+        """
+        Internal function which combines positive and negative examples 
+        (normalized LSI vectors, one per row) into a single query vector, so
+        that searching on them all takes just one scan of the index.
+        
+        The combined score for a document is the sum of its similarities to
+        each of the positive examples. That's the same as its similarity to 
+        the sum of the positive vectors. With negative examples, this is the
+        Rocchio relevance feedback query:
+        
+            mean(pos_vecs) - neg_weight * mean(neg_vecs)
+        
+        scaled by the number of positive examples, so that the scores are 
+        still the sums of the similarities when there are no negatives.
+        """
+        query_vec = np.sum(pos_vecs, axis=0)
+        
+        if neg_vecs.shape[0] > 0 and neg_weight != 0:
+            scale = neg_weight * max(pos_vecs.shape[0], 1) / float(neg_vecs.shape[0])
+            query_vec -= scale * np.sum(neg_vecs, axis=0)
+        
+        return query_vec
+
+    def getLsiVectors(self, input_tfidfs):
+        """
+        Project a batch of tf-idf vectors onto the LSI vector space, all in
+        one sparse-times-dense matrix product.
+
+        `input_tfidfs` is either a list of sparse tf-idf vectors, or a scipy
+        sparse matrix with one row per document.
+
+        Returns a dense [num_docs x num_topics] array of LSI vectors which
+        have been normalized to unit length, so that they are directly
+        comparable to the rows of the index.
+        """
+        # Build a sparse [num_docs x num_terms] matrix of the inputs.
+        if sparse.issparse(input_tfidfs):
+            vecs = sparse.csr_matrix(input_tfidfs)
+        else:
+            vecs = matutils.corpus2csc(input_tfidfs,
+                                       num_terms=self.lsi.num_terms).T.tocsr()
+
+        # Project all of the vectors at once. This is the same calculation
+        # that `self.lsi[...]` performs for a single vector.
+        u = self.lsi.projection.u[:, 0:self.lsi.num_topics]
+        lsi_vecs = np.asarray(vecs.dot(u), dtype=np.float32)
+
+        # Normalize each vector to unit length. Empty vectors (e.g., text with
+        # no words in the dictionary) are left as all zeros.
+        norms = np.sqrt(np.sum(lsi_vecs ** 2, axis=1))
+        norms[norms == 0] = 1.0
+        lsi_vecs /= norms[:, np.newaxis]
+
+        return lsi_vecs
+
+    def getIndexVectors(self, doc_ids):
+        """
+        Return the normalized LSI vectors stored in the index for the 
+        specified documents, as a [len(doc_ids) x num_topics] array.
+        """
+        # The other index types (e.g., QuantizedIndex) look up their own
+        # vectors.
+        if hasattr(self.index, 'getVectors'):
+            return self.index.getVectors(doc_ids)
+        
+        return np.asarray(self.index.index[doc_ids])
+
+    def findSimilarToVectorsBatch(self, input_tfidfs, topn=10, query_ids=None,
+                                  exclude_ids=None, chunksize=1024,
+                                  block_size=32768, allow=None, deny=None):
+        """
+        Find the most similar documents for each of a batch of input vectors.
+
+        Unlike `findSimilarToVectors`, which combines its inputs into a single
+        query, this runs a separate search for every input vector. It's meant
+        for offline jobs which look up the neighbours of many documents.
+
+        All of the inputs are projected onto the LSI space in one step, and
+        then scored against the index with matrix-matrix products. The index
+        is processed in blocks of `block_size` documents, and the queries in
+        chunks of `chunksize`, so the memory required is only about
+        (chunksize x block_size) similarity values, no matter how many
+        queries or documents there are.
+
+        Parameters:
+            input_tfidfs  List of tf-idf vectors (or a sparse matrix with one
+                          row per query).
+            topn          The number of results to return for each query.
+            query_ids     If the inputs are documents in the corpus, their
+                          doc ids. Each query document will be left out of
+                          its own results.
+            exclude_ids   Doc ids to leave out of all of the results.
+            allow, deny   Optional filters (see the class documentation).
+
+        Returns a list with one entry per query; each entry is a list of
+        tuples in the form:
+            (doc_id, similarity_value)
+        """
+        # Project all of the queries onto the LSI space.
+        query_vecs = self.getLsiVectors(input_tfidfs)
+
+        # Pass the call down.
+        return self._searchLsiVectors(query_vecs, topn, query_ids, exclude_ids,
+                                      chunksize=chunksize, 
+                                      block_size=block_size,
+                                      allow=allow, deny=deny)
+
+    def _searchLsiVectors(self, query_vecs, topn=10, query_ids=None,
+                          exclude_ids=None, skip=0, chunksize=1024,
+                          block_size=32768, allow=None, deny=None):
+        """
+        Internal function which finds the top results for a batch of 
+        normalized LSI vectors.
+
+        `skip` is the number of leading results to drop from each query's 
+        results. See `findSimilarToVectorsBatch` for the other parameters.
+        """
+        num_docs = len(self.index)
+        
+        # Leave out any deleted documents.
+        deny = self.ksearch.addDeletedToDeny(deny)
+        
+        # If only a small part of the corpus is allowed, just score those 
+        # rows.
+        if allow is not None and countAllowed(num_docs, allow) <= self.gather_fraction * num_docs:
+            doc_ids = np.flatnonzero(makeFilterMask(num_docs, allow, deny))
             
-            # Get the doc id for this result.
-            doc_id = sims_sum[i][0]    
+            results = self._searchLsiVectorsInDocs(query_vecs, doc_ids, 
+                                                   topn + skip, query_ids,
+                                                   exclude_ids, chunksize, 
+                                                   block_size)
+        
+        # The other index types (e.g., QuantizedIndex) implement their own
+        # search.
+        elif hasattr(self.index, 'findTopN'):
+            results = self.index.findTopN(query_vecs, topn + skip, 
+                                          query_ids=query_ids, 
+                                          exclude_ids=exclude_ids,
+                                          mask=makeFilterMask(num_docs, allow, deny))
         
-            # If the result is not one of the inputs, and not in the exclude 
-            # list, it's a valid result.
-            if doc_id not in exclude_ids:
-                results.append(sims_sum[i])
+        # For a MatrixSimilarity, score the queries against the rows of the
+        # index with blocked matrix-matrix products.
+        else:
+            results = blockedTopN(self._scoreBlock, num_docs, 
+                                  query_vecs, topn + skip, query_ids, 
+                                  exclude_ids, chunksize, block_size,
+                                  makeFilterMask(num_docs, allow, deny))
+
+        if skip > 0:
+            results = [result[skip:] for result in results]
 
-            # Break when we've gathered 'topn' results.
-            if len(results) == topn:
-                break
-                
         return results
-   
+
+    def _searchOne(self, query_vec, topn=10, query_id=None, skip=0, 
+                   allow=None, deny=None):
+        """
+        Internal function which finds the top results for a single normalized
+        LSI vector (a [1 x num_topics] array), leaving out the document 
+        `query_id`.
+        
+        If a `batcher` has been attached (see searchserver.py), unfiltered 
+        searches are handed to it, so that searches from concurrent requests
+        can share one scan of the index.
+        """
+        if self.batcher is not None and skip == 0 and allow is None and deny is None:
+            return self.batcher.search(query_vec[0], topn, query_id)
+        
+        query_ids = None if query_id is None else [query_id]
+        
+        return self._searchLsiVectors(query_vec, topn, query_ids, skip=skip,
+                                      allow=allow, deny=deny)[0]
+    
+    def _searchLsiVectorsInDocs(self, query_vecs, doc_ids, topn=10, 
+                                query_ids=None, exclude_ids=None, 
+                                chunksize=1024, block_size=32768):
+        """
+        Internal function which finds the top results for a batch of 
+        normalized LSI vectors, considering only the documents `doc_ids`.
+        
+        Only the rows of the index for `doc_ids` are read and scored, so the
+        time taken depends on the number of documents, not the size of the
+        corpus. See `findSimilarToVectorsBatch` for the other parameters.
+        """
+        # Look up the rows in doc id order, which is friendlier to a 
+        # memory-mapped index.
+        doc_ids = np.unique(np.asarray(doc_ids, dtype=np.int64))
+        
+        if len(doc_ids) == 0:
+            return [[] for i in range(0, query_vecs.shape[0])]
+        
+        # Score a block of the rows at a time.
+        def scoreBlock(vecs, start, end):
+            return np.dot(vecs, self.getIndexVectors(doc_ids[start:end]).T)
+        
+        # Translate the doc ids to exclude into positions within `doc_ids`. 
+        # Any which aren't in `doc_ids` are dropped.
+        def toPositions(ids):
+            ids = np.asarray(list(ids), dtype=np.int64)
+            pos = np.minimum(np.searchsorted(doc_ids, ids), len(doc_ids) - 1)
+            return np.where(doc_ids[pos] == ids, pos, -1)
+        
+        if exclude_ids is not None and len(exclude_ids) > 0:
+            exclude_ids = toPositions(exclude_ids)
+            exclude_ids = exclude_ids[exclude_ids >= 0]
+            
+        if query_ids is not None:
+            query_ids = toPositions(query_ids)
+        
+        results = blockedTopN(scoreBlock, len(doc_ids), query_vecs, topn, 
+                              query_ids, exclude_ids, chunksize, block_size)
+        
+        # Translate the positions back into doc ids.
+        return [[(int(doc_ids[pos]), sim) for (pos, sim) in result] 
+                for result in results]
+
+    def _scoreBlock(self, query_vecs, start, end):
+        """
+        Internal function which calculates the similarities between the LSI
+        vectors `query_vecs` and the block of documents `start` to `end - 1`
+        of a MatrixSimilarity index.
+        """
+        return np.dot(query_vecs, self.index.index[start:end].T)
+
     
-    def findSimilarToText(self, text, topn=10):
+    def addDocuments(self, input_tfidfs, titles, tags=None, line_nums=None,
+                     input_bows=None):
+        """
+        Add new documents to the corpus and the LSI index, without rebuilding
+        them. The documents are given the next doc ids after the end of the
+        corpus.
+        
+        The documents are projected onto the LSI space with the existing LSI
+        model, which isn't re-trained. That's fine for a small number of new
+        documents, but the model won't learn any new topics they introduce.
+        
+        Parameters:
+            input_tfidfs  List of tf-idf vectors (see 
+                          `KeySearch.getTfidfForText`).
+            titles        The title of each document.
+            tags          Optional list of tags for each document.
+            line_nums     Optional location of each document in its source
+                          file.
+            input_bows    Optional list of bag-of-words vectors (see 
+                          `KeySearch.getBowForText`), so that the documents
+                          are included in `KeySearch.rankedKeywordSearch`.
+                          
+        Returns the doc ids of the new documents.
+        """
+        if not isinstance(self.index, DeltaIndex):
+            self.index = DeltaIndex(self.index, self.lsi.num_topics)
+        
+        doc_ids = self.ksearch.addDocuments(input_tfidfs, titles, tags, line_nums,
+                                            input_bows)
+        
+        self.index.append(self.getLsiVectors(input_tfidfs))
+        
+        # The new documents may be neighbours of the existing ones, so the
+        # precomputed neighbours and any cached results are out of date.
+        self.knn_graph = None
+        self.clearCaches()
+        
+        return doc_ids
+    
+    def deleteDocuments(self, doc_ids):
+        """
+        Delete the documents `doc_ids`. They're left out of the search results
+        from now on, but keep their doc ids until `compact` is called.
+        """
+        self.ksearch.deleteDocuments(doc_ids)
+        
+        # The cached results may include the deleted documents.
+        self.clearCaches()
+    
+    def updateDocument(self, doc_id, input_tfidf, title=None, tags=None,
+                       line_nums=None, input_bow=None):
+        """
+        Replace the document `doc_id` with a new version, given by its tf-idf
+        vector (and optionally its bag-of-words vector). The new version gets
+        a new doc id; see `KeySearch.updateDocument`.
+        
+        Returns the doc id of the new version.
+        """
+        if not isinstance(self.index, DeltaIndex):
+            self.index = DeltaIndex(self.index, self.lsi.num_topics)
+        
+        new_id = self.ksearch.updateDocument(doc_id, input_tfidf, title, tags,
+                                             line_nums, input_bow)
+        
+        self.index.append(self.getLsiVectors([input_tfidf]))
+        
+        self.knn_graph = None
+        self.clearCaches()
+        
+        return new_id
+    
+    def compact(self):
+        """
+        Remove the deleted documents from the corpus and the LSI index, and
+        re-number the remaining documents to fill the gaps.
+        
+        A MatrixSimilarity index is rebuilt in memory with just the remaining
+        documents. The other index types (e.g., a QuantizedIndex) would need
+        to be re-trained, so the deleted rows are only hidden until the next
+        full build.
+        
+        Returns an array which maps each old doc id to its new doc id, or -1
+        for the deleted documents.
+        """
+        remap = self.ksearch.compact()
+        
+        if not isinstance(self.index, DeltaIndex):
+            self.index = DeltaIndex(self.index, self.lsi.num_topics)
+        
+        self.index = self.index.compact(remap >= 0)
+        
+        # The precomputed neighbours and any cached results use the old doc
+        # ids.
+        self.knn_graph = None
+        self.clearCaches()
+        
+        return remap
+    
+    def findSimilarToText(self, text, topn=10, allow=None, deny=None):
         """
         Find documents in the corpus similar to the provided input text.
 
@@ -125,12 +626,77 @@ class SimSearch(object):
             (doc_id, similarity_value)
         """
         # Parse the input text and create a tf-idf representation.        
-        tfidf_vec = self.ksearch.getTfidfForText(text)
+        tfidf_vec = self.getTfidfForText(text)
         
         # Pass the call down.        
-        return self.findSimilarToVector(tfidf_vec, topn=topn, in_corpus=False)
+        return self.findSimilarToVector(tfidf_vec, topn=topn, in_corpus=False,
+                                        allow=allow, deny=deny)
+    
+    def findSimilarToTextInDocs(self, text, doc_ids, topn=10, deny=None):
+        """
+        Find the documents most similar to the provided input text, out of 
+        just the documents `doc_ids`. For example, pass the results of a
+        `KeySearch.keywordSearch` to perform a semantic search over only the
+        documents containing certain keywords.
+        
+        Only the LSI vectors for `doc_ids` are scored, so this is fast when
+        the list is short.
+        
+        Returns the results as a list of tuples in the form:
+            (doc_id, similarity_value)
+        """
+        query_vec = self.getLsiVector(self.getTfidfForText(text))
+        
+        return self._searchLsiVectors(query_vec, topn, allow=doc_ids, 
+                                      deny=deny)[0]
     
-    def findSimilarToFile(self, filename, topn=10):
+    def hybridSearch(self, text, topn=10, fusion='rrf', num_candidates=100,
+                     keyword_weight=0.5, rrf_k=60, allow=None, deny=None):
+        """
+        Search the corpus using both keyword and conceptual similarity.
+        
+        The query text is run through two searches:
+          1. A ranked (BM25) keyword search, using KeySearch's inverted index.
+          2. An LSI (semantic) search.
+        The top `num_candidates` from each are then combined according to 
+        `fusion`:
+          'rrf'        - Reciprocal rank fusion. Documents are scored by their
+                         ranks in the two lists, so the keyword and LSI scores
+                         don't need to be on the same scale.
+          'linear'     - The scores from each list are rescaled to 0 - 1, and
+                         added together, weighted by `keyword_weight` and 
+                         (1 - keyword_weight).
+          'restricted' - A semantic search over just the keyword candidates.
+                         The LSI search only scores the candidates' rows.
+        
+        `allow` and `deny` filter both searches (see the class documentation).
+        
+        Returns the results as a list of tuples in the form:
+            (doc_id, score)
+        """
+        if fusion not in ('rrf', 'linear', 'restricted'):
+            raise ValueError('Unsupported fusion method \'%s\'' % fusion)
+        
+        # Keyword stage.
+        keyword_results = self.ksearch.rankedKeywordSearch(text, topn=num_candidates,
+                                                           allow=allow, deny=deny)
+        
+        # Semantic stage.
+        query_vec = self.getLsiVector(self.getTfidfForText(text))
+        
+        if fusion == 'restricted':
+            doc_ids = [doc_id for (doc_id, score) in keyword_results]
+            return self._searchLsiVectorsInDocs(query_vec, doc_ids, topn)[0]
+        
+        semantic_results = self._searchLsiVectors(query_vec, num_candidates,
+                                                  allow=allow, deny=deny)[0]
+        
+        return fuseResults([keyword_results, semantic_results], topn, 
+                           method=fusion, 
+                           weights=[keyword_weight, 1.0 - keyword_weight],
+                           rrf_k=rrf_k)
+    
+    def findSimilarToFile(self, filename, topn=10, allow=None, deny=None):
         """
         Find documents in the corpus similar to the provided text file.
         
@@ -145,9 +711,10 @@ class SimSearch(object):
         input_tfidf = self.ksearch.getTfidfForFile(filename)
     
         # Pass the call down.
-        return self.findSimilarToVector(input_tfidf, topn)
+        return self.findSimilarToVector(input_tfidf, topn, allow=allow, 
+                                        deny=deny)
     
-    def findSimilarToDoc(self, doc_id, topn=10):
+    def findSimilarToDoc(self, doc_id, topn=10, allow=None, deny=None):
         """
         Find documents similar to the specified entry number in the corpus.
         
@@ -156,24 +723,147 @@ class SimSearch(object):
         Returns the results as a list of tuples in the form:
             (doc_id, similarity_value)
         """
+        # Repeated searches are answered from the results cache.
+        key = ('doc', doc_id, topn, filterKey(allow), filterKey(deny))
+        
+        return self._getCachedResults(key, lambda: 
+            self._findSimilarToDoc(doc_id, topn, allow, deny))
+    
+    def _findSimilarToDoc(self, doc_id, topn=10, allow=None, deny=None):
+        """
+        Internal function which performs the search for `findSimilarToDoc`.
+        """
+        # Count negative doc ids back from the end, so that the document is
+        # recognized and left out of its own results.
+        if doc_id < 0:
+            doc_id += len(self.index)
+        
+        # Answer from the precomputed neighbours, if possible.
+        results = self._findSimilarInGraph(doc_id, topn, allow, deny)
+        
+        if results is not None:
+            return results
         
         # Find the most similar entries to 'doc_id'
-        #  1. Look up the tf-idf vector for the entry.
-        #  2. Project it onto the LSI vector space.
-        #  3. Compare the LSI vector to the entire collection.
-        tfidf_vec = self.ksearch.corpus_tfidf[doc_id]
+        #  1. Look up the entry's LSI vector. It's already stored (normalized)
+        #     in the index, so there's no need to read its tf-idf vector and
+        #     project it again.
+        #  2. Compare the LSI vector to the entire collection.
+        query_vec = self.getIndexVectors([doc_id])
         
-        # Pass the call down, specifying that the input is a part of the 
-        # corpus.
-        return self.findSimilarToVector(tfidf_vec, topn=topn, in_corpus=True)    
+        # Leave the document itself out of the results. (With a filter, it
+        # isn't necessarily the first result.)
+        return self._searchOne(query_vec, topn, query_id=doc_id, allow=allow,
+                               deny=deny)
         
     
-    def findMoreOfTag(self, tag, topn=10):
+    def findSimilarToDocs(self, doc_ids, exclude_ids=[], topn=10, allow=None,
+                          deny=None, negative_ids=None, neg_weight=0.25):
+        """
+        Find documents similar to a collection of documents in the corpus.
+        
+        Combines the similarity scores from all of the input documents, like
+        `findSimilarToVectors`. Documents similar to the `negative_ids` are
+        pushed down the results. The input documents (positive and negative)
+        are left out of the results, along with anything in `exclude_ids`.
+        
+        Returns the results as a list of tuples in the form:
+            (doc_id, similarity_value)
+        """
+        doc_ids = np.asarray(list(doc_ids), dtype=np.int64)
+        
+        if negative_ids is None:
+            negative_ids = []
+        negative_ids = np.asarray(list(negative_ids), dtype=np.int64)
+        
+        all_ids = np.concatenate((doc_ids, negative_ids))
+        is_negative = np.arange(len(all_ids)) >= len(doc_ids)
+        
+        # Read all of the documents' LSI vectors from the index as one block
+        # of rows, in doc id order (which is friendlier to a memory-mapped 
+        # index).
+        order = np.argsort(all_ids, kind='mergesort')
+        vecs = self.getIndexVectors(all_ids[order])
+        is_negative = is_negative[order]
+        
+        query_vec = self._feedbackQuery(vecs[~is_negative], vecs[is_negative],
+                                        neg_weight)
+        
+        exclude_ids = set(exclude_ids).union(all_ids.tolist())
+        
+        return self._searchLsiVectors(query_vec[np.newaxis, :], topn, 
+                                      exclude_ids=exclude_ids,
+                                      allow=allow, deny=deny)[0]
+    
+    def _findSimilarInGraph(self, doc_id, topn=10, allow=None, deny=None):
+        """
+        Internal function which looks up the most similar documents to 
+        `doc_id` in the precomputed neighbours (`knn_graph`).
+        
+        Returns None if the neighbours can't answer the search: there's no
+        graph, `topn` is more than it holds, or too many of the neighbours
+        are filtered out.
+        """
+        graph = self.knn_graph
+        num_docs = len(self.index)
+        
+        if graph is None or len(graph) != num_docs or topn > graph.k:
+            return None
+        
+        if doc_id < 0:
+            doc_id += num_docs
+        
+        # Leave out any deleted or filtered out documents.
+        mask = makeFilterMask(num_docs, allow, 
+                              self.ksearch.addDeletedToDeny(deny))
+        
+        results = graph.getNeighbors(doc_id, topn, mask)
+        
+        # If fewer than `topn` neighbours made it through the filter, the 
+        # graph doesn't hold the answer--unless it holds every other 
+        # document.
+        if len(results) < topn and graph.k < num_docs - 1:
+            return None
+        
+        return results
+        
+    def buildKnnGraph(self, fname, k=100, processes=None, chunksize=4096):
+        """
+        Find the `k` most similar documents to every document in the index,
+        and save them to `fname` (see `buildKnnGraph` in knngraph.py). 
+        `findSimilarToDoc` will answer from these whenever `topn` is no more
+        than `k`.
+        
+        This scores every document against every other document, so it's 
+        an offline job: for the full Wikipedia index it takes hours, even 
+        across all of the cores. If it's interrupted, call it again to pick
+        up where it left off.
+        """
+        # A MatrixSimilarity holds the vectors in its `index` array. The other
+        # index types provide `getVectors`.
+        if hasattr(self.index, 'getVectors'):
+            vectors = self.index
+        else:
+            vectors = self.index.index
+        
+        self.knn_graph = buildKnnGraph(vectors, fname, k, processes, chunksize)
+        
+        return self.knn_graph
+    
+    def findMoreOfTag(self, tag, topn=10, allow=None, deny=None, 
+                      neg_weight=0.25):
         """
         Find entries in the corpus which are similar to those tagged with 
         'tag'. That is, find more entries in the corpus that we might want to
         tag with 'tag'.
-
+        
+        Entries tagged with '!' + tag are negative examples: entries similar
+        to them are pushed down the results, with `neg_weight` setting how 
+        strongly (see `_feedbackQuery`). Set it to 0 to just leave the 
+        negative examples out of the results.
+        
+        `allow` and `deny` optionally filter the results (see the class
+        documentation).
         """
         
         # All tags should be lower case to avoid mistakes.
@@ -181,43 +871,20 @@ class SimSearch(object):
         
         # I pre-pend a '!' to indicate that a document does not belong under
         # a specific tag (I do this to create negative samples)
-        if ('!' + tag) in self.ksearch.tagsToEntries:
-            exclude_ids = set(self.ksearch.tagsToEntries['!' + tag])
-        else:
-            exclude_ids = set()
+        negative_ids = self.ksearch.tagsToDocs.get('!' + tag, [])
         
         # Find all documents marked with 'tag'.
-        input_ids = self.ksearch.tagsToEntries[tag]
-        
-        # Calculate the combined similarities for all input vectors.
-        sims_sum = []
+        input_ids = self.ksearch.tagsToDocs[tag]
         
         for i in input_ids:
-            # Get the LSI vector for this document.    
-            input_vec = self.lsi[self.ksearch.corpus_tfidf[i]]
-        
             print '  ' + self.ksearch.titles[i]
         
-            # Calculate the similarities between this and all other entries.
-            sims = self.index[input_vec]
-        
-            # Accumulate the similarities across all input vectors.
-            if len(sims_sum) == 0:
-                sims_sum = sims
-            else:
-                sims_sum = np.sum([sims, sims_sum], axis=0)
-                    
-        # Sort the combined similarities.
-        sims_sum = sorted(enumerate(sims_sum), key=lambda item: -item[1])    
-        
-        # Append the input ids to the list of those to exclude from the results
-        exclude_ids = exclude_ids + input_ids
-
-        # Lookup the vectors for all of the input docs.        
-        input_vecs = [self.ksearch.getTfidfForDoc(doc_id) for doc_id in input_ids]
-        
-        # Pass the call down.
-        return self.findSimilarToVecs(input_vecs, exclude_ids=exclude_ids, topn=topn)
+        # Search on the combined similarities to all of the input documents,
+        # in a single pass over the index. The input documents and negative
+        # examples are left out of the results.
+        return self.findSimilarToDocs(input_ids, topn=topn, allow=allow, 
+                                      deny=deny, negative_ids=negative_ids,
+                                      neg_weight=neg_weight)
         
     def sparseToDense(self, sparse_vec, length):
         """
@@ -230,47 +897,114 @@ class SimSearch(object):
         vec = np.zeros(length)
         
         # Copy over the values into their correct positions.
-        for i in range(0, len(sparse_vec)):
-            j = sparse_vec[i][0]
-            value = sparse_vec[i][1]
-            vec[j] = value
+        if len(sparse_vec) > 0:
+            (ids, values) = zip(*sparse_vec)
+            vec[list(ids)] = values
         
         return vec
 
+    def _getWordWeights(self, vec_tfidf):
+        """
+        Internal function which looks up the LSI weights for just the words 
+        present in the sparse tf-idf vector `vec_tfidf`.
+        
+        Returns (word_ids, tfidf_values, word_weights), where `word_weights`
+        is a [num_words x num_topics] array with the LSI weights for each 
+        word, one per row.
+        """
+        word_ids = np.asarray([word_id for (word_id, value) in vec_tfidf], dtype=np.int64)
+        values = np.asarray([value for (word_id, value) in vec_tfidf], dtype=np.float64)
+        
+        # Gather the rows of the projection matrix for these words.
+        word_weights = np.asarray(self.lsi.projection.u[word_ids, 0:self.lsi.num_topics])
+        
+        return (word_ids, values, word_weights)
 
     def getSimilarityByWord(self, vec1_tfidf, vec2_tfidf):
         """
         Calculates the individual contribution of each word in document 1 to
         the total similarity between documents 1 and 2.
         
+        Only the words which are present in document 1 are considered, since
+        all other words contribute nothing.
+        
         Returns a list of tuples in the form:
             (word_id, sim_value)
         """    
-        # Get the tf-idf and LSI vectors for the two documents, and convert them to
-        # dense representations.        
-        vec1_lsi = self.sparseToDense(self.lsi[vec1_tfidf], self.lsi.num_topics)
-        vec2_lsi = self.sparseToDense(self.lsi[vec2_tfidf], self.lsi.num_topics)
-        vec1_tfidf = self.sparseToDense(vec1_tfidf, self.ksearch.getVocabSize())
-        #vec2_tfidf = self.sparseToDense(self.ksearch.corpus_tfidf[id2], self.ksearch.getVocabSize())    
+        # Look up the LSI weights for the words in each document.
+        ids1, values1, weights1 = self._getWordWeights(vec1_tfidf)
+        ids2, values2, weights2 = self._getWordWeights(vec2_tfidf)
+
+        # Project the two documents onto the LSI space. This is the same
+        # calculation `self.lsi[...]` performs.
+        vec1_lsi = np.dot(values1, weights1)
+        vec2_lsi = np.dot(values2, weights2)
 
         # Calculate the norms of the two LSI vectors.
         norms = np.linalg.norm(vec1_lsi) * np.linalg.norm(vec2_lsi)    
+        
+        if norms == 0:
+            return []
                 
-        # Create a vector to hold the similarity contribution of each word.
-        word_sims = np.zeros(self.ksearch.getVocabSize())
+        # Calculate the contribution of every word in doc1 to the total 
+        # similarity at once. The contributions sum to the cosine similarity.
+        word_sims = values1 * np.dot(weights1, vec2_lsi) / norms
+          
+        return list(zip(ids1.tolist(), word_sims.tolist()))
 
-        # For each word in the vocabulary...
-        for word_id in range(0, self.ksearch.getVocabSize()):
+    def explainResults(self, input_tfidf, results, topn=10):
+        """
+        Find the words in the query which contribute the most (positively and
+        negatively) to the similarity with each of the search results.
+        
+        This is a batch version of `getSimilarityByWord` for the query side
+        of a search: the contributions of every query word to every result
+        are calculated with a single matrix product, using the result vectors
+        already stored in the index.
+        
+        Parameters:
+            input_tfidf - The tf-idf vector of the query.
+            results     - The search results, as a list of 
+                          (doc_id, similarity_value) tuples.
+            topn        - The number of positive and negative words to return
+                          for each result.
+        
+        Returns a list with one entry per result, each a tuple in the form:
+            (doc_id, positive_words, negative_words)
+        where `positive_words` is a list of (word, sim_value) tuples, biggest 
+        first, and `negative_words` is a list of (word, sim_value) tuples, 
+        most negative first.
+        """
+        if len(results) == 0:
+            return []
 
-            # Get the weights vector for this word. This vector has one weight
-            # for each topic
-            word_weights = np.asarray(self.lsi.projection.u[word_id, :]).flatten()
+        # Look up the LSI weights for the words in the query, and project the
+        # query onto the LSI space.
+        word_ids, values, weights = self._getWordWeights(input_tfidf)
+        query_norm = np.linalg.norm(np.dot(values, weights))
+        
+        # The LSI vectors for the results are already normalized.
+        result_vecs = self.getIndexVectors([doc_id for (doc_id, sim) in results])
+        
+        if query_norm == 0:
+            query_norm = 1.0
 
-            # Calculate the contribution of this word in doc1 to the total similarity.
-            word_sims[word_id] = vec1_tfidf[word_id] * np.dot(word_weights, vec2_lsi) / norms;
-          
-        # print 'Total word contributions:', np.sum(word_sims)  
-        return word_sims
+        # Calculate the contribution of every query word to every result;
+        # [num_words x num_results]
+        word_sims = values[:, np.newaxis] * np.dot(weights, result_vecs.T) / query_norm
+
+        explanations = []
+        for j in range(0, len(results)):
+
+            # Select the most positive and most negative words.
+            pos_words = [(self.ksearch.dictionary[word_ids[i]], sim) 
+                         for (i, sim) in topN(word_sims[:, j], topn) if sim > 0]
+            neg_words = [(self.ksearch.dictionary[word_ids[i]], -sim) 
+                         for (i, sim) in topN(-word_sims[:, j], topn) if sim > 0]
+            
+            explanations.append((results[j][0], pos_words, neg_words))
+
+        return explanations
 
     def printWordSims(self, word_sims, topn, min_pos, max_neg):
         """
@@ -283,7 +1017,7 @@ class SimSearch(object):
         
         # Build up the table of results to display.        
         tableStr = ''
-        for i in range(0, topn):
+        for i in range(0, min(topn, len(word_sims))):
             pos_word_id, pos_word_val = word_sims[i]
             neg_word_id, neg_word_val = word_sims[-(i + 1)]
             
@@ -330,7 +1064,7 @@ class SimSearch(object):
         word_sims = self.getSimilarityByWord(vec1_tfidf, vec2_tfidf)
         
         # Sort the similarities, biggest to smallest.    
-        word_sims = sorted(enumerate(word_sims), key=lambda item: -item[1])
+        word_sims = sorted(word_sims, key=lambda item: -item[1])
 
         print 'Words in doc 1 which contribute most to similarity:'
         self.printWordSims(word_sims, topn, min_pos, max_neg)
@@ -339,7 +1073,7 @@ class SimSearch(object):
         word_sims = self.getSimilarityByWord(vec2_tfidf, vec1_tfidf)
         
         # Sort the similarities, biggest to smallest.    
-        word_sims = sorted(enumerate(word_sims), key=lambda item: -item[1])
+        word_sims = sorted(word_sims, key=lambda item: -item[1])
 
         print 'Words in doc 2 which contribute most to similarity:'
         self.printWordSims(word_sims, topn, min_pos, max_neg)
@@ -365,13 +1099,12 @@ class SimSearch(object):
             # Add the tf-idf vector to the sum.
             tfidf_sum += vec_tfidf
 
-        # Sort the per-word tf-idf values, biggest to smallest.    
-        word_ids = sorted(enumerate(tfidf_sum), key=lambda item: -item[1])
+        # Select the words with the largest summed tf-idf values.
+        word_ids = topN(tfidf_sum, topn)
         
         # Create a list of the top words (as strings)
         top_words = []        
-        for i in range(0, topn):
-            word_id = word_ids[i][0]
+        for (word_id, value) in word_ids:
             top_words.append(self.ksearch.dictionary[word_id])
             
         return top_words
@@ -434,18 +1167,59 @@ class SimSearch(object):
         This also saves the underlying KeySearch object to disk.
         """
 
-        # Save the LSI model and the LSI index.        
-        self.index.save(save_dir + 'index.mm')
-        self.lsi.save(save_dir + 'lsi.model')
+        # If documents have been added or deleted, the original index is 
+        # wrapped in a DeltaIndex. The original index is written out as usual,
+        # and the changes on top of it are saved separately.
+        if isinstance(self.index, DeltaIndex):
+            index = self.index.base
+        else:
+            index = self.index
+        
+        # Save the LSI model and the LSI index. The numpy arrays are always 
+        # written to their own .npy files (sep_limit=0) so that they can be
+        # memory-mapped by `load`. They may be memory-mapped from the files
+        # being replaced right now, so they're written under temporary names
+        # first (see `saveByRenaming`). If they were loaded from this 
+        # directory, they haven't changed, and aren't written at all.
+        if getattr(index, 'fname', None) != save_dir + 'index.mm':
+            saveByRenaming(index, save_dir + 'index.mm', sep_limit=0)
+        
+        if getattr(self.lsi, 'fname', None) != save_dir + 'lsi.model':
+            saveByRenaming(self.lsi, save_dir + 'lsi.model', sep_limit=0)
+        
+        # Save the added documents and the doc id maps. (Remove any left over
+        # from an earlier save.)
+        for fname in glob.glob(save_dir + 'index.delta*'):
+            os.remove(fname)
+        
+        if isinstance(self.index, DeltaIndex):
+            self.index.save(save_dir + 'index.delta')
+        
+        # Save the precomputed neighbours, or remove any stale ones.
+        if self.knn_graph is not None:
+            self.knn_graph = self.knn_graph.save(save_dir + 'knn.graph')
+        else:
+            for ext in ['', '.ids', '.scores']:
+                if os.path.exists(save_dir + 'knn.graph' + ext):
+                    os.remove(save_dir + 'knn.graph' + ext)
 
         # Save the underlying KeySearch as well.        
         self.ksearch.save(save_dir)
         
     @classmethod
-    def load(cls, save_dir='./'):
+    def load(cls, save_dir='./', mmap=None, warm_up=False):
         """
         Load a SimSearch object and it's underlying KeySearch from the 
         specified directory. Returns both objects.
+        
+        Set mmap='r' to memory-map the LSI index and the LSI projection 
+        matrix read-only instead of reading them into memory. Loading then
+        takes about a second regardless of the index size, and multiple 
+        processes on the same machine will share a single copy of the index
+        in the OS page cache.
+        
+        Set `warm_up` to touch all of the memory-mapped pages before 
+        returning (see `warmUp`).
         """
         
         # First create and load the underlying KeySearch.
@@ -454,11 +1228,114 @@ class SimSearch(object):
         # Create a SimSearch object.
         ssearch = SimSearch(ksearch)
         
-        # Load the LSI index.
-        ssearch.index = similarities.MatrixSimilarity.load(save_dir + 'index.mm')
+        # Load the LSI index. This is usually a MatrixSimilarity, but may be
+        # one of the other index types (e.g., a QuantizedIndex). Remember 
+        # where it came from, so that `save` doesn't write it over itself.
+        index = utils.SaveLoad.load(save_dir + 'index.mm', mmap=mmap)
+        index.fname = save_dir + 'index.mm'
+        
+        # Apply any documents added or deleted since the index was built.
+        if os.path.exists(save_dir + 'index.delta'):
+            index = DeltaIndex.load(save_dir + 'index.delta', index)
+        
+        ssearch.index = index
         
         # Load the LSI model.
-        ssearch.lsi = LsiModel.load(save_dir + 'lsi.model')
+        ssearch.lsi = LsiModel.load(save_dir + 'lsi.model', mmap=mmap)
+        ssearch.lsi.fname = save_dir + 'lsi.model'
+        
+        # Load the precomputed neighbours, if any.
+        if os.path.exists(save_dir + 'knn.graph'):
+            ssearch.knn_graph = KnnGraph(save_dir + 'knn.graph', mmap=mmap)
+        
+        if warm_up:
+            ssearch.warmUp()
         
         return (ksearch, ssearch)
-        
\ No newline at end of file
+
+    def warmUp(self):
+        """
+        Read through the LSI index and the LSI projection matrix so that all 
+        of their pages are resident in memory.
+        
+        When these are memory-mapped, the pages are only read from disk the
+        first time they're touched, which would make the first few searches
+        very slow. Call this before a search process starts taking requests.
+        It has no real effect if the arrays were loaded into memory.
+        
+        Returns the number of bytes touched.
+        """
+        # Collect all of the numpy arrays held by the index and projection.
+        arrays = []
+        objs = [self.index, self.lsi.projection]
+        
+        # After documents are added, the original index is wrapped in a 
+        # DeltaIndex.
+        if isinstance(self.index, DeltaIndex):
+            objs.append(self.index.base)
+        
+        if self.knn_graph is not None:
+            objs.append(self.knn_graph)
+        
+        for obj in objs:
+            for value in vars(obj).values():
+                if isinstance(value, np.ndarray):
+                    arrays.append(value)
+                elif isinstance(value, list):
+                    arrays.extend([v for v in value if isinstance(v, np.ndarray)])
+        
+        num_bytes = 0
+        for arr in arrays:
+            num_bytes += touchPages(arr)
+        
+        return num_bytes
+
+
+def saveByRenaming(obj, fname, **kwargs):
+    """
+    Save the gensim object `obj` to `fname` (with `obj.save`, passing along
+    `kwargs`), replacing any saved there before.
+    
+    The files are written under temporary names and then renamed, the same
+    way as `TitleStore.serialize`. Writing straight over the old files would
+    truncate them, and any arrays memory-mapped from them (e.g., by 
+    `SimSearch.load` with mmap='r') would crash the process when they're next
+    read. Renaming leaves the old data in place until it's unmapped.
+    """
+    tmp_fname = fname + '.tmp'
+    
+    # Clear out anything left over from an interrupted save.
+    for tmp_path in glob.glob(tmp_fname + '*'):
+        os.remove(tmp_path)
+    
+    obj.save(tmp_fname, **kwargs)
+    
+    # Rename the separately stored arrays first, and the main pickle last.
+    tmp_paths = [tmp_path for tmp_path in glob.glob(tmp_fname + '*') if tmp_path != tmp_fname]
+    
+    for tmp_path in tmp_paths + [tmp_fname]:
+        os.rename(tmp_path, fname + tmp_path[len(tmp_fname):])
+
+
+def touchPages(arr, page_size=mmap.PAGESIZE):
+    """
+    Read one value from every memory page of the numpy array `arr`, which
+    forces the OS to load a memory-mapped array from disk.
+    
+    Returns the size of the array in bytes.
+    """
+    if arr.size == 0:
+        return 0
+    
+    # View the array as one flat run of values (this doesn't copy). 
+    flat = arr.reshape(-1)
+    
+    # The number of values per page.
+    step = max(1, page_size // arr.itemsize)
+    
+    # Read a value from each page, a block of pages at a time.
+    block = step * 65536
+    for start in range(0, flat.shape[0], block):
+        np.sum(flat[start:start + block:step])
+    
+    return arr.nbytes
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Converts batches of new text into tf-idf vectors.
+
+`KeySearch.getTfidfForText` handles one text at a time: NLTK tokenizing,
+then `doc2bow`, then the tf-idf model, each a Python loop over the words.
+That's fine for a single query, but slow for thousands of texts.
+
+`textsToTfidf` instead tokenizes each text with a single regular expression,
+looks the words up in the dictionary's token -> id map, and builds one sparse
+matrix of word counts for the whole batch. The tf-idf weights are then
+applied to the matrix all at once (see `applyTfidf` in tfidfcorpus.py). Large
+batches are split into chunks and spread over a pool of worker processes.
+
+The result is a scipy sparse [num_texts x num_terms] matrix, which can be
+passed straight to `SimSearch.getLsiVectors` or
+`SimSearch.findSimilarToVectorsBatch` to be projected in one step.
+"""
+
+from gensim import utils
+from tfidfcorpus import applyTfidf
+from scipy import sparse
+import multiprocessing
+import numpy as np
+import logging
+import nltk
+import re
+
+logger = logging.getLogger(__name__)
+
+# A word is a run of letters (and underscores), the same pattern as gensim's
+# `utils.PAT_ALPHABETIC`.
+PAT_WORD = re.compile(r'(?:(?!\d)\w)+', re.UNICODE)
+
+
+def tokenizeWiki(text, token_min_len=2, token_max_len=15):
+    """
+    Split `text` (unicode) into lower case words, exactly the way
+    `gensim.corpora.wikicorpus.tokenize` does. That's how the Wikipedia
+    dictionary was built, so query text should be tokenized the same way.
+    """
+    return [token for token in PAT_WORD.findall(text.lower())
+            if token_min_len <= len(token) <= token_max_len and not token.startswith(u'_')]
+
+
+def tokenizeNltk(text):
+    """
+    Split `text` (unicode) into lower case words using NLTK.
+    """
+    return nltk.word_tokenize(text.lower())
+
+
+# The tokenizers, by name (see KeySearch's `tokenizer`).
+TOKENIZERS = {'wiki': tokenizeWiki, 'nltk': tokenizeNltk}
+
+# The state shared with the worker processes. It's set before the pool is
+# created, so the workers inherit it when they're forked, rather than having
+# the dictionary pickled and sent with every chunk.
+_vec_state = {}
+
+
+def textsToCounts(texts, token2id, num_terms, tokenizer='wiki'):
+    """
+    Convert a list of texts to a scipy sparse [len(texts) x num_terms] CSR
+    matrix of word counts. Words which aren't in `token2id` are ignored.
+    """
+    tokenize = TOKENIZERS[tokenizer]
+
+    ids = []
+    lengths = []
+
+    for text in texts:
+        text = utils.to_unicode(text, errors='ignore')
+
+        doc_ids = [token2id.get(token) for token in tokenize(text)]
+        doc_ids = [word_id for word_id in doc_ids if word_id is not None]
+
+        ids.extend(doc_ids)
+        lengths.append(len(doc_ids))
+
+    rows = np.repeat(np.arange(len(texts)), lengths)
+
+    # Duplicate entries are summed, which counts the words.
+    counts = sparse.csr_matrix((np.ones(len(ids), dtype=np.float64), (rows, np.asarray(ids, dtype=np.int64))),
+                               shape=(len(texts), num_terms))
+    counts.sum_duplicates()
+
+    return counts
+
+
+def _vectorizeChunk(texts):
+    """
+    Worker function which converts a chunk of texts to tf-idf vectors, using
+    the dictionary and weights in `_vec_state`.
+    """
+    counts = textsToCounts(texts, _vec_state['token2id'], _vec_state['num_terms'],
+                           _vec_state['tokenizer'])
+
+    return applyTfidf(counts, _vec_state['idfs'], _vec_state['normalize'])
+
+
+def textsToTfidf(texts, token2id, idfs, normalize, tokenizer='wiki',
+                 processes=None, chunksize=1000):
+    """
+    Convert a batch of texts to tf-idf vectors.
+
+    Parameters:
+        texts      List of texts, as unicode or UTF-8 encoded strings.
+        token2id   The dictionary's map of word -> word id.
+        idfs       Array of the idf weight for each word id, and whether to
+        normalize  normalize the vectors (see `getIdfArray` in
+                   tfidfcorpus.py).
+        tokenizer  'wiki' or 'nltk' (see TOKENIZERS).
+        processes  The number of worker processes. Defaults to the number of
+                   cores. Batches of no more than `chunksize` texts are
+                   processed directly, without a pool.
+        chunksize  The number of texts per task.
+
+    Returns a scipy sparse [len(texts) x num_terms] CSR matrix of float32
+    tf-idf weights.
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    texts = list(texts)
+
+    _vec_state.update({'token2id': token2id, 'idfs': idfs, 'normalize': normalize,
+                       'num_terms': len(idfs), 'tokenizer': tokenizer})
+
+    try:
+        if processes <= 1 or len(texts) <= chunksize:
+            return _vectorizeChunk(texts)
+
+        chunks = [texts[start:start + chunksize] for start in range(0, len(texts), chunksize)]
+
+        logger.info('vectorizing %d texts with %d processes', len(texts), processes)
+
+        pool = multiprocessing.Pool(min(processes, len(chunks)))
+        try:
+            vecs = list(pool.imap(_vectorizeChunk, chunks))
+        finally:
+            pool.terminate()
+
+        return sparse.vstack(vecs, format='csr')
+    finally:
+        _vec_state.clear()
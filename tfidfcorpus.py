@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+"""
+A tf-idf corpus which is computed on the fly from the bag-of-words corpus,
+rather than stored.
+
+Step 4 of `make_wikicorpus.py` used to apply the tf-idf model to every
+article and write the results out as a second corpus (17.9 GB as Matrix
+Market, or ~8 bytes per value as a CsrCorpus). But a tf-idf vector is just
+the word counts multiplied by each word's idf weight, which is cheap to
+recompute.
+
+TfidfCorpus wraps a bag-of-words CsrCorpus, and applies the idf weights to
+the (memory-mapped) word counts whenever a document or chunk of documents is
+read. It produces the same vectors as `model_tfidf[corpus_bow]`, and can be
+used anywhere the stored tf-idf corpus was: for training LSI, building the
+LSI index and inverted index, and in KeySearch.
+"""
+
+from gensim import interfaces, matutils, utils
+from scipy import sparse
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def getIdfArray(tfidf_model, num_terms):
+    """
+    Extract the idf weights from a gensim TfidfModel as an array, indexed by
+    word id, so that they can be applied to a whole matrix of word counts at
+    once (see `applyTfidf`).
+
+    Only the default kind of TfidfModel is supported: raw term counts times
+    the idf weight, optionally normalized to unit length. Raises ValueError
+    for any other kind.
+
+    Returns (idfs, normalize).
+    """
+    if getattr(tfidf_model, 'smartirs', None) is not None or \
+            getattr(tfidf_model, 'pivot', None) is not None or \
+            getattr(tfidf_model, 'wlocal', utils.identity) is not utils.identity:
+        raise ValueError('Only a plain tf-idf model (no smartirs, pivot, or wlocal) is supported')
+
+    if tfidf_model.normalize in (True, matutils.unitvec):
+        normalize = True
+    elif tfidf_model.normalize in (False, utils.identity):
+        normalize = False
+    else:
+        raise ValueError('A custom normalize function is not supported')
+
+    idfs = np.zeros(num_terms, dtype=np.float64)
+    for (word_id, idf) in tfidf_model.idfs.items():
+        if word_id < num_terms:
+            idfs[word_id] = idf
+
+    return idfs, normalize
+
+
+def applyTfidf(chunk, idfs, normalize, eps=1e-12, dtype=np.float32):
+    """
+    Convert a CSR matrix of word counts (one row per document) to tf-idf
+    weights, the same way TfidfModel does for each document.
+
+    Words with an idf weight (or final weight) no bigger than `eps` are left
+    out of the vectors.
+    """
+    idf_values = idfs[chunk.indices]
+    values = np.asarray(chunk.data, dtype=np.float64) * idf_values
+
+    # Words with no idf weight are left out of the vectors.
+    keep = np.abs(idf_values) > eps
+
+    rows = np.repeat(np.arange(chunk.shape[0]), np.diff(chunk.indptr))
+
+    if normalize:
+        norms = np.sqrt(np.bincount(rows[keep], weights=values[keep] ** 2, minlength=chunk.shape[0]))
+        norms[norms == 0] = 1.0
+        values /= norms[rows]
+
+    keep &= np.abs(values) > eps
+
+    indptr = np.concatenate(([0], np.cumsum(np.bincount(rows[keep], minlength=chunk.shape[0]))))
+
+    return sparse.csr_matrix((values[keep].astype(dtype), chunk.indices[keep], indptr),
+                             shape=chunk.shape)
+
+
+class TfidfCorpus(interfaces.CorpusABC):
+    """
+    A read-only view of a bag-of-words CsrCorpus as tf-idf vectors.
+
+    Only the default kind of TfidfModel is supported: raw term counts times
+    the idf weight, optionally normalized to unit length.
+    """
+
+    def __init__(self, corpus_bow, tfidf_model, eps=1e-12):
+        """
+        Parameters:
+            corpus_bow   The bag-of-words CsrCorpus.
+            tfidf_model  The gensim TfidfModel to apply.
+            eps          Weights smaller than this are dropped, the same as
+                         in TfidfModel.
+        """
+        self.corpus_bow = corpus_bow
+        self.num_docs = corpus_bow.num_docs
+        self.num_terms = corpus_bow.num_terms
+        self.eps = eps
+
+        # Store the idf weights as an array, indexed by word id.
+        self.idfs, self.normalize = getIdfArray(tfidf_model, self.num_terms)
+
+        # The tf-idf vectors are returned as float32, the same as a stored
+        # CsrCorpus.
+        self.dtype = np.float32
+
+    def __len__(self):
+        return self.num_docs
+
+    def _applyTfidf(self, chunk):
+        """
+        Internal function which converts a CSR matrix of word counts to
+        tf-idf weights.
+        """
+        return applyTfidf(chunk, self.idfs, self.normalize, self.eps, self.dtype)
+
+    def __getitem__(self, doc_id):
+        """
+        Return the tf-idf vector for document `doc_id`, as a list of
+        (word_id, value) tuples.
+        """
+        chunk = self.getChunk(doc_id, doc_id + 1)
+
+        return list(zip(chunk.indices.astype(np.int64).tolist(), chunk.data.tolist()))
+
+    def __iter__(self):
+        """
+        Iterate over all of the documents, yielding each as a list of
+        (word_id, value) tuples.
+        """
+        return self.iterDocs()
+
+    def iterDocs(self, start=0):
+        """
+        Iterate over the documents from `start` onward, yielding each as a
+        list of (word_id, value) tuples.
+        """
+        for chunk in self.iterChunks(start=start):
+            for i in range(0, chunk.shape[0]):
+                begin, end = chunk.indptr[i], chunk.indptr[i + 1]
+                yield list(zip(chunk.indices[begin:end].astype(np.int64).tolist(), chunk.data[begin:end].tolist()))
+
+    def getChunk(self, start, end):
+        """
+        Return the tf-idf vectors for documents `start` through `end - 1` as
+        a scipy sparse [num_docs x num_terms] CSR matrix.
+        """
+        return self._applyTfidf(self.corpus_bow.getChunk(start, end))
+
+    def iterChunks(self, chunksize=10000, start=0):
+        """
+        Iterate over the corpus `chunksize` documents at a time, starting from
+        document `start`, yielding each chunk of tf-idf vectors as a scipy
+        sparse CSR matrix.
+        """
+        for chunk in self.corpus_bow.iterChunks(chunksize, start):
+            yield self._applyTfidf(chunk)
+
+    def getRows(self, doc_ids):
+        """
+        Gather the tf-idf vectors for the documents `doc_ids` into a scipy
+        sparse [len(doc_ids) x num_terms] CSR matrix.
+        """
+        return self._applyTfidf(self.corpus_bow.getRows(doc_ids))
+
+    def save(self, *args, **kwargs):
+        """
+        A TfidfCorpus is computed from its bag-of-words corpus; save that and
+        the tf-idf model instead.
+        """
+        raise NotImplementedError('Save the bag-of-words corpus and tf-idf model instead.')
@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+A compact, memory-mapped store of the article titles, with lookup by doc id,
+by title, and by title prefix (for autocomplete).
+
+The titles were stored as two pickled dictionaries: doc id -> (pageid,
+title), and title -> doc id. For Wikipedia's ~4.2M articles, unpickling
+these takes several seconds, and the Python objects take up gigabytes in
+every search process.
+
+TitleStore instead keeps the titles in flat binary arrays, which are
+memory-mapped (see csrcorpus.py for the same approach to the corpus):
+    blob     - (uint8)  All of the titles, UTF-8 encoded, one after another.
+    offsets  - (int64)  Title `i` is bytes offsets[i] to offsets[i + 1] of
+                        the blob.
+    pageids  - (int64)  The Wikipedia page id of each article.
+    sorted   - (uint32) The doc ids, in order of their lower-cased titles.
+
+Looking up a title by doc id is a slice of the blob. Looking up a doc id by
+title, or all of the titles starting with a prefix, is a binary search over
+the `sorted` array.
+"""
+
+from gensim import utils
+import numpy as np
+import logging
+import bisect
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class _SortedKeys(object):
+    """
+    Internal sequence of the lower-cased, UTF-8 encoded titles in sorted
+    order, which is read lazily so that `bisect` can search it.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store.sorted)
+
+    def __getitem__(self, i):
+        return self.store._getKey(self.store.sorted[i])
+
+
+class TitleStore(object):
+    """
+    The article titles, stored as memory-mapped arrays. Use
+    `TitleStore.serialize` to write one out, then `TitleStore(fname)` to open
+    it.
+
+    Indexing a TitleStore by doc id returns the title, so it can be used as
+    the `titles` list of a KeySearch.
+
+    The files are:
+        [fname]          - Pickled header (sizes).
+        [fname].blob     - Raw UTF-8 bytes.
+        [fname].offsets  - Raw int64 array.
+        [fname].pageids  - Raw int64 array.
+        [fname].sorted   - Raw uint32 array.
+    """
+
+    def __init__(self, fname, mmap='r'):
+        """
+        Open the title store saved at `fname`. By default, the arrays are
+        memory-mapped read-only; pass mmap=None to read them into memory.
+        """
+        self.fname = fname
+
+        header = utils.unpickle(fname)
+
+        self.num_titles = header['num_titles']
+
+        self.blob = self._openArray(fname + '.blob', np.uint8, header['blob_size'], mmap)
+        self.offsets = self._openArray(fname + '.offsets', np.int64, self.num_titles + 1, mmap)
+        self.pageids = self._openArray(fname + '.pageids', np.int64, self.num_titles, mmap)
+        self.sorted = self._openArray(fname + '.sorted', np.uint32, self.num_titles, mmap)
+
+        # Titles added since the store was written (see KeySearch.addDocuments)
+        # are held in memory.
+        self.added = []
+        self.added_pageids = []
+
+        # Map of doc id to title number, after a compaction (see
+        # KeySearch.compact). Numbers past the end of the stored titles are
+        # in `added`.
+        self.rows = None
+        self.doc_ids = None
+
+    @staticmethod
+    def _openArray(fname, dtype, length, mmap):
+        """
+        Internal function which opens (or memory-maps) one of the raw arrays.
+        """
+        # An empty file can't be memory-mapped.
+        if length == 0:
+            return np.zeros(0, dtype=dtype)
+
+        if mmap is None:
+            return np.fromfile(fname, dtype=dtype, count=length)
+
+        return np.memmap(fname, dtype=dtype, mode=mmap, shape=(length,))
+
+    def __len__(self):
+        if self.rows is not None:
+            return len(self.rows)
+
+        return self.num_titles + len(self.added)
+
+    def _getTitle(self, row):
+        """
+        Internal function which returns the title stored at `row`, as unicode.
+        """
+        if row >= self.num_titles:
+            return self.added[row - self.num_titles]
+
+        return self.blob[self.offsets[row]:self.offsets[row + 1]].tostring().decode('utf-8')
+
+    def _getKey(self, row):
+        """
+        Internal function which returns the sort key for the title at `row`:
+        the lower-cased title, UTF-8 encoded.
+        """
+        return self._getTitle(row).lower().encode('utf-8')
+
+    def _toRow(self, doc_id):
+        """
+        Internal function which translates a doc id to its title number.
+        """
+        if doc_id < 0:
+            doc_id += len(self)
+
+        if doc_id < 0 or doc_id >= len(self):
+            raise IndexError('doc id %d out of range' % doc_id)
+
+        if self.rows is None:
+            return doc_id
+
+        return int(self.rows[doc_id])
+
+    def _toDocId(self, row):
+        """
+        Internal function which translates a title number back to a doc id, or
+        -1 if the document has been removed.
+        """
+        if self.rows is None:
+            return row
+
+        return int(self.doc_ids[row])
+
+    def __getitem__(self, doc_id):
+        """
+        Return the title of document `doc_id`.
+        """
+        return self._getTitle(self._toRow(doc_id))
+
+    def __iter__(self):
+        for doc_id in range(0, len(self)):
+            yield self[doc_id]
+
+    def getPageId(self, doc_id):
+        """
+        Return the Wikipedia page id of document `doc_id`.
+        """
+        row = self._toRow(doc_id)
+
+        if row >= self.num_titles:
+            return self.added_pageids[row - self.num_titles]
+
+        return int(self.pageids[row])
+
+    def getId(self, title):
+        """
+        Look up the doc id for the article titled `title` (matched exactly).
+
+        Returns -1 if there's no such title.
+        """
+        if isinstance(title, str):
+            title = title.decode('utf-8')
+
+        key = title.lower().encode('utf-8')
+        keys = _SortedKeys(self)
+
+        # Titles which differ only by case share a sort key, so check each
+        # of them.
+        i = bisect.bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            row = int(self.sorted[i])
+            if self._getTitle(row) == title and self._toDocId(row) >= 0:
+                return self._toDocId(row)
+            i += 1
+
+        # Check the titles which were added since the store was written.
+        for (i, added_title) in enumerate(self.added):
+            if added_title == title and self._toDocId(self.num_titles + i) >= 0:
+                return self._toDocId(self.num_titles + i)
+
+        return -1
+
+    def findPrefix(self, prefix, topn=10):
+        """
+        Find the articles whose titles start with `prefix`, ignoring case.
+        This is meant for autocompleting a title as it's typed.
+
+        Returns up to `topn` tuples in the form:
+            (doc_id, title)
+        in alphabetical order.
+        """
+        if isinstance(prefix, str):
+            prefix = prefix.decode('utf-8')
+
+        key = prefix.lower().encode('utf-8')
+        keys = _SortedKeys(self)
+
+        # No UTF-8 string contains the byte 0xff, so every key starting with
+        # the prefix comes before prefix + 0xff.
+        start = bisect.bisect_left(keys, key)
+        end = bisect.bisect_left(keys, key + b'\xff', lo=start)
+
+        results = []
+        for i in range(start, end):
+            row = int(self.sorted[i])
+            doc_id = self._toDocId(row)
+
+            if doc_id >= 0:
+                results.append((doc_id, self._getTitle(row)))
+
+            if len(results) == topn:
+                break
+
+        # Add any matching titles which were added since the store was
+        # written.
+        for (i, title) in enumerate(self.added):
+            doc_id = self._toDocId(self.num_titles + i)
+
+            if doc_id >= 0 and title.lower().startswith(prefix.lower()):
+                results.append((doc_id, title))
+
+        results.sort(key=lambda result: result[1].lower())
+
+        return results[0:topn]
+
+    def extend(self, titles, pageids=None):
+        """
+        Add `titles` to the end of the store. They're held in memory until
+        the store is written out again.
+        """
+        first_row = self.num_titles + len(self.added)
+
+        titles = [title.decode('utf-8') if isinstance(title, str) else title for title in titles]
+
+        if pageids is None:
+            pageids = [-1] * len(titles)
+
+        self.added.extend(titles)
+        self.added_pageids.extend(pageids)
+
+        if self.rows is not None:
+            self.rows = np.concatenate((self.rows, np.arange(first_row, first_row + len(titles))))
+            self._updateDocIds()
+
+    def compact(self, keep):
+        """
+        Drop the titles which aren't marked True in the boolean array `keep`.
+        The remaining titles are re-numbered, in order.
+
+        Returns the TitleStore.
+        """
+        doc_ids = np.flatnonzero(keep)
+
+        if self.rows is None:
+            self.rows = doc_ids.astype(np.int64)
+        else:
+            self.rows = self.rows[doc_ids]
+
+        self._updateDocIds()
+
+        return self
+
+    def _updateDocIds(self):
+        """
+        Internal function which rebuilds the map of title number to doc id.
+        """
+        self.doc_ids = np.full(self.num_titles + len(self.added), -1, dtype=np.int64)
+        self.doc_ids[self.rows] = np.arange(len(self.rows))
+
+    def isModified(self):
+        """
+        Check whether any titles have been added or removed since the store
+        was written.
+        """
+        return len(self.added) > 0 or self.rows is not None
+
+    def getPageIds(self):
+        """
+        Return the page ids of all of the articles, in doc id order.
+        """
+        return [self.getPageId(doc_id) for doc_id in range(0, len(self))]
+
+    @staticmethod
+    def serialize(fname, titles, pageids=None):
+        """
+        Write the titles out to `fname`.
+
+        Parameters:
+            titles   The title of each document, in doc id order, as unicode
+                     or UTF-8 encoded strings.
+            pageids  Optional Wikipedia page id of each document.
+
+        The files are written under temporary names and then renamed, so an
+        open TitleStore can be written out over itself.
+
+        Returns the opened TitleStore.
+        """
+        logger.info('storing titles to %s', fname)
+
+        tmp_fname = fname + '.tmp'
+
+        encoded = []
+
+        with open(tmp_fname + '.blob', 'wb') as f_blob:
+            for title in titles:
+                if not isinstance(title, str):
+                    title = title.encode('utf-8')
+
+                f_blob.write(title)
+                encoded.append(title)
+
+        num_titles = len(encoded)
+
+        offsets = np.zeros(num_titles + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(title) for title in encoded])
+        offsets.tofile(tmp_fname + '.offsets')
+
+        if pageids is None:
+            pageids = [-1] * num_titles
+
+        np.asarray(pageids, dtype=np.int64).tofile(tmp_fname + '.pageids')
+
+        # Sort the titles by their lower-cased form, for lookups by title and
+        # prefix.
+        keys = [title.decode('utf-8').lower().encode('utf-8') for title in encoded]
+        del encoded
+
+        order = sorted(range(0, num_titles), key=keys.__getitem__)
+        del keys
+
+        np.asarray(order, dtype=np.uint32).tofile(tmp_fname + '.sorted')
+        del order
+
+        utils.pickle({'num_titles': num_titles, 'blob_size': int(offsets[-1])}, tmp_fname)
+
+        # Move the complete store into place, header last.
+        for ext in ['.blob', '.offsets', '.pageids', '.sorted', '']:
+            os.rename(tmp_fname + ext, fname + ext)
+
+        logger.info('saved %d titles (%d bytes) to %s', num_titles, offsets[-1], fname)
+
+        return TitleStore(fname)
+
+
+class TitleIdMap(object):
+    """
+    A read-only dictionary of article title -> doc id, backed by a
+    TitleStore. It stands in for the unpickled `titles_to_id` dictionary.
+    """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, title):
+        doc_id = self.store.getId(title)
+
+        if doc_id < 0:
+            raise KeyError(title)
+
+        return doc_id
+
+    def __contains__(self, title):
+        return self.store.getId(title) >= 0
+
+    def get(self, title, default=None):
+        doc_id = self.store.getId(title)
+
+        return default if doc_id < 0 else doc_id
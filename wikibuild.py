@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""
+Builds the Wikipedia dictionary and bag-of-words corpus in a single pass over
+the dump.
+
+The original approach (steps 1 and 2 of `make_wikicorpus.py`) parses the
+whole dump twice: once to build the dictionary, and again to convert the
+articles to bag-of-words vectors with the final word ids. Parsing and
+tokenizing is the slow part, so that's ~6.7 hours of work for ~3.5 hours
+worth of information.
+
+`buildWikiCorpus` instead tokenizes each article just once, across a pool of
+worker processes. Each word is given a provisional id the first time it's
+seen, and the word counts for each article are spooled to disk in the binary
+CSR format (see csrcorpus.py). Once the whole dump has been read, the
+dictionary is filtered using the document frequencies gathered along the
+way, and the spooled vectors are re-mapped to the final word ids--a fast,
+vectorized pass over the spool file which doesn't touch the dump again.
+"""
+
+from gensim.corpora import Dictionary
+from gensim.corpora.wikicorpus import process_article, \
+    init_to_ignore_interrupt, tokenize, IGNORED_NAMESPACES, ARTICLE_MIN_WORDS
+from gensim import utils
+from csrcorpus import CsrCorpus
+from wikidump import iterWikiPages, StageStats
+from scipy import sparse
+from collections import Counter
+import multiprocessing
+import numpy as np
+import logging
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def _processPage(args):
+    """
+    Worker function which tokenizes one article and counts its words.
+
+    `args` is (text, title, pageid). Redirects, stubs, and pages in the
+    ignored namespaces are skipped.
+
+    Returns (result, seconds), where `result` is None if the page was
+    skipped, or else (word_counts, num_tokens, title, pageid), where
+    `word_counts` is a list of (token, count) tuples.
+    """
+    text, title, pageid = args
+
+    t0 = time.time()
+
+    tokens, title, pageid = process_article((text, False, title, pageid),
+                                            tokenizer_func=tokenize)
+
+    # Article redirects and short stubs are pruned here, the same way that
+    # WikiCorpus does it.
+    if len(tokens) < ARTICLE_MIN_WORDS or \
+            any(title.startswith(ignore + ':') for ignore in IGNORED_NAMESPACES):
+        return None, time.time() - t0
+
+    # The words are sorted, so that new words are given their provisional ids
+    # in the same order that `Dictionary.doc2bow` assigns ids. This makes the
+    # final word ids identical to the two-pass build.
+    return (sorted(Counter(tokens).items()), len(tokens), title, pageid), time.time() - t0
+
+
+def buildWikiCorpus(dump_file, data_dir='./data/', keep_words=100000,
+                    no_below=20, no_above=0.1, processes=None, chunksize=10000,
+                    index_file=None, read_processes=None):
+    """
+    Parse the Wikipedia dump `dump_file` once, and write out:
+        [data_dir]dictionary.txt.bz2          - The filtered dictionary.
+        [data_dir]bow.csr                     - The bag-of-words corpus, as a
+                                                CsrCorpus.
+        [data_dir]bow.csr.metadata.cpickle    - Map of doc id to
+                                                (pageid, article title).
+        [data_dir]titles_to_id.pickle         - Map of article title to doc id.
+
+    The dictionary is filtered the same way as in step 1 of
+    `make_wikicorpus.py`: words must appear in at least `no_below` articles
+    and no more than `no_above` (a fraction) of the articles, and only the
+    `keep_words` most common words are kept.
+
+    `dump_file` can be either the regular dump or the multistream dump
+    (with its index file, `index_file`). The multistream dump is
+    decompressed in parallel--see wikidump.py.
+
+    Parameters:
+        processes       The number of worker processes for tokenizing.
+                        Defaults to one less than the number of cores.
+        chunksize       The number of articles per spooled chunk.
+        read_processes  The number of worker processes for decompressing a
+                        multistream dump. Defaults to a quarter of
+                        `processes`, since tokenizing is the slower stage.
+
+    Returns (dictionary, corpus_bow).
+    """
+    if processes is None:
+        processes = max(1, multiprocessing.cpu_count() - 1)
+
+    if read_processes is None:
+        read_processes = max(1, processes // 4)
+
+    spool_fname = data_dir + 'bow_spool.csr'
+
+    # The provisional word ids, in the order the words were first seen (each
+    # article's new words in sorted order, like doc2bow).
+    vocab = {}
+
+    # Running totals, updated as the articles are processed.
+    stats = {'num_docs': 0, 'num_pos': 0, 'num_nnz': 0}
+    dfs = np.zeros(1 << 20, dtype=np.int64)
+    titles = []
+
+    # The throughput of each stage: reading, tokenizing, and spooling.
+    stage_stats = StageStats()
+
+    def spoolChunks():
+        """
+        Tokenize the articles on the worker pool, and yield the word counts
+        as CSR matrices of `chunksize` articles each.
+        """
+        # Only articles (namespace '0') are kept.
+        pages = ((text, title, pageid) for (title, text, pageid)
+                 in iterWikiPages(dump_file, index_file, read_processes,
+                                  filter_namespaces=('0',), stats=stage_stats))
+
+        pool = multiprocessing.Pool(processes, init_to_ignore_interrupt)
+
+        lengths = []
+        ids = []
+        counts = []
+
+        try:
+            # Hand the pages to the pool in groups, so that the whole input
+            # isn't read into memory at once. (The pages are read here rather
+            # than in a separate process, as `utils.chunkize` would do, since
+            # the reader has its own pool of processes which reads ahead.)
+            for group in utils.grouper(pages, 10 * processes):
+                for (result, seconds) in pool.imap(_processPage, group):
+                    stage_stats.add('tokenize', 1, seconds)
+
+                    if result is None:
+                        continue
+
+                    t0 = time.time()
+
+                    word_counts, num_tokens, title, pageid = result
+
+                    # Look up the provisional id for each word, adding any
+                    # new words to the vocabulary.
+                    for (token, count) in word_counts:
+                        ids.append(vocab.setdefault(token, len(vocab)))
+                        counts.append(count)
+
+                    lengths.append(len(word_counts))
+                    titles.append((pageid, title))
+
+                    stats['num_pos'] += num_tokens
+
+                    stage_stats.add('spool', 1, time.time() - t0)
+
+                    if len(lengths) == chunksize:
+                        yield makeChunk(lengths, ids, counts)
+                        lengths, ids, counts = [], [], []
+
+            if len(lengths) > 0:
+                yield makeChunk(lengths, ids, counts)
+        finally:
+            pool.terminate()
+
+    def makeChunk(lengths, ids, counts):
+        """
+        Convert the word counts for a chunk of articles to a CSR matrix, and
+        update the document frequencies.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        indptr = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+
+        # Grow the document frequency array as the vocabulary grows.
+        while len(vocab) > len(dfs):
+            dfs.resize(2 * len(dfs), refcheck=False)
+
+        # Each word appears at most once per article.
+        dfs[0:len(vocab)] += np.bincount(ids, minlength=len(vocab))
+
+        stats['num_docs'] += len(lengths)
+        stats['num_nnz'] += len(ids)
+
+        logger.info('PROGRESS: tokenized %d articles, %d unique words so far',
+                    stats['num_docs'], len(vocab))
+        stage_stats.report()
+
+        return sparse.csr_matrix((np.asarray(counts, dtype=np.uint32), ids, indptr),
+                                 shape=(len(lengths), len(vocab)))
+
+    # ======== Pass 1: Tokenize and spool the word counts ========
+    logger.info('tokenizing %s with %d processes', dump_file, processes)
+    t0 = time.time()
+
+    spool = CsrCorpus.serializeChunks(spool_fname, spoolChunks(),
+                                      data_dtype=np.uint32)
+
+    num_docs = stats['num_docs']
+    num_tokens = len(vocab)
+    dfs = dfs[0:num_tokens]
+
+    logger.info('tokenized %d articles (%d unique words) in %.0f seconds',
+                num_docs, num_tokens, time.time() - t0)
+    stage_stats.report()
+
+    # ======== Filter the dictionary ========
+    # Keep the words which appear in at least `no_below` articles, but not
+    # in more than `no_above` of them. (This matches
+    # Dictionary.filter_extremes.)
+    good = np.flatnonzero((dfs >= no_below) & (dfs <= int(no_above * num_docs)))
+
+    # Keep just the `keep_words` most common of these.
+    if keep_words is not None and len(good) > keep_words:
+        good = good[np.argsort(-dfs[good], kind='mergesort')[0:keep_words]]
+
+    # The final ids keep the provisional order, the same as
+    # Dictionary.compactify does.
+    good = np.sort(good)
+
+    remap = np.full(num_tokens, -1, dtype=np.int64)
+    remap[good] = np.arange(len(good))
+
+    # Build the final dictionary.
+    id2token = [None] * num_tokens
+    for (token, token_id) in vocab.iteritems():
+        id2token[token_id] = token
+    vocab.clear()
+
+    dictionary = Dictionary()
+    dictionary.token2id = dict([(id2token[old_id], new_id) for (new_id, old_id) in enumerate(good.tolist())])
+    dictionary.dfs = dict(enumerate(dfs[good].tolist()))
+    dictionary.num_docs = num_docs
+    dictionary.num_pos = stats['num_pos']
+    dictionary.num_nnz = stats['num_nnz']
+    del id2token
+
+    logger.info('kept %d of %d unique words', len(dictionary), num_tokens)
+
+    dictionary.save_as_text(data_dir + 'dictionary.txt.bz2')
+
+    # ======== Pass 2: Re-map the spooled vectors to the final ids ========
+    def remapChunks():
+        for chunk in spool.iterChunks(chunksize):
+            new_ids = remap[chunk.indices]
+            keep = new_ids >= 0
+
+            # Count the remaining words in each article.
+            rows = np.repeat(np.arange(chunk.shape[0]), np.diff(chunk.indptr))
+            lengths = np.bincount(rows[keep], minlength=chunk.shape[0])
+            indptr = np.concatenate(([0], np.cumsum(lengths)))
+
+            chunk = sparse.csr_matrix((chunk.data[keep].astype(np.float32), new_ids[keep], indptr),
+                                      shape=(chunk.shape[0], len(dictionary)))
+
+            # Put the word ids in order, the same as doc2bow does.
+            chunk.sort_indices()
+
+            yield chunk
+
+    logger.info('re-mapping the spooled vectors to the final word ids')
+
+    corpus_bow = CsrCorpus.serializeChunks(data_dir + 'bow.csr', remapChunks(),
+                                           num_terms=len(dictionary))
+
+    # The spool files are no longer needed.
+    for ext in ['', '.indptr', '.indices', '.data']:
+        os.remove(spool_fname + ext)
+
+    # Write out the article titles, in the same format as the metadata from
+    # MmCorpus.serialize, plus the reverse mapping.
+    utils.pickle(dict(enumerate(titles)), data_dir + 'bow.csr.metadata.cpickle')
+    utils.pickle(dict((title, doc_id) for (doc_id, (pageid, title)) in enumerate(titles)),
+                 data_dir + 'titles_to_id.pickle')
+
+    return dictionary, corpus_bow
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Reads the pages out of a Wikipedia dump, decompressing and parsing the dump
+on a pool of worker processes.
+
+A regular dump (enwiki-latest-pages-articles.xml.bz2) is one long bz2
+stream, so it can only be decompressed sequentially, on one core. That caps
+the speed of everything downstream of it.
+
+Wikipedia also publishes a "multistream" version of the dump
+(enwiki-latest-pages-articles-multistream.xml.bz2). This is a series of
+independent bz2 streams of 100 pages each, concatenated together, along with
+an index file giving the byte offset of each stream. The streams can be
+decompressed and parsed in parallel, which is what `iterWikiPages` does.
+The pages are still returned in their original order.
+
+If the index file isn't available, the stream offsets are found by scanning
+the dump for the bz2 stream headers. If the dump turns out to be a single
+stream, it's read sequentially instead.
+"""
+
+from gensim.corpora.wikicorpus import extract_pages, init_to_ignore_interrupt
+from xml.etree import cElementTree
+from collections import deque
+import multiprocessing
+import numpy as np
+import logging
+import time
+import bz2
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+# Each bz2 stream starts with 'BZh', the block size ('1' - '9'), and then the
+# magic number of the first compressed block.
+STREAM_HEADER = re.compile(b'BZh[1-9]1AY&SY')
+
+
+class StageStats(object):
+    """
+    Keeps track of the number of pages which have passed through each stage
+    of a processing pipeline, and the time spent in each stage.
+
+    Stages which run on a pool of processes report the time spent in the
+    workers, so the rate per process shows how fast one core runs that stage.
+    """
+
+    def __init__(self):
+        self.t0 = time.time()
+        self.stages = []
+        self.pages = {}
+        self.seconds = {}
+
+    def add(self, stage, num_pages, seconds):
+        """
+        Record that `num_pages` pages passed through `stage`, taking
+        `seconds` of processing time.
+        """
+        if stage not in self.pages:
+            self.stages.append(stage)
+            self.pages[stage] = 0
+            self.seconds[stage] = 0.0
+
+        self.pages[stage] += num_pages
+        self.seconds[stage] += seconds
+
+    def report(self):
+        """
+        Log the throughput of each stage.
+        """
+        elapsed = max(time.time() - self.t0, 1e-6)
+
+        for stage in self.stages:
+            logger.info('  %-10s %9d pages, %7.0f pages/sec overall, %7.0f pages/sec per process',
+                        stage, self.pages[stage], self.pages[stage] / elapsed,
+                        self.pages[stage] / max(self.seconds[stage], 1e-6))
+
+
+def readStreamOffsets(index_file):
+    """
+    Read the byte offset of each stream from a multistream index file. Each
+    line of the index has the format:
+        offset:pageid:title
+
+    Returns a sorted array of the unique offsets.
+    """
+    offsets = []
+    last = -1
+
+    for line in bz2.BZ2File(index_file):
+        offset = int(line[0:line.index(b':')])
+
+        # Every page in a stream has the same offset.
+        if offset != last:
+            offsets.append(offset)
+            last = offset
+
+    return np.unique(np.asarray(offsets, dtype=np.int64))
+
+
+def findStreamOffsets(dump_file, buffer_size=1 << 26):
+    """
+    Find the byte offset of each bz2 stream in `dump_file` by scanning it for
+    the stream headers. This is the fallback when there's no index file.
+
+    Returns a sorted array of the offsets.
+    """
+    offsets = []
+
+    with open(dump_file, 'rb') as f:
+        pos = 0
+        tail = b''
+
+        while True:
+            data = f.read(buffer_size)
+            if not data:
+                break
+
+            # Keep the end of the previous buffer, in case a header is split
+            # across the two.
+            data = tail + data
+            start = pos - len(tail)
+
+            offsets.extend(start + m.start() for m in STREAM_HEADER.finditer(data))
+
+            tail = data[-9:]
+            pos = start + len(data)
+
+    return np.unique(np.asarray(offsets, dtype=np.int64))
+
+
+def _readStreams(args):
+    """
+    Worker function which decompresses and parses a run of consecutive
+    streams from a multistream dump.
+
+    `args` is (dump_file, start, end, filter_namespaces), where `start` and
+    `end` are the byte offsets of the run.
+
+    Returns (pages, seconds), where `pages` is a list of
+    (title, text, pageid) tuples.
+    """
+    dump_file, start, end, filter_namespaces = args
+
+    t0 = time.time()
+
+    with open(dump_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    # Decompress each of the streams in turn.
+    parts = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        parts.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+
+    xml = b''.join(parts)
+
+    # The first stream also holds the <mediawiki> and <siteinfo> header, and
+    # the last one the closing </mediawiki> tag. Keep just the pages.
+    first = xml.find(b'<page>')
+    last = xml.rfind(b'</page>')
+
+    pages = []
+
+    if first >= 0 and last >= 0:
+        root = cElementTree.fromstring(b'<pages>' + xml[first:last + len(b'</page>')] + b'</pages>')
+
+        for elem in root.iterfind('page'):
+            title = elem.findtext('title')
+            text = elem.findtext('revision/text')
+            pageid = elem.findtext('id')
+
+            # Pages outside of the requested namespaces are returned with no
+            # text, the same as gensim's `extract_pages`.
+            if filter_namespaces and elem.findtext('ns') not in filter_namespaces:
+                text = None
+
+            pages.append((title, text or '', pageid))
+
+    return pages, time.time() - t0
+
+
+def iterWikiPages(dump_file, index_file=None, processes=None,
+                  filter_namespaces=('0',), streams_per_task=16, stats=None):
+    """
+    Iterate over the pages in the Wikipedia dump `dump_file`, yielding
+    (title, text, pageid) tuples in their original order.
+
+    If `dump_file` is a multistream dump, its streams are decompressed and
+    parsed in parallel on `processes` worker processes. The stream offsets
+    are read from `index_file` if given; otherwise the dump is scanned for
+    them. A regular, single-stream dump is read sequentially.
+
+    Parameters:
+        processes          The number of reader processes. Defaults to half
+                           of the cores.
+        filter_namespaces  Pages outside of these namespaces are returned
+                           with no text.
+        streams_per_task   The number of streams to hand to a worker at once.
+        stats              Optional StageStats to record the 'read' stage in.
+    """
+    if processes is None:
+        processes = max(1, multiprocessing.cpu_count() // 2)
+
+    if index_file is not None:
+        logger.info('reading the stream offsets from %s', index_file)
+        offsets = readStreamOffsets(index_file)
+    else:
+        logger.info('scanning %s for bz2 streams', dump_file)
+        offsets = findStreamOffsets(dump_file)
+
+    # A regular dump is just one stream, so fall back to reading it in order.
+    if len(offsets) <= 1:
+        logger.info('%s is a single bz2 stream; reading it sequentially', dump_file)
+
+        t0 = time.time()
+        for page in extract_pages(bz2.BZ2File(dump_file), filter_namespaces):
+            if stats is not None:
+                stats.add('read', 1, time.time() - t0)
+
+            yield page
+
+            t0 = time.time()
+        return
+
+    logger.info('reading %d streams with %d processes', len(offsets), processes)
+
+    # Divide the dump up into runs of `streams_per_task` streams.
+    bounds = np.append(offsets[::streams_per_task], os.path.getsize(dump_file))
+    tasks = [(dump_file, int(bounds[i]), int(bounds[i + 1]), filter_namespaces)
+             for i in range(0, len(bounds) - 1)]
+
+    pool = multiprocessing.Pool(processes, init_to_ignore_interrupt)
+
+    try:
+        # Keep a limited number of tasks in flight, so that the decompressed
+        # pages don't pile up in memory if the downstream stages are slower.
+        pending = deque()
+        next_task = 0
+
+        while next_task < len(tasks) or len(pending) > 0:
+
+            while next_task < len(tasks) and len(pending) < 2 * processes:
+                pending.append(pool.apply_async(_readStreams, (tasks[next_task],)))
+                next_task += 1
+
+            # Return the pages in order.
+            pages, seconds = pending.popleft().get()
+
+            if stats is not None:
+                stats.add('read', len(pages), seconds)
+
+            for page in pages:
+                yield page
+    finally:
+        pool.terminate()